@@ -1,23 +1,75 @@
 """An implementation of Extensible Data Notation (EDN).
 
-This implementation is incomplete. There's just enough so that the Python
-plugin host can communicate with the Clojure server.
+read reads all of EDN, including tagged elements (see TAGS). LineDecoder
+reads EDN elements from a stream with one element per line.
 
 The tricky parts are ported from Clojure's EdnReader.java.
 
 For more information on EDN, see https://github.com/edn-format/edn."""
 
-from dataclasses import dataclass
-import io
+from decimal import Decimal
+from fractions import Fraction
+from functools import lru_cache
+import datetime
+import math
+import re
+import threading
+import uuid
+import weakref
 
 
 # Types
 
 
-@dataclass(eq=True, frozen=True)
-class Keyword:
-    name: str
-    namespace: str = ""
+class Named(object):
+    """A base class for interned EDN names.
+
+    Instances are flyweights: constructing a name with the same name and
+    namespace twice returns the same object. Equality and hashing are
+    therefore identity-based, which lets Python compare and hash names
+    without calling back into Python code.
+
+    Several threads construct names at once, and WeakValueDictionary.setdefault
+    isn't atomic, so the first construction of a name happens under a lock."""
+    __slots__ = ("name", "namespace", "__weakref__")
+
+    lock = threading.Lock()
+
+    def __new__(cls, name, namespace=""):
+        key = (name, namespace)
+        instance = cls.interned.get(key)
+
+        if instance is None:
+            with Named.lock:
+                instance = cls.interned.get(key)
+
+                if instance is None:
+                    instance = object.__new__(cls)
+                    object.__setattr__(instance, "name", name)
+                    object.__setattr__(instance, "namespace", namespace)
+                    cls.interned[key] = instance
+
+        return instance
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (type(self), (self.name, self.namespace))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, _):
+        return self
+
+
+class Keyword(Named):
+    __slots__ = ()
+    interned = weakref.WeakValueDictionary()
 
     def __repr__(self):
         if self.namespace:
@@ -26,10 +78,9 @@ class Keyword:
             return f":{self.name}"
 
 
-@dataclass(eq=True, frozen=True)
-class Symbol:
-    name: str
-    namespace: str = ""
+class Symbol(Named):
+    __slots__ = ()
+    interned = weakref.WeakValueDictionary()
 
     def __repr__(self):
         if self.namespace:
@@ -47,242 +98,379 @@ def kwmap(d):
 # Read
 
 
-def error(error, b, ch):
-    raise error(b.getvalue(), b.tell(), ch)
+class UnmatchedDelimiterError(ValueError):
+    pass
+
 
+def interpret_token(token):
+    """Interpret an EDN token.
 
-def unread(b, n):
-    """Given a filelike object and an integer, unread that many characters from
-    the object."""
-    b.seek(b.tell() - n)
+    A token in this context is one of:
 
+    - nil
+    - true/false
+    - keyword
+    - symbol"""
+    if token == "nil":
+        return None
+    elif token == "true":
+        return True
+    elif token == "false":
+        return False
+    elif token.startswith(":"):
+        xs = token.split("/")
 
-def read_string(b, _):
-    """Given a filelike object, read a single EDN string."""
-    with io.StringIO() as s:
-        while (ch := b.read(1)) != '"':
-            if ch == "\\":
-                ch = b.read(1)
+        if len(xs) == 2:
+            return Keyword(xs[1], xs[0][1:])
+        else:
+            return Keyword(xs[0][1:])
+    else:
+        xs = token.split("/")
 
-                if ch == "t":
-                    ch = "\t"
-                elif ch == "n":
-                    ch = "\n"
-                elif ch == "r":
-                    ch = ""
+        if len(xs) == 2 and xs[0] and xs[1]:
+            return Symbol(xs[1], xs[0])
+        else:
+            return Symbol(token)
+
+
+# A single regular expression matches the leading whitespace and the entire
+# next token, string, or delimiter in one go, so the reader does a constant
+# amount of Python-level work per element instead of per character.
+
+
+ELEMENT = re.compile(r"""[\s,]*(?:;[^\n]*[\s,]*)*(?:
+    (?P<token>[^\s,";^()\[\]{}\\\#][^\s,";^()\[\]{}\\]*)
+  | "(?P<string>[^"\\]*(?:\\.[^"\\]*)*)"
+  | (?P<open>[(\[{]|\#\{)
+  | (?P<close>[)\]}])
+  | \\(?P<character>.[^\s,";^()\[\]{}\\]*)
+  | (?P<dispatch>\#(?:_|\#?[^\s,";^()\[\]{}\\]*))
+  | (?P<meta>\^)
+  | (?P<error>[^\s,])
+)""", re.VERBOSE | re.DOTALL)
+
+# A map whose keys are keywords and whose values are strings or tokens, like
+# most prepl responses. read reads these in one pass of FLAT_ENTRY.
+FLAT_MAP = re.compile(r"""[\s,]*\{(?:
+    [\s,]*:[^\s,";^()\[\]{}\\\#]+[\s,]+
+    (?:"[^"\\]*(?:\\.[^"\\]*)*"|[^\s,";^()\[\]{}\\\#][^\s,";^()\[\]{}\\]*)
+)*[\s,]*\}[\s,]*""", re.VERBOSE | re.DOTALL)
+
+FLAT_ENTRY = re.compile(r"""[\s,]*(:[^\s,";^()\[\]{}\\\#]+)[\s,]+
+    (?:"([^"\\]*(?:\\.[^"\\]*)*)"|([^\s,";^()\[\]{}\\\#][^\s,";^()\[\]{}\\]*))""", re.VERBOSE | re.DOTALL)
+
+# The maximum length of a string read tries to read as a flat map. Matching
+# FLAT_MAP costs a second pass over the string, which only pays off for short
+# messages.
+FLAT_MAP_MAX_LENGTH = 1024
+
+ESCAPE = re.compile(r"\\(?:u([0-9a-fA-F]{4})|(.))", re.DOTALL)
+
+ESCAPES = {
+    "t": "\t",
+    "r": "\r",
+    "n": "\n",
+    "b": "\b",
+    "f": "\f",
+}
 
-            s.write(ch)
+CHARACTERS = {
+    "newline": "\n",
+    "return": "\r",
+    "space": " ",
+    "tab": "\t",
+    "backspace": "\b",
+    "formfeed": "\f",
+}
 
-        return s.getvalue()
+CLOSING_DELIMITERS = {
+    "(": ")",
+    "[": "]",
+    "{": "}",
+    "#{": "}",
+}
 
 
-def read_comment(b, ch):
-    error(NotImplementedError, b, ch)
+def unescape_match(m):
+    if code_point := m.group(1):
+        return chr(int(code_point, 16))
+    else:
+        return ESCAPES.get(m.group(2), m.group(2))
 
 
-def read_meta(b, ch):
-    error(NotImplementedError, b, ch)
+def unescape(s):
+    """Given the contents of an EDN string literal, return the string the
+    literal represents."""
+    if "\\" not in s:
+        return s
 
+    try:
+        # Let the unicode_escape codec do the work in C. Encoding the string as
+        # Latin-1 with backslashreplace turns every character outside Latin-1
+        # into a \u escape, which the codec then decodes back into the same
+        # character.
+        return s.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    except UnicodeDecodeError:
+        return ESCAPE.sub(unescape_match, s)
 
-def read_list(b, _):
-    """Given a filelike object, read a single EDN list."""
-    return read_delimited_list(b, ')')
 
+def interpret_character(s, token, position):
+    """Given the token of an EDN character literal (without the leading
+    backslash), return the character the literal represents."""
+    if len(token) == 1:
+        return token
+    elif ch := CHARACTERS.get(token):
+        return ch
+    elif token[0] == "u" and len(token) == 5:
+        return chr(int(token[1:], 16))
+    else:
+        raise NotImplementedError(s, position, token)
 
-def read_delimited_list(b, delim):
-    """Given a filelike object and a delimiter character, read an EDN element
-    that edns with that character."""
-    xs = []
 
-    while (ch := b.read(1)) != delim:
-        if is_whitespace(ch):
-            continue
+# Protocol messages reuse the same handful of keywords over and over, so
+# remember what the most recent tokens mean instead of interpreting them every
+# time.
+interpret_token_cached = lru_cache(maxsize=4096)(interpret_token)
 
-        xs.append(read1(b, ch))
 
-    return xs
+# https://github.com/clojure/clojure/blob/ecd5ff59e07de649a9f9affb897d02165fe7e553/src/jvm/clojure/lang/EdnReader.java#L30-L34
+INT = re.compile(r"([-+]?)(?:(0)|([1-9][0-9]*)|0[xX]([0-9A-Fa-f]+)|0([0-7]+)|([1-9][0-9]?)[rR]([0-9A-Za-z]+)|0[0-9]+)(N)?")
+RATIO = re.compile(r"([-+]?[0-9]+)/([0-9]+)")
+FLOAT = re.compile(r"([-+]?[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?)(M)?")
 
 
-def read_vector(b, _):
-    """Given a filelike object, read a single EDN vector."""
-    return read_delimited_list(b, ']')
+def is_number(token):
+    """Given a token, return true if it's an EDN number."""
+    return token[0].isdigit() or (token[0] in "+-" and len(token) > 1 and token[1].isdigit())
 
 
-def read_set(b, _):
-    """Given a filelike object, read a single EDN set."""
-    return set(read_delimited_list(b, '}'))
+def interpret_number(token):
+    """Given a token that starts with a digit (optionally preceded by a
+    sign), return the number it represents.
 
+    Integers (including N-suffixed ones) become ints, M-suffixed numbers
+    become Decimals, ratios become Fractions, and other floating point
+    numbers become floats."""
+    if m := INT.fullmatch(token):
+        if m.group(2):
+            return 0
 
-class UnmatchedDelimiterError(ValueError):
-    pass
+        sign = -1 if m.group(1) == "-" else 1
 
+        if n := m.group(3):
+            return sign * int(n)
+        elif n := m.group(4):
+            return sign * int(n, 16)
+        elif n := m.group(5):
+            return sign * int(n, 8)
+        elif n := m.group(7):
+            return sign * int(n, int(m.group(6)))
+    elif m := FLOAT.fullmatch(token):
+        if m.group(4):
+            return Decimal(m.group(1))
+        else:
+            return float(token)
+    elif m := RATIO.fullmatch(token):
+        return Fraction(int(m.group(1)), int(m.group(2)))
 
-def read_unmatched_delimiter(b, ch):
-    error(UnmatchedDelimiterError, b, ch)
+    raise ValueError(f"Invalid number: {token}")
 
 
-def read_map(b, _):
-    """Given a filelike object, read a single EDN map."""
-    xs = read_delimited_list(b, '}')
+SYMBOLIC_VALUES = {
+    "Inf": math.inf,
+    "-Inf": -math.inf,
+    "NaN": math.nan,
+}
 
-    if (len(xs) & 1) == 1:
-        raise ValueError("Map must have an even number of elements")
 
-    it = iter(xs)
-    return dict(zip(it, it))
+# Inst
 
+INST = re.compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[Tt](\d{2})(?::(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?)?)?)?(?:([Zz])|([-+])(\d{2}):(\d{2}))?")
 
-def read_character(b, _):
-    """Given a filelike object, read a single EDN character."""
-    ch = b.read(1)
-    token = read_token(b, ch)
 
-    if len(token) == 1:
-        return token
-    elif token == "space":
-        return " "
-    elif token == "tab":
-        return "\t"
-    elif token in {"newline", "return"}:
-        return "\n"
-    else:
-        error(NotImplementedError, b, ch)
+def read_inst(s):
+    """Given an RFC 3339 timestamp, return the datetime it represents.
 
+    Like Clojure, fill in any components the timestamp omits and use UTC if
+    it has no offset."""
+    if not isinstance(s, str) or not (m := INST.fullmatch(s)):
+        raise ValueError(f"Invalid #inst: {s}")
 
-def read_dispatch(b, ch):
-    """Given a file object and a character, read an EDN element prefix by the
-    dispatch macro."""
-    x = b.read(1)
+    year, month, day, hour, minute, second, fraction, _, sign, offset_hours, offset_minutes = m.groups()
 
-    if x == '{':
-        return read_set(b, ch)
+    if sign:
+        offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        tz = datetime.timezone(-offset if sign == "-" else offset)
     else:
-        error(NotImplementedError, b, ch)
-
-
-# https://github.com/clojure/clojure/blob/ecd5ff59e07de649a9f9affb897d02165fe7e553/src/jvm/clojure/lang/EdnReader.java#L37-L59
-MACROS = {
-    '"': read_string,
-    ';': read_comment,
-    '^': read_meta,
-    '(': read_list,
-    ')': read_unmatched_delimiter,
-    '[': read_vector,
-    ']': read_unmatched_delimiter,
-    '{': read_map,
-    '}': read_unmatched_delimiter,
-    '\\': read_character,
-    '#': read_dispatch
-}
+        tz = datetime.timezone.utc
 
+    return datetime.datetime(
+        int(year),
+        int(month or 1),
+        int(day or 1),
+        int(hour or 0),
+        int(minute or 0),
+        int(second or 0),
+        int((fraction or "0")[:6].ljust(6, "0")),
+        tz
+    )
 
-def read_macro(b, ch):
-    """Read an EDN element prefixed by a macro character.
 
-    A macro character is one of:
+def read_uuid(s):
+    """Given the canonical string representation of a UUID, return the
+    UUID."""
+    if not isinstance(s, str):
+        raise ValueError(f"Invalid #uuid: {s}")
 
-    - string
-    - comment
-    - metadata
-    - list
-    - vector
-    - map
-    - character
-    - dispatch"""
-    return MACROS.get(ch, lambda _1, _2: None).__call__(b, ch)
+    return uuid.UUID(s)
 
 
-def is_whitespace(ch):
-    """Given a character, return true if it's an EDN whitespace character."""
-    return ch == "," or ch.isspace()
+class TaggedLiteral(object):
+    """An EDN element with a tag that has no handler in TAGS."""
+    __slots__ = ("tag", "form")
 
+    def __init__(self, tag, form):
+        self.tag = tag
+        self.form = form
 
-def is_macro(ch):
-    """Given a character, return true if it's a macro character."""
-    return ch in MACROS
+    def __eq__(self, other):
+        return isinstance(other, TaggedLiteral) and self.tag == other.tag and self.form == other.form
 
+    def __hash__(self):
+        return hash((self.tag, repr(self.form)))
 
-def is_terminating_macro(ch):
-    """Given a character, return true if it's a terminating macro.
+    def __repr__(self):
+        return f"#{self.tag} {self.form!r}"
 
-    A terminating macro signifies the end of an EDN token."""
-    return (ch != "#" and ch != "'" and is_macro(ch))
 
+# Maps a tag (without the leading #) to a function that, given the element
+# that follows the tag, returns the value the tagged element represents.
+TAGS = {
+    "inst": read_inst,
+    "uuid": read_uuid,
+}
 
-def read_token(b, ch):
-    """Given a file object and a start character, read a single EDN token."""
-    with io.StringIO() as s:
-        s.write(ch)
 
-        while ch := b.read(1):
-            if is_whitespace(ch) or is_terminating_macro(ch):
-                unread(b, 1)
-                break
+def register_tag(tag, handler):
+    """Given a tag (without the leading #) and a function of one argument,
+    read elements with the tag by calling the function with the element
+    that follows the tag."""
+    TAGS[tag] = handler
 
-            s.write(ch)
 
-        return s.getvalue()
+def read_tagged(tag, x):
+    """Given a tag and the element that follows it, return the value the
+    tagged element represents."""
+    if handler := TAGS.get(tag):
+        return handler(x)
+    else:
+        return TaggedLiteral(tag, x)
 
 
-def read_number(b, ch):
-    """Given a file object and a start character, read a single number."""
-    with io.StringIO() as s:
-        s.write(ch)
+def collection(delimiter, xs):
+    """Given an opening delimiter and a list of elements, return the
+    collection the delimiter opens."""
+    if delimiter == "{":
+        if (len(xs) & 1) == 1:
+            raise ValueError("Map must have an even number of elements")
 
-        while x := b.read(1):
-            if not x.isdigit():
-                unread(b, 1)
-                break
+        it = iter(xs)
+        return dict(zip(it, it))
+    elif delimiter == "#{":
+        return set(xs)
+    else:
+        return xs
 
-            s.write(x)
 
-        return int(s.getvalue())
+def read_flat_map(s):
+    """Given a string that FLAT_MAP matches, return the map it represents."""
+    m = {}
 
+    for key, string, token in FLAT_ENTRY.findall(s, s.index("{") + 1):
+        if token:
+            m[interpret_token_cached(key)] = interpret_number(token) if is_number(token) else interpret_token_cached(token)
+        else:
+            m[interpret_token_cached(key)] = unescape(string)
 
-def interpret_token(token):
-    """Interpret an EDN token.
+    return m
 
-    A token in this context is one of:
 
-    - nil
-    - true/false
-    - keyword
-    - symbol"""
-    if token == "nil":
-        return None
-    elif token == "true":
-        return True
-    elif token == "false":
-        return False
-    elif token.startswith(":"):
-        xs = token.split("/")
-
-        if len(xs) == 2:
-            return Keyword(xs[1], xs[0][1:])
+def read(s):
+    """Read one EDN element from a string.
+
+    Return None if the string has no elements."""
+    if len(s) < FLAT_MAP_MAX_LENGTH and FLAT_MAP.fullmatch(s):
+        return read_flat_map(s)
+
+    stack = []
+    xs = None
+    delimiter = None
+
+    for m in ELEMENT.finditer(s):
+        kind = m.lastgroup
+
+        if kind == "token":
+            token = m.group(kind)
+
+            if is_number(token):
+                x = interpret_number(token)
+            else:
+                x = interpret_token_cached(token)
+        elif kind == "string":
+            x = unescape(m.group(kind))
+        elif kind == "open":
+            stack.append((delimiter, xs))
+            delimiter = m.group(kind)
+            xs = []
+            continue
+        elif kind == "close":
+            ch = m.group(kind)
+
+            if xs is None or CLOSING_DELIMITERS.get(delimiter) != ch:
+                raise UnmatchedDelimiterError(s, m.start(kind), ch)
+
+            x = collection(delimiter, xs)
+            delimiter, xs = stack.pop()
+        elif kind == "character":
+            x = interpret_character(s, m.group(kind), m.start(kind))
+        elif kind == "dispatch" or kind == "meta":
+            dispatch = m.group(kind)
+
+            if dispatch.startswith("##"):
+                if (x := SYMBOLIC_VALUES.get(dispatch[2:])) is None:
+                    raise NotImplementedError(s, m.start(kind), dispatch)
+            elif dispatch == "#":
+                raise NotImplementedError(s, m.start(kind), dispatch)
+            else:
+                # A prefix (#_, ^, or a tag) waits for the element it applies
+                # to the same way a collection waits for its elements.
+                stack.append((delimiter, xs))
+                delimiter = dispatch
+                xs = []
+                continue
+        elif m.group(kind) == '"':
+            raise EOFError(s, len(s), '"')
         else:
-            return Keyword(xs[0][1:])
-    else:
-        return Symbol(token)
-
-
-def read1(b, ch):
-    """Given a file object and a start character, read one EDN element from the
-    file object."""
-    while is_whitespace(ch):
-        ch = b.read(1)
+            raise NotImplementedError(s, m.start(kind), m.group(kind))
 
-    if ch.isdigit():
-        return read_number(b, ch)
-    elif is_macro(ch):
-        return read_macro(b, ch)
-    else:
-        return interpret_token(read_token(b, ch))
+        while True:
+            if xs is None:
+                return x
+            elif delimiter in CLOSING_DELIMITERS or (delimiter == "^" and not xs):
+                xs.append(x)
+                break
+            elif delimiter == "#_":
+                delimiter, xs = stack.pop()
+                break
+            else:
+                # Python values can't carry metadata, so drop it.
+                if delimiter != "^":
+                    x = read_tagged(delimiter[1:], x)
 
+                delimiter, xs = stack.pop()
 
-def read(s):
-    """Read one EDN element from a string."""
-    with io.StringIO(s) as s:
-        return read1(s, s.read(1))
+    if xs is not None:
+        raise EOFError(s, len(s), delimiter)
 
 
 def read_line(b):
@@ -291,110 +479,291 @@ def read_line(b):
         return read(line)
 
 
-# Write
+# Decode
+
+
+# A quote, or a backslash and the character it escapes: inside a string, an
+# escape sequence; outside a string, a character literal.
+QUOTE_OR_ESCAPE = re.compile(rb'\\.|"', re.DOTALL)
+
+
+def ends_in_string(b, start, end, in_string=False):
+    """Given a bytes-like object of UTF-8 encoded EDN, a start and an end
+    position, and whether the start position is inside a string, return True
+    if the end position is inside a string."""
+    for m in QUOTE_OR_ESCAPE.finditer(b, start, end):
+        if m.end() - m.start() == 1:
+            in_string = not in_string
 
+    return in_string
 
-def write_nil(b, _):
-    b.write("nil")
 
+class LineDecoder(object):
+    """An incremental EDN decoder for streams with one element per line, like
+    the responses of a prepl or a newline-framed backchannel.
 
-def write_bool(b, x):
-    b.write("true" if x else "false")
+    Feed the decoder chunks of UTF-8 encoded bytes as they arrive from a socket
+    and iterate over the decoder to get every element that the chunks fed so
+    far complete.
 
+    If a line ends inside a string (a string with a literal newline in it),
+    the element continues on the next line. If a line isn't valid EDN, the
+    decoder drops the line, calls on_error with the line and the error, and
+    carries on with the next line."""
 
-def write_int(b, x):
-    b.write(str(x))
+    def __init__(self, on_error=None):
+        self.buffer = bytearray()
+        # The position in the buffer to look for the next newline from.
+        self.position = 0
+        # True if the element the buffer starts with continues a string past
+        # the end of a line.
+        self.in_string = False
+        self.on_error = on_error
 
+    def feed(self, data):
+        """Given a bytes-like object, add it to the end of the decoder's
+        buffer."""
+        self.buffer.extend(data)
 
-def write_str(b, x):
-    b.write("\"")
-    # FIXME: Quick 'n' dirty. What if there's more backslashes? Regular
-    # expressions or loop over string
-    b.write(x.replace('\\', '\\\\').replace('"', '\\"'))
-    b.write("\"")
+    def readline(self):
+        """Remove a single line from the start of the decoder's buffer and
+        return it as a string, or return None if the buffer doesn't hold a
+        complete line.
 
+        Only use this method to read non-EDN lines before reading any EDN
+        elements from the decoder."""
+        if (index := self.buffer.find(b"\n")) != -1:
+            line = self.buffer[:index + 1].decode("utf-8")
+            del self.buffer[:index + 1]
+            return line
 
-def write_keyword(b, x):
-    b.write(":")
+    def __iter__(self):
+        b = self.buffer
+        # The position in the buffer where the current element starts.
+        start = 0
 
-    if x.namespace:
-        b.write(x.namespace + "/")
+        try:
+            while (index := b.find(b"\n", self.position)) != -1:
+                end = index + 1
 
-    b.write(x.name)
+                if self.in_string:
+                    # Only scan the new line, so that an element with many
+                    # lines takes time proportional to its length.
+                    self.in_string = ends_in_string(b, self.position, end, True)
+                    self.position = end
 
+                    if self.in_string:
+                        continue
 
-def write_symbol(b, x):
-    if x.namespace:
-        b.write(x.namespace + "/")
+                self.position = end
+                line = b[start:end].decode("utf-8")
 
-    b.write(x.name)
+                try:
+                    element = read(line)
+                except EOFError as error:
+                    if ends_in_string(b, start, end):
+                        # The element continues on the next line.
+                        self.in_string = True
+                        continue
 
+                    self.error(line, error)
+                    start = end
+                    continue
+                except Exception as error:
+                    self.error(line, error)
+                    start = end
+                    continue
 
-def write_list(b, xs):
-    b.write("[")
+                start = end
 
-    if xs:
-        for x in xs[:-1]:
-            write1(b, x)
-            b.write(", ")
+                if element is not None or line.strip():
+                    yield element
+        finally:
+            # Remove every line read so far from the buffer at once.
+            del b[:start]
+            self.position -= start
+
+    def error(self, line, error):
+        if self.on_error is not None:
+            self.on_error(line, error)
 
-        write1(b, xs[-1])
 
-    b.write("]")
+# Write
 
 
-def write_set(b, xs):
-    b.write("#{")
+STRING_ESCAPE = re.compile(r'[\x00-\x1f"\\]')
 
-    for x in xs:
-        write1(b, x)
-        b.write(",")
-
-    b.write("}")
-
-
-def write_dict(b, d):
-    b.write("{")
-
-    xs = list(d.items())
-
-    for k, v in xs[:-1]:
-        write1(b, k)
-        b.write(" ")
-        write1(b, v)
-        b.write(" ")
-
-    write1(b, xs[-1][0])
-    b.write(" ")
-    write1(b, xs[-1][1])
-
-    b.write("}")
-
-
-def write1(b, x):
-    if x is None:
-        write_nil(b, x)
-    elif isinstance(x, bool):
-        write_bool(b, x)
-    elif isinstance(x, int):
-        write_int(b, x)
-    elif isinstance(x, str):
-        write_str(b, x)
-    elif isinstance(x, Keyword):
-        write_keyword(b, x)
-    elif isinstance(x, Symbol):
-        write_symbol(b, x)
-    elif isinstance(x, set):
-        write_set(b, x)
-    elif isinstance(x, list):
-        write_list(b, x)
-    elif isinstance(x, dict):
-        write_dict(b, x)
+STRING_ESCAPES = {chr(n): f"\\u{n:04x}" for n in range(0x20)}
+
+STRING_ESCAPES.update({
+    '"': '\\"',
+    "\\": "\\\\",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+    "\b": "\\b",
+    "\f": "\\f",
+})
+
+
+def escape_match(m):
+    return STRING_ESCAPES[m.group()]
+
+
+def write_nil(parts, _):
+    parts.append("nil")
+
+
+def write_bool(parts, x):
+    parts.append("true" if x else "false")
+
+
+def write_int(parts, x):
+    parts.append(str(x))
+
+
+def write_float(parts, x):
+    if math.isnan(x):
+        parts.append("##NaN")
+    elif math.isinf(x):
+        parts.append("##Inf" if x > 0 else "##-Inf")
     else:
+        parts.append(repr(x))
+
+
+def write_decimal(parts, x):
+    if not x.is_finite():
         raise ValueError(f"""Can't write {x} as EDN""")
 
+    parts.append(f"{x}M")
+
+
+def write_fraction(parts, x):
+    if x.denominator == 1:
+        parts.append(str(x.numerator))
+    else:
+        parts.append(f"{x.numerator}/{x.denominator}")
+
+
+def write_datetime(parts, x):
+    if x.tzinfo is None:
+        x = x.replace(tzinfo=datetime.timezone.utc)
+
+    parts.append(f'#inst "{x.isoformat()}"')
+
+
+def write_uuid(parts, x):
+    parts.append(f'#uuid "{x}"')
+
+
+def write_tagged_literal(parts, x):
+    parts.append(f"#{x.tag} ")
+    WRITERS.get(type(x.form), write_other)(parts, x.form)
+
+
+def write_str(parts, x):
+    if STRING_ESCAPE.search(x):
+        x = STRING_ESCAPE.sub(escape_match, x)
+
+    parts.append(f'"{x}"')
+
+
+def write_keyword(parts, x):
+    if x.namespace:
+        parts.append(f":{x.namespace}/{x.name}")
+    else:
+        parts.append(f":{x.name}")
+
+
+def write_symbol(parts, x):
+    if x.namespace:
+        parts.append(f"{x.namespace}/{x.name}")
+    else:
+        parts.append(x.name)
+
+
+def write_elements(parts, xs):
+    separator = False
+
+    for x in xs:
+        if separator:
+            parts.append(" ")
+        else:
+            separator = True
+
+        WRITERS.get(type(x), write_other)(parts, x)
+
+
+def write_list(parts, xs):
+    parts.append("[")
+    write_elements(parts, xs)
+    parts.append("]")
+
+
+def write_set(parts, xs):
+    parts.append("#{")
+    write_elements(parts, xs)
+    parts.append("}")
+
+
+def write_dict(parts, d):
+    parts.append("{")
+    separator = False
+
+    for k, v in d.items():
+        if separator:
+            parts.append(" ")
+        else:
+            separator = True
+
+        WRITERS.get(type(k), write_other)(parts, k)
+        parts.append(" ")
+        WRITERS.get(type(v), write_other)(parts, v)
+
+    parts.append("}")
+
+
+WRITERS = {
+    type(None): write_nil,
+    bool: write_bool,
+    int: write_int,
+    float: write_float,
+    Decimal: write_decimal,
+    Fraction: write_fraction,
+    str: write_str,
+    Keyword: write_keyword,
+    Symbol: write_symbol,
+    list: write_list,
+    tuple: write_list,
+    set: write_set,
+    frozenset: write_set,
+    dict: write_dict,
+    datetime.datetime: write_datetime,
+    uuid.UUID: write_uuid,
+    TaggedLiteral: write_tagged_literal,
+}
+
+
+def write_other(parts, x):
+    """Write a value whose exact type has no entry in WRITERS.
+
+    Looks up the nearest base class that does, and remembers the result for
+    the value's type."""
+    for base in type(x).__mro__[1:]:
+        if writer := WRITERS.get(base):
+            WRITERS[type(x)] = writer
+            return writer(parts, x)
+
+    raise ValueError(f"""Can't write {x} as EDN""")
+
+
+def dumps(x):
+    """Given a Python value, return its EDN representation as a string."""
+    parts = []
+    WRITERS.get(type(x), write_other)(parts, x)
+    return "".join(parts)
+
 
 def write(b, x):
-    write1(b, x)
-    b.write("\n")
+    b.write(dumps(x) + "\n")
     b.flush()
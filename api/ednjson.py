@@ -0,0 +1,141 @@
+"""Carry EDN values over JSON.
+
+The backchannel can send JSON instead of EDN, so that the Python plugin host
+can parse messages with the C-accelerated json module instead of the EDN
+reader written in Python.
+
+JSON has no keywords, symbols, or sets, so this module tags them:
+
+- A keyword value is an object with the single key "~:", and the keyword
+  without the leading colon as the value: {"~:": "ns/name"}.
+- A symbol value is an object with the single key "~$": {"~$": "ns/name"}.
+- A set is an object with the single key "~#set" and an array of the
+  elements of the set as the value.
+- Any other value JSON can't represent is an object with the single key
+  "~#edn" and the value as an EDN string as the value.
+- Object keys are strings. A keyword key is prefixed with "~:", a symbol key
+  with "~$", and any other key that isn't a string is prefixed with "~#" and
+  written as EDN. A string key that starts with "~" gets another "~" in
+  front of it.
+
+String values are never tagged, so reading them costs nothing extra.
+
+The Clojure side of this module is tutkain.json."""
+
+from functools import lru_cache
+import json
+import math
+
+from . import edn
+
+
+# Read
+
+
+def named(cls, s):
+    """Given Keyword or Symbol and a string like "ns/name" or "name", return
+    the keyword or symbol of the same name."""
+    namespace, slash, name = s.partition("/")
+
+    if slash and namespace and name:
+        return cls(name, namespace)
+    else:
+        return cls(s)
+
+
+def keyword(s):
+    return named(edn.Keyword, s)
+
+
+def symbol(s):
+    return named(edn.Symbol, s)
+
+
+@lru_cache(maxsize=4096)
+def read_key(k):
+    """Given a JSON object key, return the EDN map key it represents."""
+    if k[:1] != "~":
+        return k
+
+    tag = k[:2]
+
+    if tag == "~:":
+        return keyword(k[2:])
+    elif tag == "~$":
+        return symbol(k[2:])
+    elif tag == "~#":
+        return edn.read(k[2:])
+    elif tag == "~~":
+        return k[1:]
+    else:
+        return k
+
+
+TAGS = {
+    "~:": keyword,
+    "~$": symbol,
+    "~#set": set,
+    "~#edn": edn.read,
+}
+
+
+def read_object(pairs):
+    """Given the key-value pairs of a JSON object, return the EDN value the
+    object represents."""
+    if len(pairs) == 1 and (tag := TAGS.get(pairs[0][0])):
+        return tag(pairs[0][1])
+    else:
+        return {read_key(k): v for k, v in pairs}
+
+
+def loads(s):
+    """Given a JSON string (or UTF-8 encoded bytes), return the EDN value it
+    represents."""
+    return json.loads(s, object_pairs_hook=read_object)
+
+
+# Write
+
+
+def write_named(x):
+    if x.namespace:
+        return f"{x.namespace}/{x.name}"
+    else:
+        return x.name
+
+
+def write_key(k):
+    """Given an EDN map key, return the JSON object key that represents it."""
+    if isinstance(k, str):
+        return "~" + k if k[:1] == "~" else k
+    elif isinstance(k, edn.Keyword):
+        return "~:" + write_named(k)
+    elif isinstance(k, edn.Symbol):
+        return "~$" + write_named(k)
+    else:
+        return "~#" + edn.dumps(k)
+
+
+def to_json(x):
+    """Given an EDN value, return a value the json module can serialize."""
+    if x is None or isinstance(x, (str, bool, int)):
+        return x
+    elif isinstance(x, dict):
+        return {write_key(k): to_json(v) for k, v in x.items()}
+    elif isinstance(x, (list, tuple)):
+        return [to_json(v) for v in x]
+    elif isinstance(x, edn.Keyword):
+        return {"~:": write_named(x)}
+    elif isinstance(x, edn.Symbol):
+        return {"~$": write_named(x)}
+    elif isinstance(x, (set, frozenset)):
+        return {"~#set": [to_json(v) for v in x]}
+    elif isinstance(x, float) and math.isfinite(x):
+        return x
+    else:
+        return {"~#edn": edn.dumps(x)}
+
+
+def dumps(x):
+    """Given an EDN value, return its representation as a JSON string."""
+    return json.dumps(to_json(x), ensure_ascii=False, separators=(",", ":"))
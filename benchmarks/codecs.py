@@ -0,0 +1,58 @@
+"""Compare the EDN and the JSON encodings of backchannel messages on
+completion responses with 10,000 candidates each.
+
+Run from the root of the repository:
+
+    python -m benchmarks.codecs"""
+
+import random
+import time
+
+from api import edn, ednjson
+from benchmarks import corpus
+
+
+def measure(f, xs, rounds=3):
+    """Given a function of one argument and a list of arguments, return the
+    best time it takes to call the function with every argument in the
+    list."""
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for x in xs:
+            f(x)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    rng = random.Random(0)
+    edn_messages = [corpus.completions_response(rng, i, 10000) for i in range(5)]
+    values = list(map(edn.read, edn_messages))
+    json_messages = list(map(ednjson.dumps, values))
+
+    for value, message in zip(values, json_messages):
+        assert ednjson.loads(message) == value
+
+    n = len(values)
+
+    print(f"{'codec':<6} {'KB/message':>12} {'decode ms':>10} {'encode ms':>10}")
+
+    for name, messages, loads, dumps in [
+        ("edn", edn_messages, edn.read, edn.dumps),
+        ("json", json_messages, ednjson.loads, ednjson.dumps),
+    ]:
+        size = sum(len(message.encode("utf-8")) for message in messages) / n / 1e3
+        decode = measure(loads, messages) / n * 1e3
+        encode = measure(dumps, values) / n * 1e3
+
+        print(f"{name:<6} {size:>12.1f} {decode:>10.2f} {encode:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
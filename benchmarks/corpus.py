@@ -0,0 +1,100 @@
+"""Realistic EDN messages for benchmarking the EDN codec.
+
+Every message is a line of EDN like the ones the Clojure side of Tutkain sends
+over the socket REPL and the backchannel."""
+
+import random
+
+
+def pr_str(s):
+    """Given a string, return it as an EDN string literal, escaped the same way
+    clojure.core/pr-str escapes it."""
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\t", "\\t") + '"'
+
+
+def words(rng, n):
+    return [rng.choice(["foo", "bar", "baz", "quux", "spam", "eggs", "ham"]) + str(i) for i in range(n)]
+
+
+def pprinted_map(rng, entries):
+    """Given a random number generator and a number of entries, return a string
+    that looks like the output of clojure.pprint/pprint for a map with that
+    many entries."""
+    lines = []
+
+    for i, word in enumerate(words(rng, entries)):
+        value = rng.choice([
+            str(rng.randint(0, 1 << 32)),
+            f'"{word} \\"quoted\\" value"',
+            f"[:{word} {i} {i + 1}]",
+            f"{{:id {i}, :name \"{word}\"}}",
+        ])
+
+        lines.append(f":{word} {value}")
+
+    return "{" + ",\n ".join(lines) + "}\n"
+
+
+def eval_response(val, form="(big-map)"):
+    """Given a pretty-printed evaluation result, return a prepl :ret message."""
+    return f"""{{:tag :ret, :val {pr_str(val)}, :ns "user", :ms 12, :form {pr_str(form)}}}\n"""
+
+
+def out_message(text):
+    return f"""{{:tag :out, :val {pr_str(text)}}}\n"""
+
+
+def completions_response(rng, id, n):
+    candidates = []
+
+    for word in sorted(words(rng, n)):
+        doc = pr_str(f"Returns {word}.\n  Does things.")
+
+        candidates.append(
+            f"""{{:candidate "{word}", :type :function, :arglists ("[x]" "[x y & more]"), """
+            f""":doc {doc}}}"""
+        )
+
+    return f"""{{:completions ({" ".join(candidates)}), :id {id}}}\n"""
+
+
+def lookup_response(id):
+    doc = "Returns a lazy sequence consisting of the result of applying f to\n  the set of first items of each coll."
+
+    return (
+        f"""{{:info {{:arglists ("[f]" "[f coll]" "[f c1 c2]"), :doc {pr_str(doc)}, """
+        f""":file "jar:file:/clojure-1.10.3.jar!/clojure/core.clj", :line 2727, :column 1, """
+        f""":name map, :ns "clojure.core"}}, :id {id}}}\n"""
+    )
+
+
+def test_response(rng, id, failures):
+    fails = []
+
+    for i in range(failures):
+        expected = pprinted_map(rng, 20)
+        actual = pprinted_map(rng, 20)
+
+        fails.append(
+            f"""{{:type :fail, :line {10 + i}, :expected {pr_str(expected)}, :actual {pr_str(actual)}, """
+            f""":var-meta {{:line {8 + i}, :column 1, :name test-{i}, :ns "my.app-test"}}}}"""
+        )
+
+    return (
+        f"""{{:fail [{" ".join(fails)}], :pass [{{:type :pass, :line 5, :var-meta {{:name test-ok}}}}], """
+        f""":error [], :tag :ret, :val "{{:test 1, :pass 1, :fail {failures}, :error 0, :type :summary}}\\n", :id {id}}}\n"""
+    )
+
+
+def messages(seed=0):
+    """Return a dict of corpus name to a list of EDN messages."""
+    rng = random.Random(seed)
+
+    return {
+        "small-eval": [eval_response(str(i) + "\n", f"(inc {i})") for i in range(2000)],
+        "out": [out_message(f"Line {i} of output\n") for i in range(2000)],
+        "completions": [completions_response(rng, i, 200) for i in range(20)],
+        "lookup": [lookup_response(i) for i in range(500)],
+        "test-results": [test_response(rng, i, 10) for i in range(10)],
+        "large-eval": [eval_response(pprinted_map(rng, 50000))],
+    }
@@ -0,0 +1,85 @@
+"""Compare reading EDN messages from a socket with edn.LineDecoder against
+reading them line by line from a text-mode file object with edn.read_line.
+
+Run from the root of the repository:
+
+    python -m benchmarks.decoder"""
+
+import socket
+import time
+from threading import Thread
+
+from api import edn
+from benchmarks import corpus
+
+
+def send_all(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def read_lines(sock):
+    buffer = sock.makefile(mode="r")
+    count = 0
+
+    while edn.read_line(buffer) is not None:
+        count += 1
+
+    return count
+
+
+def decode(sock):
+    decoder = edn.LineDecoder()
+    count = 0
+
+    while chunk := sock.recv(65536):
+        decoder.feed(chunk)
+
+        for _ in decoder:
+            count += 1
+
+    return count
+
+
+def measure(reader, data):
+    """Given a function that reads EDN messages from a socket and the bytes to
+    send over the socket, return the number of messages the function read and
+    the time it took."""
+    a, b = socket.socketpair()
+    writer = Thread(daemon=True, target=send_all, args=(a, data))
+
+    try:
+        start = time.perf_counter()
+        writer.start()
+        count = reader(b)
+        elapsed = time.perf_counter() - start
+    finally:
+        writer.join()
+        a.close()
+        b.close()
+
+    return count, elapsed
+
+
+def main():
+    print(
+        f"{'corpus':<14} {'MB':>8} {'messages':>10} {'read_line MB/s':>16} "
+        f"{'LineDecoder MB/s':>18} {'speedup':>8}"
+    )
+
+    for name, messages in corpus.messages().items():
+        data = "".join(messages).encode("utf-8")
+        mb = len(data) / 1e6
+
+        lines, line_time = measure(read_lines, data)
+        decoded, decode_time = measure(decode, data)
+        assert lines == decoded == len(messages)
+
+        print(
+            f"{name:<14} {mb:>8.2f} {len(messages):>10} "
+            f"{mb / line_time:>16.2f} {mb / decode_time:>18.2f} {line_time / decode_time:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Property-based fuzzing for the EDN codec in api/edn.py.
+
+Generates random EDN values and checks that:
+
+- reading what edn.dumps writes returns an equal value
+- edn.LineDecoder returns the same values when fed the written messages in
+  random chunks
+- the EDN over JSON codec in api/ednjson.py round-trips the value
+
+It also mutates the written messages at random and checks that reading them
+either succeeds or fails with one of the exceptions the reader documents.
+
+Runs with plain CPython; it doesn't need Sublime Text. Run from the root of
+the repository:
+
+    python -m benchmarks.fuzz [--iterations N] [--seed N] [--output FILE]
+
+Writes a JSON report to stdout, or to the given file, and exits with a
+non-zero status if any check fails."""
+
+import argparse
+import datetime
+import json
+import random
+import string
+import sys
+import uuid
+
+from decimal import Decimal
+from fractions import Fraction
+
+from api import edn, ednjson
+
+
+# The exceptions edn.read may raise on malformed input.
+READ_ERRORS = (ValueError, EOFError, NotImplementedError)
+
+NAME_START = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ*!_?<>="
+NAME_REST = NAME_START + "0123456789-+.'"
+
+STRING_CHARACTERS = (
+    ["a", "b", "z", " ", "0", "9", ":", "#", "{", "}", "(", "]", ";", "/", "~"]
+    + ['"', "\\", "\n", "\r", "\t", "\b", "\f", "\x00", "\x1f", "\x7f"]
+    + ["ä", "€", " ", "\U0001f600"]
+)
+
+
+def gen_name(rng):
+    name = rng.choice(NAME_START) + "".join(rng.choice(NAME_REST) for _ in range(rng.randint(0, 8)))
+    return "x" + name if name in ("nil", "true", "false") else name
+
+
+def gen_named(rng, cls):
+    if rng.random() < 0.3:
+        return cls(gen_name(rng), ".".join(gen_name(rng) for _ in range(rng.randint(1, 3))))
+    else:
+        return cls(gen_name(rng))
+
+
+def gen_string(rng):
+    return "".join(rng.choice(STRING_CHARACTERS) for _ in range(rng.randint(0, 20)))
+
+
+def gen_scalar(rng):
+    kind = rng.randrange(12)
+
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return rng.random() < 0.5
+    elif kind == 2:
+        return rng.randint(-(1 << 70), 1 << 70)
+    elif kind == 3:
+        return rng.choice([rng.uniform(-1e6, 1e6), rng.uniform(-1, 1) * 10 ** rng.randint(-300, 300), float("inf")])
+    elif kind == 4:
+        return Decimal(f"{rng.randint(-10**6, 10**6)}.{rng.randint(0, 999)}")
+    elif kind == 5:
+        return Fraction(rng.randint(-1000, 1000), rng.randint(2, 1000))
+    elif kind == 6:
+        return datetime.datetime(
+            rng.randint(1, 9999), rng.randint(1, 12), rng.randint(1, 28),
+            rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999999),
+            datetime.timezone.utc
+        )
+    elif kind == 7:
+        return uuid.UUID(int=rng.getrandbits(128))
+    elif kind == 8:
+        return gen_named(rng, edn.Keyword)
+    elif kind == 9:
+        return gen_named(rng, edn.Symbol)
+    else:
+        return gen_string(rng)
+
+
+def gen_value(rng, depth=0):
+    """Given a random number generator, return a random EDN value."""
+    kind = rng.randrange(10) if depth < 4 else 0
+
+    if kind < 5:
+        return gen_scalar(rng)
+    elif kind < 7:
+        return [gen_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+    elif kind == 7:
+        return {gen_scalar(rng) for _ in range(rng.randint(0, 5))}
+    elif kind == 8:
+        return {gen_scalar(rng): gen_value(rng, depth + 1) for _ in range(rng.randint(0, 5))}
+    else:
+        # A tag must start with a letter.
+        tag = rng.choice(string.ascii_letters) + gen_name(rng) + "/" + gen_name(rng)
+        return edn.TaggedLiteral(tag, gen_value(rng, depth + 1))
+
+
+def mutate(rng, s):
+    """Given a random number generator and a string, return a copy of the
+    string with a few random characters removed, replaced, or inserted."""
+    s = list(s)
+
+    for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(len(s) + 1)
+        kind = rng.randrange(3)
+
+        if kind == 0 and i < len(s):
+            del s[i]
+        elif kind == 1 and i < len(s):
+            s[i] = rng.choice(STRING_CHARACTERS)
+        else:
+            s.insert(i, rng.choice(STRING_CHARACTERS))
+
+    return "".join(s)
+
+
+def check(iteration, rng, failures):
+    x = gen_value(rng)
+    message = edn.dumps(x)
+
+    def fail(check, detail):
+        failures.append({"iteration": iteration, "check": check, "message": message, "detail": detail})
+
+    try:
+        if (y := edn.read(message)) != x:
+            fail("roundtrip", repr(y))
+
+        if (y := ednjson.loads(ednjson.dumps(x))) != x:
+            fail("json", repr(y))
+    except Exception as error:
+        fail("exception", repr(error))
+        return
+
+    # Feed the message, followed by another message, to a decoder in random
+    # chunks.
+    data = (message + "\n:next\n").encode("utf-8")
+    decoder = edn.LineDecoder()
+    values = []
+    i = 0
+
+    while i < len(data):
+        n = rng.randint(1, 16)
+        decoder.feed(data[i:i + n])
+        values.extend(decoder)
+        i += n
+
+    if values != [x, edn.Keyword("next")]:
+        fail("decoder", repr(values))
+
+    mutated = mutate(rng, message)
+
+    try:
+        edn.read(mutated)
+    except READ_ERRORS:
+        pass
+    except Exception as error:
+        failures.append({"iteration": iteration, "check": "mutation", "message": mutated, "detail": repr(error)})
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Fuzz the EDN codec.")
+    parser.add_argument("--iterations", type=int, default=2000, help="the number of random values to check")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the random number generator")
+    parser.add_argument("--output", help="the file to write the JSON report to (default: stdout)")
+    args = parser.parse_args(args)
+
+    rng = random.Random(args.seed)
+    failures = []
+
+    for iteration in range(args.iterations):
+        check(iteration, rng, failures)
+
+    report = {"seed": args.seed, "iterations": args.iterations, "failures": failures}
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
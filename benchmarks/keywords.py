@@ -0,0 +1,120 @@
+"""Measure the per-message cost of looking up protocol keys in responses,
+comparing the interned edn.Keyword constants against constructing frozen
+dataclass keywords for every lookup, as the client and printer used to do.
+
+Run from the root of the repository:
+
+    python -m benchmarks.keywords"""
+
+from dataclasses import dataclass
+import time
+
+from api import edn
+from benchmarks import corpus
+
+
+@dataclass(eq=True, frozen=True)
+class DataclassKeyword:
+    name: str
+    namespace: str = ""
+
+
+def to_dataclass_keywords(x):
+    """Given an EDN value, return a copy of the value where every keyword is
+    a DataclassKeyword."""
+    if isinstance(x, edn.Keyword):
+        return DataclassKeyword(x.name, x.namespace)
+    elif isinstance(x, dict):
+        return {to_dataclass_keywords(k): to_dataclass_keywords(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [to_dataclass_keywords(v) for v in x]
+    else:
+        return x
+
+
+def handle_dataclass(response):
+    tag = response.get(DataclassKeyword("tag"))
+
+    if tag == DataclassKeyword("tap"):
+        return response.get(DataclassKeyword("val"))
+    elif tag == DataclassKeyword("err"):
+        return response.get(DataclassKeyword("val"))
+    elif tag == DataclassKeyword("out"):
+        return response.get(DataclassKeyword("val"))
+    elif form := response.get(DataclassKeyword("form")):
+        return form
+    elif response.get(DataclassKeyword("exception")):
+        return response.get(DataclassKeyword("id"))
+    else:
+        return response.get(DataclassKeyword("val"))
+
+
+TAG = edn.Keyword("tag")
+TAP = edn.Keyword("tap")
+ERR = edn.Keyword("err")
+OUT = edn.Keyword("out")
+VAL = edn.Keyword("val")
+FORM = edn.Keyword("form")
+EXCEPTION = edn.Keyword("exception")
+ID = edn.Keyword("id")
+
+
+def handle_interned(response):
+    tag = response.get(TAG)
+
+    if tag == TAP:
+        return response.get(VAL)
+    elif tag == ERR:
+        return response.get(VAL)
+    elif tag == OUT:
+        return response.get(VAL)
+    elif form := response.get(FORM):
+        return form
+    elif response.get(EXCEPTION):
+        return response.get(ID)
+    else:
+        return response.get(VAL)
+
+
+def measure(handle, responses, rounds=5):
+    """Given a response handler and a list of responses, return the best time
+    it takes to handle every response in the list."""
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for response in responses:
+            handle(response)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    responses = [
+        edn.read(message)
+        for messages in corpus.messages().values()
+        for message in messages
+    ]
+
+    responses = [response for response in responses if isinstance(response, dict)]
+    dataclass_responses = list(map(to_dataclass_keywords, responses))
+
+    for response, dataclass_response in zip(responses, dataclass_responses):
+        assert to_dataclass_keywords(handle_interned(response)) == handle_dataclass(dataclass_response)
+
+    old = measure(handle_dataclass, dataclass_responses)
+    new = measure(handle_interned, responses)
+    n = len(responses)
+
+    print(f"{'keywords':<12} {'µs/message':>12}")
+    print(f"{'dataclass':<12} {old / n * 1e6:>12.3f}")
+    print(f"{'interned':<12} {new / n * 1e6:>12.3f}")
+    print(f"{'speedup':<12} {old / new:>11.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Compare the throughput of edn.read with and without the fast path for short
+flat maps (see edn.read_flat_map) on a corpus of prepl and backchannel
+responses.
+
+Run from the root of the repository:
+
+    python -m benchmarks.reader"""
+
+import time
+
+from api import edn
+from benchmarks import corpus
+
+
+def read_general(s):
+    """Read an EDN string without the fast path for short flat maps."""
+    limit = edn.FLAT_MAP_MAX_LENGTH
+    edn.FLAT_MAP_MAX_LENGTH = 0
+
+    try:
+        return edn.read(s)
+    finally:
+        edn.FLAT_MAP_MAX_LENGTH = limit
+
+
+def measure(read, messages, rounds=3):
+    """Given a function that reads an EDN string and a list of EDN strings,
+    return the best time it takes to read every string in the list."""
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for message in messages:
+            read(message)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    print(f"{'corpus':<14} {'MB':>8} {'general MB/s':>12} {'read MB/s':>12} {'speedup':>8}")
+
+    total_old = total_new = 0
+
+    for name, messages in corpus.messages().items():
+        for message in messages:
+            assert edn.read(message) == read_general(message)
+
+        mb = sum(map(len, messages)) / 1e6
+        old = measure(read_general, messages)
+        new = measure(edn.read, messages)
+        total_old += old
+        total_new += new
+
+        print(f"{name:<14} {mb:>8.2f} {mb / old:>12.2f} {mb / new:>12.2f} {old / new:>7.2f}x")
+
+    print(f"{'total':<14} {'':>8} {'':>12} {'':>12} {total_old / total_new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Benchmark the EDN codec in api/edn.py on the corpora in benchmarks/corpus.py.
+
+For every corpus, measure the throughput and the peak memory allocated by:
+
+- edn.read, one message at a time
+- edn.read_line, reading every message from a file object
+- edn.dumps, writing the values the messages represent
+
+Runs with plain CPython; it doesn't need Sublime Text. Run from the root of
+the repository:
+
+    python -m benchmarks.suite [--rounds N] [--corpus NAME ...] [--output FILE]
+
+Prints a table to stderr and writes the results as JSON to stdout, or to the
+given file, so that they can be stored and compared between runs:
+
+    {"meta": {...}, "results": [{"corpus": ..., "operation": ..., ...}]}"""
+
+import argparse
+import datetime
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from api import edn
+from benchmarks import corpus
+
+
+def best_time(f, rounds):
+    """Given a function of no arguments and a number of rounds, return the
+    shortest time it takes to call the function in that many rounds."""
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def peak_memory(f):
+    """Given a function of no arguments, return the peak number of bytes it
+    allocates while it runs."""
+    tracemalloc.start()
+
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+        return peak
+    finally:
+        tracemalloc.stop()
+
+
+def operations(messages):
+    """Given a list of EDN messages, return a dict of operation name to a
+    function of no arguments that runs the operation on every message."""
+    values = [edn.read(message) for message in messages]
+    text = "".join(messages)
+
+    def read():
+        for message in messages:
+            edn.read(message)
+
+    def read_line():
+        with io.StringIO(text) as b:
+            while edn.read_line(b) is not None:
+                pass
+
+    def dumps():
+        for value in values:
+            edn.dumps(value)
+
+    return {"read": read, "read_line": read_line, "dumps": dumps}
+
+
+def run(corpora, rounds):
+    results = []
+
+    for name, messages in corpora.items():
+        size = sum(len(message.encode("utf-8")) for message in messages)
+
+        for operation, f in operations(messages).items():
+            elapsed = best_time(f, rounds)
+
+            results.append({
+                "corpus": name,
+                "operation": operation,
+                "messages": len(messages),
+                "bytes": size,
+                "seconds": elapsed,
+                "mb_per_second": size / elapsed / 1e6,
+                "us_per_message": elapsed / len(messages) * 1e6,
+                "peak_bytes": peak_memory(f),
+            })
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def meta(rounds):
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "rounds": rounds,
+    }
+
+
+def print_table(results, file):
+    print(
+        f"{'corpus':<14} {'operation':<10} {'MB/s':>8} {'us/message':>12} {'peak KB':>10}",
+        file=file
+    )
+
+    for result in results:
+        print(
+            f"{result['corpus']:<14} {result['operation']:<10} "
+            f"{result['mb_per_second']:>8.2f} {result['us_per_message']:>12.1f} "
+            f"{result['peak_bytes'] / 1e3:>10.1f}",
+            file=file
+        )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the EDN codec.")
+    parser.add_argument("--rounds", type=int, default=3, help="the number of rounds per measurement")
+    parser.add_argument("--corpus", action="append", help="the name of a corpus to run (default: all)")
+    parser.add_argument("--output", help="the file to write the JSON results to (default: stdout)")
+    args = parser.parse_args(args)
+
+    corpora = corpus.messages()
+
+    if args.corpus:
+        corpora = {name: corpora[name] for name in args.corpus}
+
+    results = run(corpora, args.rounds)
+    print_table(results, sys.stderr)
+    report = {"meta": meta(args.rounds), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 (ns tutkain.backchannel
   (:require
    [clojure.edn :as edn]
-   [tutkain.format :as format])
+   [clojure.java.io :as io]
+   [tutkain.format :as format]
+   [tutkain.json :as json])
   (:import
    (clojure.lang Compiler Compiler$CompilerException LineNumberingPushbackReader)
-   (java.io ByteArrayInputStream InputStreamReader FileNotFoundException)
+   (java.io ByteArrayInputStream ByteArrayOutputStream InputStream InputStreamReader FileNotFoundException)
    (java.lang.reflect Field)
    (java.net InetSocketAddress)
-   (java.nio.channels Channels ServerSocketChannel)
+   (java.nio ByteBuffer)
+   (java.nio.channels ServerSocketChannel SocketChannel)
+   (java.util.concurrent ExecutorService Executors FutureTask ThreadFactory)
    (java.util.concurrent.atomic AtomicInteger)
-   (java.util Base64)))
+   (java.util Base64)
+   (java.util.zip DeflaterOutputStream InflaterInputStream)))
 
 (defn respond-to
   "Respond to a backchannel op message."
@@ -42,18 +47,27 @@
     (InputStreamReader.)
     (LineNumberingPushbackReader.)))
 
+(defonce ^{:doc "An atom with a map of the file name of every module :load-base64 has
+  loaded to the content hash of the module."}
+  module-hashes
+  (atom {}))
+
 (defmethod handle :load-base64
-  [{:keys [blob path filename requires] :as message}]
-  (try
-    (some->> requires (run! require))
-    (with-open [reader (base64-reader blob)]
-      (try
-        (Compiler/load reader path filename)
-        (respond-to message {:filename filename :result :ok})
-        (catch Compiler$CompilerException ex
-          (respond-to message {:filename filename :result :fail :reason :compiler-ex :ex (Throwable->map ex)}))))
-    (catch FileNotFoundException ex
-      (respond-to message {:filename filename :result :fail :reason :not-found :ex (Throwable->map ex)}))))
+  [{:keys [blob path filename requires hash] :as message}]
+  (if (and hash (= hash (get @module-hashes filename)))
+    ;; This version of the module is already loaded; don't recompile it.
+    (respond-to message {:filename filename :result :ok})
+    (try
+      (some->> requires (run! require))
+      (with-open [reader (base64-reader blob)]
+        (try
+          (Compiler/load reader path filename)
+          (when hash (swap! module-hashes assoc filename hash))
+          (respond-to message {:filename filename :result :ok})
+          (catch Compiler$CompilerException ex
+            (respond-to message {:filename filename :result :fail :reason :compiler-ex :ex (Throwable->map ex)}))))
+      (catch FileNotFoundException ex
+        (respond-to message {:filename filename :result :fail :reason :not-found :ex (Throwable->map ex)})))))
 
 (def ^:private eval-ctx
   (atom {:file nil}))
@@ -64,12 +78,24 @@
   (when-let [field (.getDeclaredField LineNumberingPushbackReader "_columnNumber")]
     (-> ^Field field (doto (.setAccessible true)) (.set reader column))))
 
-(defmethod handle :set-eval-context
-  [{:keys [in file line column] :or {line 0 column 0} :as message}]
+(defn set-eval-context!
+  "Given the reader a REPL reads code from and a map with the :file, :line,
+  and :column of the code the REPL reads next, set the line and column number
+  of the reader and the file of the next evaluation.
+
+  Return the new eval context."
+  [in {:keys [file line column] :or {line 0 column 0}}]
   (.setLineNumber in (int line))
   (set-column! in (int column))
-  (let [new-context (swap! eval-ctx assoc :file file)]
-    (respond-to message new-context)))
+  (swap! eval-ctx assoc :file file))
+
+;; Deprecated: Tutkain sends the eval context to the REPL in a
+;; {:tutkain/eval-context ...} directive with the code it evaluates (see
+;; tutkain.repl). Kept for clients that still send this op; to be removed in
+;; the next release.
+(defmethod handle :set-eval-context
+  [{:keys [in] :as message}]
+  (respond-to message (set-eval-context! in message)))
 
 (defmethod handle :interrupt
   [{:keys [repl-thread]}]
@@ -83,6 +109,279 @@
 (def ^:private thread-counter
   (AtomicInteger.))
 
+;; Dispatch
+;;
+;; The backchannel reads messages on a single thread, but doesn't necessarily
+;; handle them on that thread. Every op belongs to a lane:
+;;
+;;   :sync         Handled on the thread that reads messages, before reading
+;;                 the next message. For quick ops, and for ops that later
+;;                 messages depend on (for example, loading the module that
+;;                 implements the next op).
+;;   :interactive  Handled on a pool of threads reserved for ops the editor
+;;                 waits on while the user types (auto-completion, lookup,
+;;                 and so on).
+;;   :heavy        Handled one at a time, in the order they arrive, on a
+;;                 thread of its own. For ops that can take a long time, like
+;;                 running tests or loading a file.
+;;
+;; A slow :heavy op therefore never holds up an :interactive op. Responses
+;; carry the :id of the message, so they can arrive in any order.
+;;
+;; The client can cancel ops it no longer needs the response to (for
+;; example, auto-completions for a prefix the user has already typed past)
+;; with a :cancel message that has the :ids of the ops. If an op hasn't
+;; started yet, the backchannel skips it.
+
+(def lanes
+  "A map of ops to the lane the backchannel handles them on. Ops that aren't
+  in the map are :heavy."
+  {:cancel :sync
+   :echo :sync
+   :interrupt :sync
+   :load-base64 :sync
+   :set-eval-context :sync
+   :completions :interactive
+   :expand :interactive
+   :locals :interactive
+   :lookup :interactive})
+
+(def ^:private interactive-threads
+  (max 2 (min 4 (.availableProcessors (Runtime/getRuntime)))))
+
+(defn- thread-factory
+  ^ThreadFactory [prefix]
+  (let [counter (AtomicInteger.)]
+    (reify ThreadFactory
+      (newThread [_ runnable]
+        (doto (Thread. runnable)
+          (.setName (format "%s-%s" prefix (.incrementAndGet counter)))
+          (.setDaemon true))))))
+
+(defn- handle-message
+  [message]
+  (try
+    (handle message)
+    (catch Throwable ex
+      (respond-to message {:tag :ret
+                           :exception true
+                           :val (format/pp-str (Throwable->map ex))}))))
+
+(defn- dispatch
+  "Given a map of lanes to executors, an atom with a map of message ids to the
+  futures of the messages that haven't completed, and a message, handle the
+  message on its lane."
+  [executors futures {:keys [id op ids] :as message}]
+  (let [lane (get lanes op :heavy)]
+    (cond
+      (= :cancel op)
+      ;; A cancelled op that hasn't started never runs, so it never removes
+      ;; itself from the futures.
+      (let [[pending] (swap-vals! futures #(apply dissoc % ids))]
+        (doseq [id ids]
+          (some-> (get pending id) (.cancel false))))
+
+      (= :sync lane)
+      (handle-message message)
+
+      :else
+      (let [f (bound-fn []
+                (try
+                  (handle-message message)
+                  (finally
+                    (swap! futures dissoc id))))
+            task (FutureTask. ^Callable f)]
+        (when id (swap! futures assoc id task))
+        (.execute ^ExecutorService (executors lane) task)))))
+
+;; Framing and encoding
+;;
+;; By default, the backchannel sends and receives newline-delimited EDN. If
+;; the client asks for it, the backchannel frames every message instead: a
+;; flags byte and the length of the payload as a 32-bit big-endian integer,
+;; followed by the payload (the UTF-8 encoded message).
+;;
+;; With length-prefixed framing, the client can also ask for the backchannel
+;; to encode messages as JSON instead of EDN (see tutkain.json), and to
+;; compress messages of at least :compression-threshold bytes with zlib. If
+;; the payload of a frame is compressed, the lowest bit of the flags byte is
+;; set. Either side may compress any message, so both sides check the flag of
+;; every frame they read.
+
+(def ^:private frame-header-size 5)
+
+(def ^:private compressed-flag 0x01)
+
+(def ^:private default-compression-threshold 1024)
+
+(def framings
+  "The framings the backchannel supports."
+  #{:newline :length-prefixed})
+
+(def encodings
+  "The encodings the backchannel supports."
+  #{:edn :json})
+
+(def compressions
+  "The compressions the backchannel supports."
+  #{:none :zlib})
+
+(defn negotiate
+  "Given backchannel options, return a map of the wire protocol parameters
+  the backchannel uses.
+
+  If the client asks for a :framing, an :encoding, or a :compression the
+  backchannel doesn't support, fall back to :newline, :edn, and :none,
+  respectively. Newline-delimited messages are always uncompressed EDN."
+  [{:keys [framing encoding compression compression-threshold]}]
+  (let [framing (if (contains? framings framing) framing :newline)
+        length-prefixed? (= :length-prefixed framing)]
+    {:framing framing
+     :encoding (if (and length-prefixed? (contains? encodings encoding)) encoding :edn)
+     :compression (if (and length-prefixed? (contains? compressions compression)) compression :none)
+     :compression-threshold (if (nat-int? compression-threshold)
+                              compression-threshold
+                              default-compression-threshold)}))
+
+(defn- read-fully
+  "Read from a socket channel until the buffer is full.
+
+  Return the buffer, flipped for reading, or nil if the channel reaches its
+  end first."
+  [^SocketChannel channel ^ByteBuffer buffer]
+  (loop []
+    (if (.hasRemaining buffer)
+      (when-not (neg? (.read channel buffer))
+        (recur))
+      (.flip buffer))))
+
+(defn- write-fully
+  "Write every byte in a buffer to a socket channel."
+  [^SocketChannel channel ^ByteBuffer buffer]
+  (while (.hasRemaining buffer)
+    (.write channel buffer)))
+
+(defn- channel-input-stream
+  "Return an input stream that reads directly from a socket channel.
+
+  Unlike the streams java.nio.channels.Channels returns, this stream doesn't
+  lock the channel, so a thread blocked reading from it doesn't block other
+  threads writing to the channel."
+  ^InputStream [^SocketChannel channel]
+  (proxy [InputStream] []
+    (read
+      ([]
+       (let [buffer (ByteBuffer/allocate 1)]
+         (if (read-fully channel buffer)
+           (bit-and (.get buffer) 0xff)
+           -1)))
+      ([^bytes bs]
+       (.read channel (ByteBuffer/wrap bs)))
+      ([^bytes bs off len]
+       (if (zero? len)
+         0
+         (.read channel (ByteBuffer/wrap bs off len)))))))
+
+(defn- deflate
+  ^bytes [^bytes bs]
+  (let [out (ByteArrayOutputStream.)]
+    (with-open [deflater (DeflaterOutputStream. out)]
+      (.write deflater bs))
+    (.toByteArray out)))
+
+(defn- inflate
+  ^bytes [^bytes bs]
+  (let [out (ByteArrayOutputStream. (* 4 (alength bs)))]
+    (with-open [inflater (InflaterInputStream. (ByteArrayInputStream. bs))]
+      (io/copy inflater out))
+    (.toByteArray out)))
+
+(defn read-frame
+  "Read a length-prefixed frame from a socket channel.
+
+  Return the payload of the frame as a string, decompressed if the frame
+  says it is compressed, or nil if the channel reaches its end."
+  [channel]
+  (when-some [^ByteBuffer header (read-fully channel (ByteBuffer/allocate frame-header-size))]
+    (let [flags (.get header)
+          length (.getInt header)]
+      (when-some [^ByteBuffer payload (read-fully channel (ByteBuffer/allocate length))]
+        (let [^bytes bs (cond-> (.array payload)
+                          (pos? (bit-and flags compressed-flag)) inflate)]
+          (String. bs "UTF-8"))))))
+
+(defn write-frame
+  "Write a string to a socket channel as a length-prefixed frame.
+
+  Given a compression threshold, compress the payload with zlib if it is at
+  least that many bytes and compressing makes it smaller."
+  ([channel s]
+   (write-frame channel s nil))
+  ([^SocketChannel channel ^String s compression-threshold]
+   (let [payload (.getBytes s "UTF-8")
+         compressed (when (and compression-threshold (>= (alength payload) compression-threshold))
+                      (let [bs (deflate payload)]
+                        (when (< (alength bs) (alength payload)) bs)))
+         ^bytes bs (or compressed payload)
+         buffer (ByteBuffer/allocate (+ frame-header-size (alength bs)))]
+     (.put buffer (byte (if compressed compressed-flag 0)))
+     (.putInt buffer (alength bs))
+     (.put buffer bs)
+     (.flip buffer)
+     (write-fully channel buffer))))
+
+(def ^:private codecs
+  {:edn {:encode pr-str
+         :decode (fn [s eof] (edn/read-string {:eof eof} s))}
+   :json {:encode json/write-str
+          :decode (fn [s eof] (json/read-str s eof))}})
+
+(defn- routing-first
+  "Given a message, return the message with its :id, and its :exception if
+  any, as its first entries, so that the client can tell which request a
+  message responds to without decoding the whole message."
+  [{:keys [id exception] :as message}]
+  (if (some? id)
+    (apply array-map :id id
+      (concat
+        (when (contains? message :exception) [:exception exception])
+        (sequence cat (dissoc message :id :exception))))
+    message))
+
+(defmulti transport
+  "Given a socket channel and the wire protocol parameters negotiate
+  returns, return a map with these keys:
+
+    :read-message   A function that takes an EOF value and reads the next
+                    message from the channel, or returns the EOF value if
+                    there are no more messages.
+    :write-message  A function that takes a message and writes it to the
+                    channel."
+  (fn [_ {:keys [framing]}] framing))
+
+(defmethod transport :newline
+  [socket-channel _]
+  ;; Ops run on executor threads while the connection thread blocks reading
+  ;; the next message, so read and write the socket channel directly: the
+  ;; stream adapters in java.nio.channels.Channels lock the channel, so a
+  ;; thread blocked reading from a stream would block every write.
+  (let [in (LineNumberingPushbackReader. (InputStreamReader. (channel-input-stream socket-channel) "UTF-8"))]
+    {:read-message (fn [eof] (edn/read {:eof eof} in))
+     :write-message (fn [message]
+                      (write-fully socket-channel
+                        (ByteBuffer/wrap (.getBytes (str (pr-str message) "\n") "UTF-8"))))}))
+
+(defmethod transport :length-prefixed
+  [socket-channel {:keys [encoding compression compression-threshold]}]
+  ;; Read and write the socket channel directly (see transport :newline).
+  (let [{:keys [encode decode]} (codecs encoding)
+        compression-threshold (when (= :zlib compression) compression-threshold)]
+    {:read-message (fn [eof]
+                     (if-some [s (read-frame socket-channel)]
+                       (decode s eof)
+                       eof))
+     :write-message #(write-frame socket-channel (encode %) compression-threshold)}))
+
 (defn open
   "Open a backchannel that listens for editor tooling messages on a socket.
 
@@ -96,51 +395,58 @@
   Options:
     :port         The TCP port the backchannel listens on.
     :bind-address The TCP bind address.
+    :framing      The framing the client wants (see framings).
+    :encoding     The encoding the client wants (see encodings).
+    :compression  The compression the client wants (see compressions).
+    :compression-threshold
+                  The size in bytes at which to start compressing messages.
+
+  Use negotiate to find out which wire protocol parameters the backchannel
+  uses.
+
+  The backchannel handles ops concurrently (see lanes).
 
   Other options are subject to change."
   [{:keys [port bind-address xform-in xform-out]
-    :or {port 0 bind-address "localhost" xform-in identity xform-out identity}}]
+    :or {port 0 bind-address "localhost" xform-in identity xform-out identity}
+    :as opts}]
   (let [socket (ServerSocketChannel/open)
         address (InetSocketAddress. ^String bind-address port)
+        negotiated (negotiate opts)
         lock (Object.)]
     (.bind socket address)
-    (let [thread (Thread.
+    (let [n (.incrementAndGet thread-counter)
+          futures (atom {})
+          executors {:interactive (Executors/newFixedThreadPool interactive-threads
+                                    (thread-factory (format "tutkain/backchannel-%s-interactive" n)))
+                     :heavy (Executors/newSingleThreadExecutor
+                              (thread-factory (format "tutkain/backchannel-%s-heavy" n)))}
+          thread (Thread.
                    (bound-fn []
                      (try
                        (let [socket-channel (.accept socket)
-                             in (LineNumberingPushbackReader. (Channels/newReader socket-channel "UTF-8"))
-                             out (Channels/newWriter socket-channel "UTF-8")
+                             {:keys [read-message write-message]} (transport socket-channel negotiated)
                              EOF (Object.)
                              out-fn (fn [message]
                                       (locking lock
-                                        (.write out (pr-str (dissoc (xform-out message) :out-fn)))
-                                        (.write out "\n")
-                                        (.flush out)))]
+                                        (write-message (routing-first (dissoc (xform-out message) :out-fn)))))]
                          (loop []
                            (when (.isOpen socket)
                              (when-some [message (try
-                                                   (edn/read {:eof EOF} in)
+                                                   (read-message EOF)
                                                    ;; If we can't read from the socket, exit the loop.
                                                    (catch java.net.SocketException _)
                                                    ;; If the remote host closes the connection, exit the loop.
                                                    (catch java.io.IOException _))]
                                (when-not (identical? EOF message)
-                                 (let [recur? (case (:op message)
-                                                :quit false
-                                                (let [message (assoc (xform-in message) :out-fn out-fn)]
-                                                  (try
-                                                    (handle message)
-                                                    true
-                                                    (catch Throwable ex
-                                                      (respond-to message {:tag :ret
-                                                                           :exception true
-                                                                           :val (format/pp-str (Throwable->map ex))})
-                                                      true))))]
-                                   (when recur? (recur))))))))
+                                 (when-not (= :quit (:op message))
+                                   (dispatch executors futures (assoc (xform-in message) :out-fn out-fn))
+                                   (recur)))))))
                        (finally
+                         (run! #(.shutdownNow ^ExecutorService %) (vals executors))
                          (.close socket)))))]
       (doto thread
-        (.setName (format "tutkain/backchannel-%s" (.incrementAndGet thread-counter)))
+        (.setName (format "tutkain/backchannel-%s" n))
         (.setDaemon true)
         (.start))
       socket)))
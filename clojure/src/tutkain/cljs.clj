@@ -147,24 +147,28 @@
 
 (defn candidates
   "Given a compiler environment, a string prefix, and an ns symbol, return all
-  applicable auto-completion candidates for the prefix."
-  [env ^String prefix ns]
-  (assert (symbol? ns))
-  (let [candidates (cond
-                     (.startsWith prefix ":") (keyword-candidates env ns)
-                     (completions/scoped? prefix) (scoped-candidates env prefix ns)
-                     (.contains prefix ".") (ns-candidates env)
-                     :else (concat (ns-var-candidates env ns) (core-candidates env) (ns-alias-candidates env ns)))]
-    (sort-by :candidate (filter #(completions/candidate? prefix %) candidates))))
+  applicable auto-completion candidates for the prefix.
+
+  If fuzzy is true, match candidates fuzzily (see tutkain.completions/rank)."
+  ([env prefix ns]
+   (candidates env prefix ns false))
+  ([env ^String prefix ns fuzzy]
+   (assert (symbol? ns))
+   (let [candidates (cond
+                      (.startsWith prefix ":") (keyword-candidates env ns)
+                      (completions/scoped? prefix) (scoped-candidates env prefix ns)
+                      (.contains prefix ".") (ns-candidates env)
+                      :else (concat (ns-var-candidates env ns) (core-candidates env) (ns-alias-candidates env ns)))]
+     (completions/rank prefix candidates fuzzy))))
 
 (defn ^:private parse-ns
   [ns]
   (or (some-> ns symbol) 'cljs.user))
 
 (defmethod completions/completions :cljs
-  [{:keys [ns prefix build-id] :as message}]
-  (let [completions (candidates (compiler-env build-id) prefix (parse-ns ns))]
-    (respond-to message {:completions completions})))
+  [{:keys [ns prefix build-id fuzzy] :as message}]
+  (completions/respond-with-candidates message
+    (candidates (compiler-env build-id) prefix (parse-ns ns) fuzzy)))
 
 (comment
   (candidates (compiler-env :browser) "c" 'cljs.core)
@@ -172,6 +176,7 @@
   (candidates (compiler-env :browser) "string/b" 'cljs.pprint)
   (candidates (compiler-env :browser) "make-hi" 'cljs.core)
   (candidates (compiler-env :browser) ":a" 'cljs.core)
+  (candidates (compiler-env :browser) "mct" 'cljs.core true)
   ,)
 
 (defn special-sym-meta
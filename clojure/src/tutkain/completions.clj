@@ -16,12 +16,16 @@
   [kw]
   {:candidate (str kw) :type :keyword})
 
+(def ^:private keyword-table
+  (delay
+    (let [^Field field (.getDeclaredField clojure.lang.Keyword "table")]
+      (.setAccessible field true)
+      (.get field nil))))
+
 (defn all-keywords
   "Return every interned keyword in the Clojure runtime."
   []
-  (let [^Field field (.getDeclaredField clojure.lang.Keyword "table")]
-    (.setAccessible field true)
-    (map keyword (.keySet ^ConcurrentHashMap (.get field nil)))))
+  (map keyword (.keySet ^ConcurrentHashMap @keyword-table)))
 
 (comment (all-keywords),)
 
@@ -327,35 +331,292 @@
       (take-while candidate?)
       @class-candidate-list)))
 
+;; Indexes
+;;
+;; Walking every keyword, namespace, and var in the runtime on every request
+;; takes time proportional to the size of the runtime. Instead, keep prefix
+;; indexes of keywords, namespaces, and the mappings of every namespace: the
+;; candidate strings in a sorted array, with the items they stand for in
+;; another. Finding the candidates for a prefix is then a binary search for
+;; the first candidate followed by a walk until the first string that doesn't
+;; start with the prefix, so a request takes time proportional to the number
+;; of candidates.
+;;
+;; Every index has a version: the number of interned keywords, the identities
+;; of the namespaces, or the mappings of the namespace. If the version
+;; changes, the index is rebuilt the next time a request needs it.
+;;
+;; Evaluating code often interns a few keywords, and rebuilding the keyword
+;; index means sorting every keyword in the runtime. A request that finds the
+;; keyword index stale therefore gets the stale index, and the index is
+;; rebuilt in the background: new keywords show up in the candidates once the
+;; rebuild finishes.
+
+(defonce ^:private indexes
+  (atom {}))
+
+(defonce ^:private rebuilds
+  ;; A map of the key of every index that is being rebuilt in the background
+  ;; to a delay that holds the future that rebuilds it.
+  (atom {}))
+
+(defn- current?
+  [a b]
+  (or (identical? a b) (and (number? a) (number? b) (== a b))))
+
+(defn- index
+  "Given a function that returns the candidate string of an item and a
+  collection of items, return a prefix index of the items."
+  [key-fn items]
+  (let [entries (sort-by first (map (juxt key-fn identity) items))]
+    {:names (object-array (map first entries))
+     :items (object-array (map second entries))}))
+
+(defn- cached-index
+  "Given the key of an index, the current version of the index, and a function
+  that builds the index, return the index, rebuilding it if it's stale."
+  [k version build]
+  (let [entry (get @indexes k)]
+    (if (and entry (current? (:version entry) version))
+      (:index entry)
+      (let [index (build)]
+        (swap! indexes assoc k {:version version :index index})
+        index))))
+
+(defn- eventual-index
+  "Like cached-index, but if the index is stale, return the stale index and
+  rebuild the index in the background. Only the first request waits for the
+  index to build."
+  [k version build]
+  (let [entry (get @indexes k)]
+    (cond
+      (nil? entry) (cached-index k version build)
+      (current? (:version entry) version) (:index entry)
+      :else
+      (let [rebuild (delay
+                      (future
+                        (try
+                          (swap! indexes assoc k {:version version :index (build)})
+                          (finally
+                            (swap! rebuilds dissoc k)))))
+            [rebuilding] (swap-vals! rebuilds #(cond-> % (not (contains? % k)) (assoc k rebuild)))]
+        (when-not (contains? rebuilding k) (force rebuild))
+        (:index entry)))))
+
+(defn- lower-bound
+  "Given a sorted array of strings and a string, return the index of the first
+  string in the array that isn't less than the string."
+  [^objects names ^String s]
+  (loop [lo 0 hi (alength names)]
+    (if (< lo hi)
+      (let [mid (unsigned-bit-shift-right (+ lo hi) 1)]
+        (if (neg? (.compareTo ^String (aget names mid) s))
+          (recur (inc mid) hi)
+          (recur lo mid)))
+      lo)))
+
+(defn- prefix-range
+  "Given an index, a string prefix, and a function, call the function with
+  every item whose candidate string starts with the prefix, and return the
+  results."
+  [{:keys [^objects names ^objects items]} ^String prefix f]
+  (loop [i (lower-bound names prefix)
+         ret (transient [])]
+    (if (and (< i (alength names)) (.startsWith ^String (aget names i) prefix))
+      (recur (inc i) (conj! ret (f (aget items i))))
+      (persistent! ret))))
+
+(defn- keyword-index
+  []
+  (let [^ConcurrentHashMap table @keyword-table]
+    (eventual-index ::keywords (.size table) #(index str (all-keywords)))))
+
+(defn- namespace-index
+  []
+  (let [namespaces (all-ns)
+        ;; Unlike the number of namespaces, the sum of their identity hash
+        ;; codes changes if one namespace is removed and another created.
+        version (reduce #(unchecked-add %1 (System/identityHashCode %2)) 0 namespaces)]
+    (cached-index ::namespaces version
+      #(index (comp name ns-name) namespaces))))
+
+(defn- mapping-index
+  "Given a namespace, return an index of the vars and the classes mapped in
+  the namespace."
+  [ns]
+  (let [^clojure.lang.Namespace ns (the-ns ns)
+        mappings (.getMappings ns)]
+    (cached-index [::mappings (ns-name ns)] mappings
+      #(index first
+         (eduction
+           (keep (fn [[sym v]]
+                   (cond
+                     (var? v) (when-some [var-name (-> v meta :name)] [(name var-name) v])
+                     (class? v) [(name sym) v])))
+           mappings)))))
+
+(defn- annotate-mapping
+  [[candidate v]]
+  (if (var? v)
+    (annotate-var v)
+    {:candidate candidate :type :class}))
+
+(defn- annotate-ns-with-doc
+  [ns]
+  (let [doc (-> ns meta :doc)]
+    (cond-> (annotate-namespace (ns-name ns))
+      doc (assoc :doc doc))))
+
+(defn- indexed-ns-candidates
+  "Like ns-candidates, but only return the candidates that start with the
+  prefix."
+  [^String prefix ns]
+  (concat
+    (prefix-range (namespace-index) prefix annotate-ns-with-doc)
+    (eduction
+      (map key)
+      (filter #(.startsWith (name %) prefix))
+      (map annotate-namespace)
+      (ns-aliases ns))))
+
+(defn- indexed-keyword-candidates
+  "Like keyword-candidates, but only return the candidates that start with
+  the prefix."
+  [^String prefix ns]
+  (let [index (keyword-index)
+        ns (the-ns ns)
+        aliases (ns-aliases ns)]
+    (if (.startsWith prefix "::")
+      (let [s (subs prefix 2)
+            slash (.indexOf s "/")]
+        (if (neg? slash)
+          (concat
+            (prefix-range index (str ":" (ns-name ns) "/" s) #(annotate-keyword (str "::" (name %))))
+            (eduction
+              (map #(str "::" (name (key %))))
+              (filter #(.startsWith ^String % prefix))
+              (map annotate-keyword)
+              aliases)
+            (mapcat
+              (fn [[alias target]]
+                (when (.startsWith (name alias) s)
+                  (prefix-range index (str ":" (ns-name target) "/")
+                    #(annotate-keyword (str "::" alias "/" (name %))))))
+              aliases))
+          (let [alias (symbol (subs s 0 slash))]
+            (when-some [target (get aliases alias)]
+              (prefix-range index (str ":" (ns-name target) "/" (subs s (inc slash)))
+                #(annotate-keyword (str "::" alias "/" (name %))))))))
+      (prefix-range index prefix annotate-keyword))))
+
+;; Fuzzy matching
+;;
+;; A fuzzy match anchors on the first character of the prefix (after any
+;; leading colons or dots), so that "mct" matches "mapcat", but not "format".
+;; Anchoring keeps fuzzy matching cheap: it only needs to look at the range of
+;; the indexes that starts with the anchor.
+
+(defn anchor
+  "Given a string prefix, return the part of the prefix every fuzzy candidate
+  must start with: any leading colons or dots, and the character after them."
+  [^String prefix]
+  (let [n (count (take-while #{\: \.} prefix))]
+    (subs prefix 0 (min (count prefix) (inc n)))))
+
+(def ^:private word-boundary?
+  #{\- \. \/ \: \$ \_ \> \! \?})
+
+(defn score
+  "Given a string prefix and a candidate string, return a number that says how
+  well the candidate fuzzily matches the prefix, or nil if it doesn't match.
+
+  A candidate matches if it starts with the anchor of the prefix and the rest
+  of the prefix is a subsequence of the candidate. Characters that match
+  consecutively or at the start of a word score higher, and candidates that
+  start with the whole prefix score highest."
+  [^String prefix ^String candidate]
+  (let [anchor (anchor prefix)]
+    (when (.startsWith candidate anchor)
+      (loop [i (count anchor)
+             from (count anchor)
+             score 0]
+        (if (= i (count prefix))
+          (cond-> score (.startsWith candidate prefix) (+ 100))
+          (let [j (.indexOf candidate (int (.charAt prefix i)) (int from))]
+            (when-not (neg? j)
+              (recur (inc i) (inc j)
+                (cond-> (inc score)
+                  (= j from) (+ 3)
+                  (word-boundary? (.charAt candidate (dec j))) (+ 2))))))))))
+
+(comment
+  (score "mct" "mapcat")
+  (score "mct" "format")
+  (score "ma" "map")
+  ,)
+
+(defn rank
+  "Given a string prefix, a list of candidates, and whether to match fuzzily,
+  return the candidates that match the prefix.
+
+  If matching fuzzily, sort the candidates best match first; otherwise, sort
+  them by the candidate string."
+  [^String prefix candidates fuzzy]
+  (if fuzzy
+    (->> candidates
+      (keep #(some-> (score prefix (:candidate %)) (vector %)))
+      (sort-by (fn [[score {:keys [^String candidate]}]] [(- score) (.length candidate) candidate]))
+      (map second))
+    (sort-by :candidate (filter #(candidate? prefix %) candidates))))
+
 (defn candidates
   "Given a string prefix and ns symbol, return auto-completion candidates for
   the string prefix.
 
+  Options:
+
+    :fuzzy  If true, match candidates fuzzily and sort them best match first
+            (see score).
+
   See the comment form below for examples."
-  [^String prefix ns]
-  (when (seq prefix)
-    (let [candidates (cond
-                       (.startsWith prefix ":") (keyword-candidates (all-keywords) (ns-aliases ns) ns)
-                       (.startsWith prefix ".") (ns-java-method-candidates ns)
-                       (scoped? prefix) (scoped-candidates prefix ns)
-                       (.contains prefix ".") (concat (ns-candidates ns) (class-candidates prefix))
-                       :else (concat (special-form-candidates)
-                               (ns-candidates ns)
-                               (ns-var-candidates ns)
-                               (ns-class-candidates ns)))]
-      (sort-by :candidate (filter #(candidate? prefix %) candidates)))))
+  ([prefix ns]
+   (candidates prefix ns {}))
+  ([^String prefix ns {:keys [fuzzy]}]
+   (when (seq prefix)
+     (let [lookup (if fuzzy (anchor prefix) prefix)
+           candidates (cond
+                        (.startsWith prefix ":") (indexed-keyword-candidates lookup ns)
+                        (.startsWith prefix ".") (ns-java-method-candidates ns)
+                        (scoped? prefix) (scoped-candidates prefix ns)
+                        (.contains prefix ".") (concat (indexed-ns-candidates lookup ns) (class-candidates prefix))
+                        :else (concat (special-form-candidates)
+                                (indexed-ns-candidates lookup ns)
+                                (prefix-range (mapping-index ns) lookup annotate-mapping)))]
+       (rank prefix candidates fuzzy)))))
 
 (comment
   (candidates "ran" 'clojure.core)
+  (candidates "mct" 'clojure.core {:fuzzy true})
   (time (dorun (candidates "m" 'clojure.core)))
   ,)
 
+(defn respond-with-candidates
+  "Given a completions message and a list of candidates, respond to the
+  message with the candidates.
+
+  If the message has a :limit, respond with at most that many candidates, and
+  say whether there were more."
+  [{:keys [limit] :as message} candidates]
+  (if (and limit (seq (drop limit candidates)))
+    (respond-to message {:completions (vec (take limit candidates)) :truncated true})
+    (respond-to message {:completions candidates})))
+
 (defmulti completions :dialect)
 
 (defmethod completions :clj
-  [{:keys [prefix ns] :as message}]
+  [{:keys [prefix ns fuzzy] :as message}]
   (let [ns (or (some-> ns symbol find-ns) (the-ns 'user))]
-    (respond-to message {:completions (candidates prefix ns)})))
+    (respond-with-candidates message (candidates prefix ns {:fuzzy fuzzy}))))
 
 (defmethod handle :completions
   [message]
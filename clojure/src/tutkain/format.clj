@@ -1,7 +1,9 @@
 (ns tutkain.format
   (:require
    [clojure.main :as main]
-   [clojure.pprint :as pprint]))
+   [clojure.pprint :as pprint])
+  (:import
+   (java.io Writer)))
 
 (defn Throwable->str
   "Print a java.lang.Throwable into a string."
@@ -12,3 +14,49 @@
   [x]
   (binding [pprint/*print-right-margin* 100]
     (-> x pprint/pprint with-out-str)))
+
+(defn- budget-exceeded?
+  [ex]
+  (some #(::budget-exceeded (ex-data %)) (take-while some? (iterate ex-cause ex))))
+
+(defn- budget-writer
+  "Given a StringBuilder and a number of characters, return a writer that
+  appends to the StringBuilder and throws once the StringBuilder holds more
+  than that many characters."
+  ^Writer [^StringBuilder sb limit]
+  (letfn [(check! []
+            (when (> (.length sb) limit)
+              (throw (ex-info "Print budget exceeded" {::budget-exceeded true}))))]
+    (proxy [Writer] []
+      (write
+        ([x]
+         (cond
+           (string? x) (.append sb ^String x)
+           (integer? x) (.append sb (char x))
+           :else (.append sb ^chars x))
+         (check!))
+        ([x off len]
+         (if (string? x)
+           (.append sb ^String x (int off) (+ (int off) (int len)))
+           (.append sb ^chars x (int off) (int len)))
+         (check!)))
+      (flush [])
+      (close []))))
+
+(defn pp-str-limited
+  "Like pp-str, but stop printing once the output exceeds limit characters,
+  so that printing a large (or infinite) value takes time proportional to
+  the limit instead of the size of the value.
+
+  Return a vector of the output (at most limit characters) and whether the
+  output was truncated."
+  [x limit]
+  (let [sb (StringBuilder.)]
+    (try
+      (binding [pprint/*print-right-margin* 100]
+        (pprint/pprint x (budget-writer sb limit)))
+      [(str sb) false]
+      (catch Exception ex
+        (if (budget-exceeded? ex)
+          [(subs (str sb) 0 limit) true]
+          (throw ex))))))
@@ -0,0 +1,252 @@
+(ns tutkain.json
+  "Carry EDN values over JSON.
+
+  The backchannel can send JSON instead of EDN, so that the editor can parse
+  messages with a faster JSON parser. JSON has no keywords, symbols, or sets,
+  so this namespace tags them:
+
+  - A keyword value is an object with the single key \"~:\" and the keyword
+    without the leading colon as the value: {\"~:\": \"ns/name\"}.
+  - A symbol value is an object with the single key \"~$\".
+  - A set is an object with the single key \"~#set\" and an array of the
+    elements of the set as the value.
+  - Any other value JSON can't represent is an object with the single key
+    \"~#edn\" and the value as an EDN string as the value.
+  - A keyword object key is prefixed with \"~:\", a symbol key with \"~$\",
+    and any other key that isn't a string is prefixed with \"~#\" and written
+    as EDN. A string key that starts with \"~\" gets another \"~\" in front of
+    it.
+
+  The Python side of this namespace is api/ednjson.py."
+  (:require
+   [clojure.edn :as edn])
+  (:import
+   (java.io EOFException PushbackReader StringReader)))
+
+;; Write
+
+(defn- write-string
+  [^StringBuilder sb ^String s]
+  (.append sb \")
+  (dotimes [i (.length s)]
+    (let [c (.charAt s i)]
+      (case c
+        \" (.append sb "\\\"")
+        \\ (.append sb "\\\\")
+        \newline (.append sb "\\n")
+        \return (.append sb "\\r")
+        \tab (.append sb "\\t")
+        (if (< (int c) 0x20)
+          (.append sb (format "\\u%04x" (int c)))
+          (.append sb c)))))
+  (.append sb \"))
+
+(defn- named->str
+  [x]
+  (if-some [ns (namespace x)]
+    (str ns "/" (name x))
+    (name x)))
+
+(defn- key->str
+  [k]
+  (cond
+    (keyword? k) (str "~:" (named->str k))
+    (symbol? k) (str "~$" (named->str k))
+    (string? k) (if (.startsWith ^String k "~") (str "~" k) k)
+    :else (str "~#" (pr-str k))))
+
+(declare write-value)
+
+(defn- write-tagged
+  [^StringBuilder sb tag write x]
+  (.append sb \{)
+  (write-string sb tag)
+  (.append sb \:)
+  (write sb x)
+  (.append sb \}))
+
+(defn- write-array
+  [^StringBuilder sb xs]
+  (.append sb \[)
+  (reduce (fn [first? x]
+            (when-not first? (.append sb \,))
+            (write-value sb x)
+            false)
+    true
+    xs)
+  (.append sb \]))
+
+(defn- write-object
+  [^StringBuilder sb m]
+  (.append sb \{)
+  (reduce-kv (fn [first? k v]
+               (when-not first? (.append sb \,))
+               (write-string sb (key->str k))
+               (.append sb \:)
+               (write-value sb v)
+               false)
+    true
+    m)
+  (.append sb \}))
+
+(defn- write-value
+  [^StringBuilder sb x]
+  (cond
+    (nil? x) (.append sb "null")
+    (string? x) (write-string sb x)
+    (boolean? x) (.append sb (str x))
+    (keyword? x) (write-tagged sb "~:" write-string (named->str x))
+    (symbol? x) (write-tagged sb "~$" write-string (named->str x))
+    (map? x) (write-object sb x)
+    (set? x) (write-tagged sb "~#set" write-array x)
+    (sequential? x) (write-array sb x)
+    (or (instance? Long x) (instance? Integer x) (instance? Short x) (instance? Byte x)
+      (instance? clojure.lang.BigInt x) (instance? BigInteger x)) (.append sb (str x))
+    (and (or (instance? Double x) (instance? Float x))
+      (not (Double/isNaN (double x)))
+      (not (Double/isInfinite (double x)))) (.append sb (str x))
+    :else (write-tagged sb "~#edn" write-string (pr-str x))))
+
+(defn write-str
+  "Given an EDN value, return its representation as a JSON string."
+  [x]
+  (let [sb (StringBuilder.)]
+    (write-value sb x)
+    (str sb)))
+
+;; Read
+
+(defn- invalid
+  [^PushbackReader reader message]
+  (throw (ex-info message {:next (.read reader)})))
+
+(defn- peek-char
+  "Skip whitespace and return the next character in the reader without
+  consuming it, or -1 at the end of the reader."
+  [^PushbackReader reader]
+  (loop []
+    (let [c (.read reader)]
+      (cond
+        (neg? c) c
+        (Character/isWhitespace c) (recur)
+        :else (do (.unread reader c) c)))))
+
+(defn- expect
+  [^PushbackReader reader ch]
+  (when-not (= (int ch) (.read reader))
+    (invalid reader (str "Expected " ch))))
+
+(defn- read-string*
+  "Read a JSON string whose opening quote the reader has already consumed."
+  [^PushbackReader reader]
+  (let [sb (StringBuilder.)]
+    (loop []
+      (let [c (.read reader)]
+        (cond
+          (neg? c) (throw (EOFException. "EOF while reading JSON string"))
+          (= c (int \")) (str sb)
+          (= c (int \\)) (let [e (char (.read reader))]
+                           (case e
+                             \b (.append sb \backspace)
+                             \f (.append sb \formfeed)
+                             \n (.append sb \newline)
+                             \r (.append sb \return)
+                             \t (.append sb \tab)
+                             \u (let [cs (char-array 4)]
+                                  (.read reader cs 0 4)
+                                  (.append sb (char (Integer/parseInt (String. cs) 16))))
+                             (.append sb e))
+                           (recur))
+          :else (do (.append sb (char c)) (recur)))))))
+
+(defn- read-token
+  "Read the characters of a JSON number or literal."
+  [^PushbackReader reader]
+  (let [sb (StringBuilder.)]
+    (loop []
+      (let [c (.read reader)]
+        (if (and (not (neg? c)) (or (Character/isLetterOrDigit c) (#{\- \+ \.} (char c))))
+          (do (.append sb (char c)) (recur))
+          (do (when-not (neg? c) (.unread reader c)) (str sb)))))))
+
+(defn- str->key
+  [^String s]
+  (if (and (.startsWith s "~") (> (.length s) 1))
+    (case (subs s 0 2)
+      "~:" (keyword (subs s 2))
+      "~$" (symbol (subs s 2))
+      "~#" (edn/read-string (subs s 2))
+      "~~" (subs s 1)
+      s)
+    s))
+
+(defn- decode-object
+  [m]
+  (let [[tag v] (when (= 1 (count m)) (first m))]
+    (case tag
+      "~:" (keyword v)
+      "~$" (symbol v)
+      "~#set" (set v)
+      "~#edn" (edn/read-string v)
+      (persistent! (reduce-kv (fn [m k v] (assoc! m (str->key k) v)) (transient {}) m)))))
+
+(declare read-value)
+
+(defn- read-array
+  [^PushbackReader reader]
+  (if (= (int \]) (peek-char reader))
+    (do (.read reader) [])
+    (loop [xs (transient [])]
+      (let [xs (conj! xs (read-value reader))]
+        (peek-char reader)
+        (let [c (.read reader)]
+          (cond
+            (= c (int \,)) (recur xs)
+            (= c (int \])) (persistent! xs)
+            :else (invalid reader "Expected , or ]")))))))
+
+(defn- read-object
+  [^PushbackReader reader]
+  (if (= (int \}) (peek-char reader))
+    (do (.read reader) {})
+    (loop [m (transient {})]
+      (peek-char reader)
+      (expect reader \")
+      (let [k (read-string* reader)
+            _ (peek-char reader)
+            _ (expect reader \:)
+            m (assoc! m k (read-value reader))]
+        (peek-char reader)
+        (let [c (.read reader)]
+          (cond
+            (= c (int \,)) (recur m)
+            (= c (int \})) (decode-object (persistent! m))
+            :else (invalid reader "Expected , or }")))))))
+
+(defn- read-value
+  [^PushbackReader reader]
+  (let [c (peek-char reader)]
+    (cond
+      (neg? c) (throw (EOFException. "EOF while reading JSON"))
+      (= c (int \{)) (do (.read reader) (read-object reader))
+      (= c (int \[)) (do (.read reader) (read-array reader))
+      (= c (int \")) (do (.read reader) (read-string* reader))
+      :else (let [token (read-token reader)]
+              (case token
+                "null" nil
+                "true" true
+                "false" false
+                "" (invalid reader "Unexpected character")
+                (edn/read-string token))))))
+
+(defn read-str
+  "Given a JSON string, return the EDN value it represents.
+
+  If the string has no JSON value, return eof."
+  ([s]
+   (read-str s nil))
+  ([s eof]
+   (let [reader (PushbackReader. (StringReader. s))]
+     (if (neg? (peek-char reader))
+       eof
+       (read-value reader)))))
@@ -4,6 +4,7 @@
    [tutkain.backchannel :as backchannel]
    [tutkain.format :as format])
   (:import
+   (clojure.lang LineNumberingPushbackReader)
    (java.io File)))
 
 (def ^:dynamic ^:experimental *print*
@@ -14,6 +15,95 @@
   "A function you can use as the :caught arg of clojure.main/repl."
   main/repl-caught)
 
+(def ^:private max-truncated-results
+  "The number of truncated evaluation results to keep for the :expand op."
+  16)
+
+(def ^:private default-page-size
+  "The default number of characters the :expand op returns."
+  100000)
+
+(defonce ^:private truncated-results
+  (atom (sorted-map)))
+
+(defn- keep-truncated-result!
+  "Given an evaluation result and the truncated output of printing it, keep
+  them for the :expand op and return a handle to them.
+
+  Only keep the last max-truncated-results results."
+  [x s]
+  (-> (swap! truncated-results
+        (fn [results]
+          (let [handle (inc (or (some-> results rseq first key) 0))
+                results (assoc results handle {:x x :printed s :truncated? true})]
+            (cond-> results
+              (> (count results) max-truncated-results) (dissoc (ffirst results))))))
+    rseq
+    first
+    key))
+
+(defn- print-result
+  "Given an evaluation result and the result budget of the REPL, return a map
+  with the pretty-printed result as :val.
+
+  If printing the result takes more characters than the budget, truncate it
+  and add a :truncated map with the :handle and the :offset the :expand op
+  can continue printing the result from."
+  [x result-budget]
+  (if result-budget
+    (let [[s truncated?] (format/pp-str-limited x result-budget)]
+      (cond-> {:val s}
+        truncated? (assoc :truncated {:handle (keep-truncated-result! x s) :offset (count s)})))
+    {:val (format/pp-str x)}))
+
+(defn- print-further
+  "Given a truncated result kept for the :expand op and a number of
+  characters, return the result with at least that many characters of it
+  printed, or all of it if it takes fewer characters to print.
+
+  Print at least twice as many characters as the last time, so that paging
+  through a large result prints it a logarithmic number of times instead of
+  once per page."
+  [{:keys [x printed truncated?] :as result} limit]
+  (if (or (not truncated?) (<= limit (count printed)))
+    result
+    (let [[s truncated?] (format/pp-str-limited x (max limit (* 2 (count printed))))]
+      (assoc result :printed s :truncated? truncated?))))
+
+(defmethod backchannel/handle :expand
+  [{:keys [handle offset length] :or {offset 0 length default-page-size} :as message}]
+  (if-some [result (get @truncated-results handle)]
+    (let [{:keys [printed truncated?] :as result} (print-further result (+ offset length))
+          end (min (+ offset length) (count printed))]
+      (swap! truncated-results #(cond-> % (contains? % handle) (assoc handle result)))
+      (backchannel/respond-to message
+        (cond-> {:val (subs printed (min offset end) end)}
+          (or truncated? (< end (count printed))) (assoc :truncated {:handle handle :offset end}))))
+    (backchannel/respond-to message {:val nil :reason :not-found})))
+
+(defn- eval-context
+  "Given a form, if the form is an eval context directive, return the eval
+  context in it.
+
+  An eval context directive is a map like this:
+
+    {:tutkain/eval-context {:file \"/path/to/file.clj\" :line 1 :column 1}}
+
+  The client sends it on the line before the code it wants to evaluate, in
+  the same write as the code, so that evaluating code with a file, line, and
+  column takes a single round trip."
+  [form]
+  (when (map? form)
+    (:tutkain/eval-context form)))
+
+(defn- skip-line
+  "Skip the rest of the current line in a reader."
+  [^LineNumberingPushbackReader in]
+  (loop []
+    (let [c (.read in)]
+      (when-not (or (neg? c) (= c (int \newline)))
+        (recur)))))
+
 (defn repl
   "Tutkain's main read-eval-print loop.
 
@@ -22,14 +112,19 @@
   - Starts a backchannel socket server that Tutkain uses for editor tooling
     (auto-completion, metadata lookup, etc.)
   - Pretty-prints evaluation results and exception maps
+  - Given a :result-budget option, truncates evaluation results that take
+    more than that many characters to print (see the :expand backchannel
+    op)
   - Binds *print* and *caught* for use with nested REPLs started via
     clojure.main/repl
-  - Binds *file* and *source-path* to vals sent via backchannel when evaluating
-    to ensure useful exception stack traces"
+  - Binds *file* and *source-path* to vals sent via an eval context directive
+    (or via the backchannel) when evaluating to ensure useful exception stack
+    traces"
   ([]
    (repl {}))
   ([opts]
    (let [EOF (Object.)
+         result-budget (:result-budget opts)
          lock (Object.)
          out *out*
          in *in*
@@ -55,38 +150,45 @@
            (try
              (let [address (.getLocalAddress backchannel)]
                (out-fn {:tag :ret
-                        :val (pr-str {:host (.getHostName address)
-                                      :port (.getPort address)})}))
+                        :val (pr-str (merge {:host (.getHostName address)
+                                             :port (.getPort address)}
+                                       (backchannel/negotiate opts)))}))
              (add-tap tapfn)
              (loop []
                (when
                  (try
                    (let [[form s] (read+string {:eof EOF :read-cond :allow} in)
                          file (backchannel/eval-context :file)]
-                     (binding [*file* (or file "NO_SOURCE_PATH")
-                               *source-path* (or (some-> file File. .getName) "NO_SOURCE_FILE")]
-                       (try
-                         (when-not (identical? form EOF)
-                           (let [start (System/nanoTime)
-                                 ret (eval form)
-                                 ms (quot (- (System/nanoTime) start) 1000000)]
-                             (when-not (= :repl/quit ret)
-                               (set! *3 *2)
-                               (set! *2 *1)
-                               (set! *1 ret)
-                               (out-fn {:tag :ret
-                                        :val (format/pp-str ret)
-                                        :ns (str (.name *ns*))
-                                        :ms ms
-                                        :form s})
-                               true)))
-                         (catch Throwable ex
-                           (set! *e ex)
-                           (out-fn {:tag :err
-                                    :val (format/Throwable->str ex)
-                                    :ns (str (.name *ns*))
-                                    :form s})
-                           true))))
+                     (if-some [context (eval-context form)]
+                       (do
+                         ;; The code to evaluate starts on the next line.
+                         (skip-line in)
+                         (backchannel/set-eval-context! in context)
+                         true)
+                       (binding [*file* (or file "NO_SOURCE_PATH")
+                                 *source-path* (or (some-> file File. .getName) "NO_SOURCE_FILE")]
+                         (try
+                           (when-not (identical? form EOF)
+                             (let [start (System/nanoTime)
+                                   ret (eval form)
+                                   ms (quot (- (System/nanoTime) start) 1000000)]
+                               (when-not (= :repl/quit ret)
+                                 (set! *3 *2)
+                                 (set! *2 *1)
+                                 (set! *1 ret)
+                                 (out-fn (merge {:tag :ret
+                                                 :ns (str (.name *ns*))
+                                                 :ms ms
+                                                 :form s}
+                                           (print-result ret result-budget)))
+                                 true)))
+                           (catch Throwable ex
+                             (set! *e ex)
+                             (out-fn {:tag :err
+                                      :val (format/Throwable->str ex)
+                                      :ns (str (.name *ns*))
+                                      :form s})
+                             true)))))
                    (catch Throwable ex
                      (set! *e ex)
                      (out-fn {:tag :ret
@@ -27,8 +27,11 @@ from .src import paredit
 from .src import namespace
 from .src import test
 from .src.repl.client import BabashkaClient, JVMClient, JSClient
+from .src.repl.reactor import REACTOR
+from .src.repl import completions
 from .src.repl import info
 from .src.repl import history
+from .src.repl import keywords
 from .src.repl import tap
 from .src.repl import ports
 from .src.repl import printer
@@ -106,6 +109,8 @@ def plugin_unloaded():
     for window in sublime.windows():
         window.run_command("tutkain_disconnect")
 
+    REACTOR.stop()
+
     view = sublime.active_window().active_view()
     view and inline.clear(view)
 
@@ -158,6 +163,23 @@ def set_layout(window):
         window.set_layout(layout)
 
 
+def scrollback():
+    """Return the scrollback limit of REPL views per the scrollback setting,
+    or None if REPL views have no scrollback limit."""
+    opts = settings().get("scrollback") or {}
+
+    if opts.get("max_characters") or opts.get("max_lines"):
+        log_path = opts.get("log")
+
+        return printer.Scrollback(
+            max_characters=opts.get("max_characters"),
+            max_lines=opts.get("max_lines"),
+            log_path=log_path and os.path.expanduser(log_path),
+            log_max_bytes=opts.get("log_max_bytes", printer.LOG_MAX_BYTES),
+            log_backups=opts.get("log_backups", printer.LOG_BACKUPS)
+        )
+
+
 class TutkainClearOutputViewCommand(WindowCommand):
     def clear_view(self, view):
         if view:
@@ -175,6 +197,13 @@ class TutkainClearOutputViewCommand(WindowCommand):
         panel and self.clear_view(panel)
 
 
+class TutkainTrimViewCommand(TextCommand):
+    def run(self, edit, end):
+        self.view.set_read_only(False)
+        self.view.erase(edit, sublime.Region(0, end))
+        self.view.set_read_only(True)
+
+
 class TutkainEvaluateFormCommand(TextCommand):
     def run(self, _, scope="outermost", ignore={"comment"}, inline_result=False):
         self.view.window().status_message(
@@ -434,7 +463,9 @@ class TutkainEvaluateCommand(TextCommand):
                             client,
                             code,
                             eval_region.begin(),
-                            lambda response: self.handler(eval_region, client, response, inline_result)
+                            # Bind the region now: the evaluations pipeline, so the
+                            # responses arrive after the loop is done.
+                            lambda response, region=eval_region: self.handler(region, client, response, inline_result)
                         )
 
     def input(self, args):
@@ -488,6 +519,7 @@ class TutkainConnectCommand(WindowCommand):
 
     def run(self, dialect, host, port, view_id=None):
         dialect = edn.Keyword(dialect)
+        output_backlog = settings().get("output_backlog", 10000)
 
         try:
             active_view = self.window.active_view()
@@ -501,15 +533,18 @@ class TutkainConnectCommand(WindowCommand):
                     self.choose_build_id(view, ids, on_done)
 
                 # FIXME: Backchannel port option
-                client = JSClient(source_root(), host, int(port), prompt)
+                client = JSClient(source_root(), host, int(port), prompt, output_backlog=output_backlog)
             elif dialect == edn.Keyword("bb"):
-                client = BabashkaClient(source_root(), host, int(port))
+                client = BabashkaClient(source_root(), host, int(port), output_backlog=output_backlog)
             else:
                 client = JVMClient(
                     source_root(), host, int(port), backchannel_opts={
                         "port": settings().get("clojure").get("backchannel").get("port"),
-                        "bind_address": settings().get("clojure").get("backchannel").get("bind_address", "localhost")
-                    }
+                        "bind_address": settings().get("clojure").get("backchannel").get("bind_address", "localhost"),
+                        "compression_threshold": settings().get("clojure").get("backchannel").get("compression_threshold", 1024)
+                    },
+                    output_backlog=output_backlog,
+                    result_budget=settings().get("clojure").get("result_budget", 100000)
                 )
 
             client.connect()
@@ -518,7 +553,11 @@ class TutkainConnectCommand(WindowCommand):
             state.set_view_client(view, dialect, client)
             state.set_repl_view(view, dialect)
 
-            print_loop = Thread(daemon=True, target=printer.print_loop, args=(view, client))
+            print_loop = Thread(
+                daemon=True,
+                target=printer.print_loop,
+                args=(view, client, settings().get("max_frame_rate", printer.MAX_FRAME_RATE), scrollback())
+            )
             print_loop.name = f"tutkain.{dialect.name}.print_loop"
             print_loop.start()
 
@@ -538,6 +577,9 @@ class TutkainConnectCommand(WindowCommand):
         except ConnectionRefusedError:
             view.close()
             self.window.status_message(f"ERR: connection to {host}:{port} refused.")
+        except ConnectionError as error:
+            view.close()
+            self.window.status_message(f"ERR: connection to {host}:{port} failed: {error}")
 
     def input(self, args):
         if "dialect" in args and "host" in args and "port" in args:
@@ -641,23 +683,37 @@ class TutkainViewEventListener(ViewEventListener):
             if scope := selectors.expand_by_selector(self.view, point, "meta.symbol | constant.other.keyword"):
                 prefix = self.view.substr(scope)
 
+            ns = namespace.name(self.view)
+
+            if (candidates := client.completions.get(ns, dialect, prefix)) is not None:
+                return sublime.CompletionList(map(self.completion_item, candidates))
+
             completion_list = sublime.CompletionList()
 
+            def handler(response):
+                candidates = response.get(edn.Keyword("completions")) or []
+
+                if prefix:
+                    client.completions.put(
+                        ns, dialect, prefix, candidates,
+                        truncated=bool(response.get(keywords.TRUNCATED))
+                    )
+
+                completion_list.set_completions(map(self.completion_item, candidates))
+
             client.backchannel.send({
                 "op": edn.Keyword("completions"),
                 "prefix": prefix,
-                "ns": namespace.name(self.view),
-                "dialect": dialect
-            }, handler=lambda response: (
-                completion_list.set_completions(
-                    map(self.completion_item, response.get(edn.Keyword("completions"), []))
-                )
-            ))
+                "ns": ns,
+                "dialect": dialect,
+                "fuzzy": True,
+                "limit": settings().get("auto_complete_limit", completions.LIMIT)
+            }, handler=handler, group="completions")
 
             return completion_list
 
 
-def lookup(view, form, handler):
+def lookup(view, form, handler, group=None):
     if not view.settings().get("tutkain_repl_view_dialect") and form and (
         dialect := dialects.for_point(view, form.begin())
     ) and (
@@ -668,7 +724,7 @@ def lookup(view, form, handler):
             "named": view.substr(form),
             "ns": namespace.name(view),
             "dialect": dialect
-        }, handler)
+        }, handler, group)
 
 
 class TutkainShowInformationCommand(TextCommand):
@@ -795,7 +851,7 @@ class TutkainEventListener(EventListener):
             "source.clojure & (meta.symbol | constant.other.keyword.qualified | constant.other.keyword.auto-qualified)"
         ):
             form = forms.find_adjacent(view, point)
-            lookup(view, form, lambda response: info.show_popup(view, point, response))
+            lookup(view, form, lambda response: info.show_popup(view, point, response), group="lookup")
 
     def on_close(self, view):
         if view.settings().get("tutkain_repl_view_dialect"):
@@ -862,6 +918,17 @@ class TutkainInterruptEvaluationCommand(WindowCommand):
             client.backchannel.send({"op": edn.Keyword("interrupt")})
 
 
+class TutkainExpandResultCommand(WindowCommand):
+    def run(self):
+        dialect = edn.Keyword("clj")
+        client = state.client(self.window, dialect)
+
+        if client is None:
+            self.window.status_message("ERR: Not connected to a REPL.")
+        elif not client.expand():
+            self.window.status_message("No truncated evaluation result to expand.")
+
+
 class TutkainInsertNewlineCommand(TextCommand):
     def run(self, edit):
         indent.insert_newline_and_indent(self.view, edit)
@@ -1200,7 +1267,7 @@ def fetch_locals(view, point, form, handler):
     ) and (
         client := state.client(view.window(), dialect)
     ) and (
-        "analyzer.clj" in client.capabilities
+        client.ready("locals")
     ) and (
         outermost := sexp.outermost(view, point, edge=False)
     ):
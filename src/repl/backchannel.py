@@ -1,107 +1,376 @@
-import itertools
-import queue
+import re
 import socket
-
-from threading import Event, Thread
+import struct
+import zlib
 
 from ...api import edn
+from ...api import ednjson
+from . import keywords
+from .reactor import REACTOR
+from .tracker import NO_DEADLINE, Tracker
 from ..log import log
 
 
+# The maximum number of bytes to read from the socket at once.
+RECV_BUFFER_SIZE = 65536
+
+# The header of a length-prefixed frame: a flags byte followed by the length
+# of the payload as an unsigned 32-bit big-endian integer.
+FRAME_HEADER = struct.Struct(">BI")
+
+# The flag of a frame whose payload is compressed with zlib.
+COMPRESSED = 0x01
+
+# The backchannel ops that evaluate code. They can take any length of time,
+# so the backchannel waits for their responses indefinitely.
+EVALUATING_OPS = {"load", "test"}
+
+# By default, compress payloads of at least this many bytes.
+COMPRESSION_THRESHOLD = 1024
+
+# The number of bytes at the start of a payload to look for the id of the
+# request the message responds to in.
+ID_PEEK_SIZE = 64
+
+# The start of a message that responds to a request, per encoding. The server
+# writes :id first, and :exception second if the message is an exception, so
+# the backchannel can drop a response to a request it no longer tracks
+# without decoding the message.
+ID_PREFIXES = {
+    keywords.EDN: re.compile(rb'\{:id (\d+)(,? :exception true)?'),
+    keywords.JSON: re.compile(rb'\{"~:id":(\d+)(,"~:exception":true)?'),
+}
+
+
+class FrameReader(object):
+    """Reads length-prefixed frames from a socket.
+
+    The reader receives bytes straight into a preallocated buffer and yields
+    each complete frame as a memoryview of the buffer, so the payload is
+    never copied before it is decoded. A payload is only valid until the
+    next call to recv."""
+
+    def __init__(self, socket, size=RECV_BUFFER_SIZE):
+        self.socket = socket
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # The position in the buffer where the first unread frame starts.
+        self.start = 0
+        # The position in the buffer where the received bytes end.
+        self.end = 0
+
+    def reserve(self, size):
+        """Given a number of bytes, make sure the buffer has room for at least
+        that many bytes after the first unread frame."""
+        pending = self.end - self.start
+
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+
+        self.start = 0
+        self.end = pending
+
+    def recv(self):
+        """Receive bytes from the socket into the buffer.
+
+        Return the number of bytes received, or 0 if the socket is closed."""
+        if self.end == len(self.buffer):
+            # Make room for at least the frame at the start of the buffer.
+            size = len(self.buffer)
+
+            if self.end - self.start >= FRAME_HEADER.size:
+                _, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+                size = max(size, FRAME_HEADER.size + length)
+
+            self.reserve(size)
+
+        n = self.socket.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def __iter__(self):
+        """Yield the flags and the payload of every complete frame in the
+        buffer."""
+        while self.end - self.start >= FRAME_HEADER.size:
+            flags, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            frame_end = self.start + FRAME_HEADER.size + length
+
+            if frame_end > self.end:
+                return
+
+            payload = self.view[self.start + FRAME_HEADER.size:frame_end]
+            self.start = frame_end
+            yield flags, payload
+            payload.release()
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+def frame(payload, flags=0):
+    """Given a payload as bytes, return the payload as a length-prefixed
+    frame."""
+    return FRAME_HEADER.pack(flags, len(payload)) + payload
+
+
 class Backchannel(object):
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.host, self.port))
-        self.buffer = self.socket.makefile(mode="rw")
 
         log.debug({"event": "backchannel/connect", "host": self.host, "port": self.port})
 
-        send_loop = Thread(daemon=True, target=self.send_loop)
-        send_loop.name = "tutkain.backchannel.send_loop"
-        send_loop.start()
-
-        recv_loop = Thread(daemon=True, target=self.recv_loop)
-        recv_loop.name = "tutkain.backchannel.recv_loop"
-        recv_loop.start()
-
+        self.channel = self.reactor.channel(self.socket, self.recv, self.disconnected).open()
         return self
 
-    def disconnect(self):
-        if self.socket is not None:
-            try:
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
-                log.debug({"event": "backchannel/disconnect"})
-            except OSError as e:
-                log.debug({"event": "error", "exception": e})
-
-    def __init__(self, client, host, port):
-        self.stop_event = Event()
+    def disconnected(self):
+        log.debug({"event": "backchannel/disconnect", "bytes": self.byte_counts})
+
+    def __init__(
+        self,
+        client,
+        host,
+        port,
+        framing=keywords.NEWLINE,
+        encoding=keywords.EDN,
+        compression_threshold=None,
+        reactor=REACTOR,
+        tracker=None
+    ):
+        self.reactor = reactor
+        self.socket = None
+        self.channel = None
         self.client = client
         self.host = host
         self.port = port
-        self.sendq = queue.Queue()
-        self.handlers = {}
-        self.message_id = itertools.count(1)
+        # The framing and the encoding the server agreed to during the
+        # handshake. The framing is either newline-delimited or
+        # length-prefixed messages. The encoding is either EDN or JSON
+        # (length-prefixed messages only).
+        self.framing = framing
+        self.encoding = encoding
+        # If the server agreed to compress messages, the size in bytes at
+        # which to start compressing messages (length-prefixed messages
+        # only). If None, never compress messages.
+        self.compression_threshold = compression_threshold
+        # The number of payload bytes sent and received before compression
+        # and on the wire.
+        self.byte_counts = {"sent": 0, "sent_wire": 0, "received": 0, "received_wire": 0}
+        # The tracker of the requests awaiting a response. The backchannel can
+        # share the tracker with the REPL client.
+        self.tracker = tracker or Tracker(schedule=reactor.call_later)
+        # A map of every request group to the id of the newest request in
+        # the group.
+        self.latest = {}
+        # A map of every request group to the id of the request in the group
+        # the backchannel has sent and hasn't received a response to. Only
+        # touched on the reactor thread.
+        self.sent = {}
+        self.decoder = edn.LineDecoder(on_error=self.decode_error)
+        self.reader = None
 
-    def send_loop(self):
-        try:
-            while item := self.sendq.get():
-                log.debug({"event": "backchannel/send", "item": item})
-                edn.write(self.buffer, item)
-        except OSError as error:
-            log.error({"event": "error", "error": error})
-        finally:
-            self.disconnect()
-            self.stop_event.set()
-            log.debug({"event": "thread/exit"})
-
-    def send(self, op, handler=None):
-        mid = edn.Keyword("id")
+        if encoding == keywords.JSON:
+            self.decode = ednjson.loads
+        else:
+            self.decode = edn.read
+
+        self.id_prefix = ID_PREFIXES.get(encoding, ID_PREFIXES[keywords.EDN])
+
+    def count(self, direction, size, wire_size):
+        self.byte_counts[direction] += size
+        self.byte_counts[direction + "_wire"] += wire_size
+
+    def compress(self, payload):
+        """Given a payload as bytes, return the flags of the frame to send
+        the payload in and the payload, compressed if the payload is at least
+        as large as the compression threshold and compressing makes it
+        smaller."""
+        if self.compression_threshold is not None and len(payload) >= self.compression_threshold:
+            compressed = zlib.compress(payload)
+
+            if len(compressed) < len(payload):
+                return COMPRESSED, compressed
+
+        return 0, payload
+
+    def encode(self, item):
+        """Given a message, return the message as bytes ready to send."""
+        if self.framing != keywords.LENGTH_PREFIXED:
+            data = (edn.dumps(item) + "\n").encode("utf-8")
+            self.count("sent", len(data), len(data))
+            return data
+
+        if self.encoding == keywords.JSON:
+            payload = ednjson.dumps(item).encode("utf-8")
+        else:
+            payload = edn.dumps(item).encode("utf-8")
+
+        flags, data = self.compress(payload)
+        self.count("sent", len(payload), len(data))
+        return frame(data, flags)
+
+    def send(self, op, handler=None, group=None):
+        """Given an op and a function that handles the response to the op,
+        send the op to the server.
+
+        Given a group, a newer request in the same group supersedes this one:
+        if the backchannel hasn't sent this request yet, it drops the request;
+        else, it tells the server to cancel the request. Either way, the
+        handler is never called. Use for requests whose response is useless
+        once the user has moved on, like auto-completion."""
         op = edn.kwmap(op)
-        op[mid] = next(self.message_id)
+        kind = op.get(keywords.OP)
+
+        if kind:
+            self.client.before_op(kind.name)
 
         if handler:
-            self.handlers[op[mid]] = handler
+            name = kind.name if kind else None
+            timeout = NO_DEADLINE if name in EVALUATING_OPS else None
+            op[keywords.ID] = id = self.tracker.track(handler, name, timeout=timeout)
+        else:
+            op[keywords.ID] = id = self.tracker.next_id()
+
+        if group is not None:
+            self.latest[group] = id
 
-        self.sendq.put(op)
+        self.reactor.call_soon(self.write, op, group)
+
+    def write(self, item, group=None):
+        if group is not None:
+            id = item.get(keywords.ID)
+
+            if self.latest.get(group) != id:
+                # A newer request superseded this one before we sent it.
+                self.tracker.cancel(id)
+                log.debug({"event": "backchannel/drop", "id": id, "group": group})
+                return
+
+            if (previous := self.sent.get(group)) is not None and self.tracker.cancel(previous):
+                self.write(edn.kwmap({
+                    "op": keywords.CANCEL,
+                    "id": self.tracker.next_id(),
+                    "ids": [previous]
+                }))
+
+            self.sent[group] = id
+
+        log.debug({"event": "backchannel/send", "item": item})
+        self.channel.write(self.encode(item))
 
     def handle(self, response):
         try:
-            if not isinstance(response, dict):
-                self.client.recvq.put(response)
-            elif response.get(edn.Keyword("exception")):
-                self.client.recvq.put(response)
-            elif response.get(edn.Keyword("debug")):
-                log.debug({"event": "info", "message": response.get(edn.Keyword("val"))})
+            if not isinstance(response, dict) or response.get(keywords.EXCEPTION):
+                # Keep the order of the responses the client prints.
+                self.reactor.call_handler(self.client.recvq.put, response)
+            elif response.get(keywords.DEBUG):
+                log.debug({"event": "info", "message": response.get(keywords.VAL)})
             else:
-                id = response.get(edn.Keyword("id"))
+                id = response.get(keywords.ID)
+
+                if handler := self.tracker.complete(id):
+                    self.reactor.call_handler(handler, response)
+                else:
+                    # The request was cancelled or expired. Drop the
+                    # response.
+                    log.debug({"event": "backchannel/stale", "id": id})
 
-                try:
-                    handler = self.handlers.get(id)
-                    handler.__call__(response)
-                finally:
-                    self.handlers.pop(id, None)
+                self.forget(id)
         except AttributeError as error:
             log.error({"event": "error", "response": response, "error": error})
 
-    def recv_loop(self):
-        try:
-            while not self.stop_event.is_set() and (item := edn.read_line(self.buffer)):
-                log.debug({"event": "backchannel/recv", "item": item})
-                self.handle(item)
-        except OSError as error:
-            log.error({"event": "error", "error": error})
-        finally:
-            log.debug({"event": "thread/exit"})
+    def forget(self, id):
+        """Given the id of a request the backchannel has received a response
+        to, stop waiting for a response to the request."""
+        for group, sent in list(self.sent.items()):
+            if sent == id:
+                del self.sent[group]
+
+    def peek_id(self, flags, payload):
+        """Given the flags and the payload of a frame, return the id of the
+        request the message in the frame responds to, without decoding the
+        message.
+
+        Return None if the message doesn't respond to a request, or if it's
+        an exception, which the client prints even if it no longer tracks the
+        request."""
+        if flags & COMPRESSED:
+            head = zlib.decompressobj().decompress(payload, ID_PEEK_SIZE)
+        else:
+            head = payload[:ID_PEEK_SIZE]
+
+        if (match := self.id_prefix.match(head)) and not match.group(2):
+            return int(match.group(1))
+
+    def decode_error(self, line, error):
+        log.error({"event": "error", "line": line, "error": error})
+
+    def recv_lines(self):
+        if not (chunk := self.socket.recv(RECV_BUFFER_SIZE)):
+            return False
+
+        self.count("received", len(chunk), len(chunk))
+        self.decoder.feed(chunk)
+
+        for item in self.decoder:
+            log.debug({"event": "backchannel/recv", "item": item})
+            self.handle(item)
+
+        return True
+
+    def recv_frames(self):
+        if self.reader is None:
+            self.reader = FrameReader(self.socket)
+
+        if not self.reader.recv():
+            return False
+
+        for flags, payload in self.reader:
+            wire_size = len(payload)
+
+            if (id := self.peek_id(flags, payload)) is not None and not self.tracker.tracking(id):
+                # The request was cancelled or expired. Drop the response
+                # before decompressing or decoding it.
+                self.count("received", wire_size, wire_size)
+                log.debug({"event": "backchannel/stale", "id": id})
+                self.forget(id)
+                continue
+
+            if flags & COMPRESSED:
+                payload = zlib.decompress(payload)
+
+            self.count("received", len(payload), wire_size)
+            item = self.decode(str(payload, "utf-8"))
+            log.debug({"event": "backchannel/recv", "item": item})
+            self.handle(item)
+
+        return True
+
+    def recv(self):
+        """Receive bytes from the socket and handle every message they
+        complete.
+
+        Return False if the socket has reached its end."""
+        if self.framing == keywords.LENGTH_PREFIXED:
+            return self.recv_frames()
+        else:
+            return self.recv_lines()
 
     def halt(self):
         log.debug({"event": "backchannel/halt"})
-        self.sendq.put(None)
+
+        if self.channel is not None:
+            self.channel.close()
 
 
 class NoopBackchannel():
-    def send(self, op, handler=None):
+    def send(self, op, handler=None, group=None):
         pass
 
     def halt(self):
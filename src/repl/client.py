@@ -1,114 +1,557 @@
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+from functools import partial
 from inspect import cleandoc
+import collections
+import hashlib
 import queue
 import os
 import pathlib
 import posixpath
 import socket
+import time
 
-from .backchannel import Backchannel, NoopBackchannel
+from threading import Condition, RLock
+
+from .backchannel import COMPRESSION_THRESHOLD, EVALUATING_OPS, Backchannel, NoopBackchannel
+from .completions import CompletionCache
 from ...api import edn
+from . import keywords
+from .reactor import REACTOR
+from .tracker import NO_DEADLINE, Tracker
 from ..log import log
 from .. import base64
 
 
+# The maximum number of bytes to read from a socket at once.
+RECV_BUFFER_SIZE = 65536
+
+# By default, start dropping output once this many lines of it are waiting
+# to be printed.
+OUTPUT_BACKLOG = 10000
+
+# By default, truncate evaluation results that take more than this many
+# characters to print.
+RESULT_BUDGET = 100000
+
+# The number of seconds to wait for the REPL prompt when connecting.
+PROBE_TIMEOUT = 5
+
+# The forms that define the functions the handshake uses to load modules
+# into the REPL.
+#
+# tutkain.bootstrap/hashes holds the content hash of every module the REPL
+# has loaded. It survives reconnects, so that reconnecting to a REPL doesn't
+# ship or recompile modules that haven't changed.
+BOOTSTRAP = [
+    "(ns tutkain.bootstrap)",
+    "(defonce hashes (atom {}))",
+    "(def load-base64 (let [decoder (java.util.Base64/getDecoder)] (fn [blob file filename hash] (when-not (= hash (get @hashes filename)) (with-open [reader (-> decoder (.decode blob) (java.io.ByteArrayInputStream.) (java.io.InputStreamReader.) (clojure.lang.LineNumberingPushbackReader.))] (clojure.lang.Compiler/load reader file filename)) (swap! hashes assoc filename hash)) filename)))",
+    "(defn module-hashes [] (merge (some-> (resolve 'tutkain.backchannel/module-hashes) deref deref) @hashes))",
+    "(module-hashes)",
+]
+
+# The backchannel ops of the modules the client loads on demand, the first
+# time it sends one of their ops.
+#
+# Loading analyzer.clj compiles tools.analyzer.jvm, and loading
+# completions.clj starts scanning every class on the classpath, so loading
+# them during the handshake makes connecting slower and uses heap the REPL
+# might never need.
+DEFERRED_OPS = {
+    "completions": "completions.clj",
+    "locals": "analyzer.clj",
+    "test": "test.clj",
+}
+
+# The states of the modules in Client.capabilities.
+LOADABLE = "loadable"
+LOADING = "loading"
+LOADED = "loaded"
+
+
+def read_module(path):
+    """Given the path to a module, return the contents of the module and
+    their content hash."""
+    with open(path, "rb") as file:
+        content = file.read()
+
+    return content, hashlib.sha256(content).hexdigest()
+
+
+class FormatQueue(object):
+    """A queue-like sink for REPL responses.
+
+    Formats every response as soon as it's put and puts the response and its
+    printable representation into the print queue. Putting None closes the
+    print queue."""
+
+    def __init__(self, format, printq):
+        self.format = format
+        self.printq = printq
+        self.closed = False
+
+    def put(self, response):
+        if self.closed:
+            return
+
+        log.debug({"event": "formatq/recv", "data": response})
+
+        if response is None:
+            self.closed = True
+            self.printq.put(None)
+        elif printable := self.format(response):
+            self.printq.put({"printable": printable, "response": response})
+
+
+class PrintQueue(object):
+    """A bounded queue of printable REPL responses.
+
+    Merges consecutive :out and :err responses into a single printable item,
+    so that a REPL that prints a lot of short lines doesn't flood the view
+    with appends.
+
+    Once the backlog of output waiting to be printed exceeds the given
+    number of lines, drops the lines past the backlog instead of queueing
+    them, and queues an item that says how many lines were dropped instead.
+    If no output is waiting, always queues at least the first line of an
+    item, so that a single large item is truncated rather than dropped. Never
+    drops anything else (for example, evaluation results).
+
+    Putting an item never blocks: the reactor thread puts items into the
+    queue, and blocking the reactor thread would block every connection."""
+
+    def __init__(self, backlog=OUTPUT_BACKLOG):
+        self.backlog = backlog
+        # A deque of [item, output tag, lines of output, lines dropped] lists.
+        self.entries = collections.deque()
+        self.condition = Condition()
+        # The number of lines of output in the queue.
+        self.lines = 0
+
+    def put(self, item):
+        with self.condition:
+            tag = item and item["response"].get(keywords.TAG)
+
+            if tag in {keywords.OUT, keywords.ERR}:
+                self.put_output(item, tag)
+            else:
+                self.entries.append([item, None, 0, 0])
+
+            self.condition.notify()
+
+    def put_output(self, item, tag):
+        lines = max(1, item["printable"].count("\n"))
+        dropped = 0
+
+        if self.backlog is not None and self.lines + lines > self.backlog:
+            # The number of lines of the item that fit into the backlog.
+            room = max(self.backlog - self.lines, 0 if self.lines else 1)
+            dropped = lines - room
+            lines = room
+
+            if room:
+                printable = "\n".join(item["printable"].split("\n")[:room]) + "\n"
+                item = {"printable": printable, "response": edn.kwmap({"tag": tag, "val": printable})}
+
+        last = self.entries[-1] if self.entries else None
+
+        if not lines:
+            # The backlog is full: drop the whole item.
+            pass
+        elif last is not None and last[1] == tag:
+            printable = last[0]["printable"] + item["printable"]
+            last[0] = {"printable": printable, "response": edn.kwmap({"tag": tag, "val": printable})}
+            last[2] += lines
+            self.lines += lines
+        else:
+            self.entries.append([item, tag, lines, 0])
+            self.lines += lines
+
+        if dropped:
+            last = self.entries[-1] if self.entries else None
+
+            if last is not None and last[3]:
+                last[3] += dropped
+            else:
+                self.entries.append([None, None, 0, dropped])
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next item in the queue, like queue.Queue.get."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.entries, timeout if block else 0):
+                raise queue.Empty
+
+            item, _, lines, dropped = self.entries.popleft()
+            self.lines -= lines
+
+            if dropped:
+                return {
+                    "printable": f"… {dropped} {'line' if dropped == 1 else 'lines'} dropped\n",
+                    "response": edn.kwmap({"tag": keywords.ERR})
+                }
+
+            return item
+
+    def qsize(self):
+        with self.condition:
+            return len(self.entries)
+
+
 class Client(ABC):
-    def start_workers(self):
-        self.executor.submit(self.send_loop)
-        self.executor.submit(self.recv_loop)
-        self.executor.submit(self.format_loop)
+    def start(self):
+        """Start reading from and writing to the REPL socket on the reactor
+        thread."""
+        # Handle whatever the handshake left in the decoder's buffer first.
+        self.reactor.call_soon(self.handle_decoded)
+        self.handshake_complete = True
+        self.reactor.call_soon(self.report_timings)
+        self.channel.open()
         return self
 
+    @contextmanager
+    def phase(self, name):
+        """Time the body of the with statement as the connection phase with
+        the given name."""
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def record_phase(self, name, seconds):
+        ms = round(seconds * 1000)
+        self.timings.append((name, ms))
+        log.debug({"event": "client/phase", "client": self.name, "phase": name, "ms": ms})
+
+    def report_timings(self):
+        """Once the handshake is complete and every module the handshake
+        loads has loaded, print how long each phase of connecting took.
+
+        Only call on the reactor thread."""
+        if self.timings_reported or not self.handshake_complete or self.handshake_loads:
+            return
+
+        self.timings_reported = True
+        total = round((time.perf_counter() - self.connect_started) * 1000)
+        log.info({"event": "client/connected", "client": self.name, "ms": total, "phases": dict(self.timings)})
+        phases = ", ".join(f"{name} {ms} ms" for name, ms in self.timings)
+
+        self.recvq.put(edn.kwmap({
+            "tag": keywords.OUT,
+            "val": f"Connected in {total} ms ({phases}).\n"
+        }))
+
     def sink_until_prompt(self):
         bs = bytearray()
 
         while True:
-            bs.extend(self.socket.recv(1))
+            if not (b := self.socket.recv(1)):
+                raise ConnectionAbortedError("The REPL closed the connection before printing a prompt")
+
+            bs.extend(b)
 
             if bs[-3:] == bytearray(b"=> "):
                 break
 
         return bs
 
+    def readline(self):
+        """Read a single line from the socket.
+
+        Use during the handshake, before the client starts. Any bytes that
+        arrive after the line stay in the decoder's buffer for the client to
+        handle once it starts."""
+        while (line := self.decoder.readline()) is None:
+            if not (chunk := self.socket.recv(RECV_BUFFER_SIZE)):
+                return ""
+
+            self.decoder.feed(chunk)
+
+        return line
+
     def write_line(self, line):
-        self.buffer.write(line)
-        self.buffer.write("\n")
-        self.buffer.flush()
+        """Write a line to the socket.
+
+        Use during the handshake, before the client starts."""
+        self.socket.sendall((line + "\n").encode("utf-8"))
+
+    def write_lines(self, lines):
+        """Write lines to the socket in a single write.
+
+        Use during the handshake, before the client starts."""
+        self.socket.sendall("".join(line + "\n" for line in lines).encode("utf-8"))
+
+    def bootstrap(self, filenames, *lines):
+        """Given the file names of the modules the handshake needs, load every
+        module the REPL hasn't already loaded, then write the given lines.
+
+        Pipeline the writes: write all the forms that load modules at once
+        and only then read their results. Return the content hashes of the
+        modules the REPL had already loaded, and leave the results of the
+        given lines for the caller to read."""
+        start = time.perf_counter()
+        self.write_lines(BOOTSTRAP)
+
+        for _ in BOOTSTRAP[:-1]:
+            self.readline()
+
+        loaded = edn.read(self.readline()) or {}
+        loads = []
+
+        for filename in filenames:
+            path = self.source_path(filename)
+            content, hash = read_module(path)
+
+            if loaded.get(filename) != hash:
+                blob = base64.encode(content)
+                loads.append(f"""(load-base64 "{blob}" "{path}" "{filename}" "{hash}")""")
 
-    def module_loaded(self, response):
-        if response.get(edn.Keyword("result")) == edn.Keyword("ok"):
-            self.capabilities.add(response.get(edn.Keyword("filename")))
+        log.debug({"event": "client/bootstrap", "cached": sorted(loaded), "loads": len(loads)})
+        self.write_lines(loads + list(lines))
+
+        for _ in loads:
+            self.readline()
+
+        self.record_phase("bootstrap", time.perf_counter() - start)
+        return loaded
+
+    def module_loaded(self, filename, start, response):
+        """Given the file name of a module, the time the client started
+        loading it, and the response to loading it, record that the module has
+        loaded.
+
+        Only call on the reactor thread."""
+        self.record_phase(filename, time.perf_counter() - start)
+
+        with self.capabilities_lock:
+            if response.get(keywords.RESULT) == keywords.OK:
+                self.capabilities[filename] = LOADED
+            else:
+                self.capabilities.pop(filename, None)
+
+        if filename in self.handshake_loads:
+            self.handshake_loads.discard(filename)
+            self.report_timings()
 
     def load_modules(self, modules):
+        for filename, requires in modules.items():
+            path = os.path.join(self.source_root, filename)
+            content, hash = read_module(path)
+
+            with self.capabilities_lock:
+                if self.module_hashes.get(filename) == hash:
+                    self.capabilities[filename] = LOADED
+                else:
+                    self.capabilities[filename] = LOADING
+
+                    if not self.handshake_complete:
+                        self.handshake_loads.add(filename)
+
+                    self.backchannel.send({
+                        "op": keywords.LOAD_BASE64,
+                        "path": path,
+                        "filename": filename,
+                        "blob": base64.encode(content),
+                        "hash": hash,
+                        "requires": requires
+                    }, partial(self.reactor.call_soon, self.module_loaded, filename, time.perf_counter()))
+
+    def defer_modules(self, modules):
+        """Given a map of module file names to the namespaces they require,
+        mark the modules loadable, but don't load them until the client sends
+        the first backchannel op they provide (see DEFERRED_OPS).
+
+        If the REPL has already loaded the current version of a module,
+        there's nothing to defer."""
         for filename, requires in modules.items():
             path = os.path.join(self.source_root, filename)
 
-            with open(path, "rb") as file:
-                self.backchannel.send({
-                    "op": edn.Keyword("load-base64"),
-                    "path": path,
-                    "filename": filename,
-                    "blob": base64.encode(file.read()),
-                    "requires": requires
-                }, self.module_loaded)
+            hash = read_module(path)[1]
+
+            with self.capabilities_lock:
+                if self.module_hashes.get(filename) == hash:
+                    self.capabilities[filename] = LOADED
+                else:
+                    self.capabilities[filename] = LOADABLE
+                    self.deferred_modules[filename] = requires
+
+    def before_op(self, op):
+        """Given the name of a backchannel op, prepare for sending the op."""
+        if op in EVALUATING_OPS:
+            self.completions.invalidate()
+
+        self.load_deferred(op)
+
+    def ready(self, op):
+        """Given the name of a backchannel op the client loads on demand (see
+        DEFERRED_OPS), return True if the REPL has loaded the module that
+        provides the op.
+
+        If the client has deferred loading the module, start loading it, so
+        that the op is ready the next time."""
+        with self.capabilities_lock:
+            self.load_deferred(op)
+            return self.capabilities.get(DEFERRED_OPS.get(op)) == LOADED
+
+    def load_deferred(self, op):
+        """Given the name of a backchannel op, load the module that provides
+        the op if the client has deferred loading it.
+
+        The backchannel handles messages in the order it receives them, so
+        the op can follow the module straight away. Any thread can send an op,
+        so hold the capabilities lock until the module is queued: another
+        thread sending the same op waits for the module instead of
+        overtaking it."""
+        filename = DEFERRED_OPS.get(op)
+
+        if filename:
+            with self.capabilities_lock:
+                if self.capabilities.get(filename) == LOADABLE:
+                    log.debug({"event": "client/load-deferred", "op": op, "filename": filename})
+                    self.load_modules({filename: self.deferred_modules.pop(filename)})
 
     @abstractmethod
     def handshake(self):
         pass
 
     def probe(self):
-        # TODO: Configurable timeout?
-        self.executor.submit(self.sink_until_prompt).result(timeout=5)
+        self.socket.settimeout(PROBE_TIMEOUT)
+
+        try:
+            return self.sink_until_prompt()
+        except socket.timeout:
+            raise TimeoutError("Timed out waiting for the REPL prompt")
+        finally:
+            self.socket.settimeout(None)
 
     def connect(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
-        self.buffer = self.socket.makefile(mode="rw")
+        self.connect_started = time.perf_counter()
+
+        with self.phase("tcp"):
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.connect((self.host, self.port))
+
+        # The channel buffers anything sent before the client starts.
+        self.channel = self.reactor.channel(self.socket, self.recv, self.disconnected)
         log.debug({"event": "client/connect", "host": self.host, "port": self.port})
-        log.debug({"event": "client/handshake", "data": self.probe()})
+
+        with self.phase("probe"):
+            log.debug({"event": "client/handshake", "data": self.probe()})
+
         return self
 
-    def disconnect(self):
-        if self.socket is not None:
-            try:
-                self.buffer.close()
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
-                log.debug({"event": "client/disconnect"})
-            except OSError as e:
-                log.debug({"event": "error", "exception": e})
+    def disconnected(self):
+        self.recvq.put(edn.kwmap({
+            "tag": keywords.RET,
+            "val": ":tutkain/disconnected"
+        }))
+
+        # put a None into the queue to tell consumers to stop reading it.
+        self.recvq.put(None)
+
+        log.debug({"event": "client/disconnect"})
 
     def source_path(self, filename):
         return posixpath.join(pathlib.Path(self.source_root).as_posix(), filename)
 
-    def __init__(self, source_root, host, port, name, backchannel_opts={}):
+    def __init__(self, source_root, host, port, name, backchannel_opts={}, output_backlog=OUTPUT_BACKLOG, reactor=REACTOR):
         self.source_root = source_root
         self.host = host
         self.port = port
         self.name = name
-        self.sendq = queue.Queue()
-        self.recvq = queue.Queue()
-        self.printq = queue.Queue()
-        self.handlers = {}
+        self.reactor = reactor
+        self.socket = None
+        self.channel = None
+        self.printq = PrintQueue(output_backlog)
+        self.recvq = FormatQueue(self.format, self.printq)
+        self.decoder = edn.LineDecoder(on_error=self.decode_error)
+        # The tracker of the evaluations awaiting a response, shared with the
+        # backchannel.
+        self.tracker = Tracker(schedule=reactor.call_later)
+        # The REPL doesn't echo request ids, only the form it evaluated, so
+        # keep the ids of the evaluations of every form in the order they
+        # were sent. Only touched on the reactor thread.
+        self.pending = {}
         self.executor = ThreadPoolExecutor(thread_name_prefix=f"{self.name}")
         self.namespace = "user"
         self.backchannel = NoopBackchannel()
         self.backchannel_opts = backchannel_opts
-        self.capabilities = set()
+        # A map of the file name of every module the REPL can use to
+        # whether the module is loadable, loading, or loaded.
+        self.capabilities = {}
+        # A map of the file name of every module the client hasn't loaded yet
+        # to the namespaces the module requires.
+        self.deferred_modules = {}
+        # Guards capabilities and deferred_modules, which the thread that
+        # sends an op and the reactor thread both update. Reentrant, because
+        # loading a module sends an op.
+        self.capabilities_lock = RLock()
+        # The content hashes of the modules the REPL had already loaded
+        # before the handshake.
+        self.module_hashes = {}
+        # The name and the duration in milliseconds of every phase of
+        # connecting to the REPL, in the order they completed.
+        self.timings = []
+        self.connect_started = time.perf_counter()
+        # The modules the handshake loads over the backchannel that haven't
+        # loaded yet.
+        self.handshake_loads = set()
+        self.handshake_complete = False
+        self.timings_reported = False
+        # The :truncated map of the last evaluation result the REPL
+        # truncated, if any.
+        self.truncated = None
+        self.completions = CompletionCache()
+
+    def protocol_options(self):
+        """Return the wire protocol options to open the backchannel with as
+        EDN map entries."""
+        threshold = self.backchannel_opts.get("compression_threshold", COMPRESSION_THRESHOLD)
+
+        if threshold is None:
+            compression = ":compression :none"
+        else:
+            compression = f":compression :zlib :compression-threshold {int(threshold)}"
+
+        return f":framing :length-prefixed :encoding :json {compression}"
+
+    def open_backchannel(self, host, reply):
+        """Given the backchannel host and the server's reply to the request
+        to open the backchannel, connect to the backchannel using the wire
+        protocol the server agreed to."""
+        if reply.get(keywords.COMPRESSION) == keywords.ZLIB:
+            compression_threshold = reply.get(keywords.COMPRESSION_THRESHOLD, COMPRESSION_THRESHOLD)
+        else:
+            compression_threshold = None
+
+        with self.phase("backchannel"):
+            return Backchannel(
+                self,
+                host,
+                reply.get(keywords.PORT),
+                reply.get(keywords.FRAMING, keywords.NEWLINE),
+                reply.get(keywords.ENCODING, keywords.EDN),
+                compression_threshold,
+                reactor=self.reactor,
+                tracker=self.tracker
+            ).connect()
 
     def __enter__(self):
         self.connect()
         return self
 
-    def send_loop(self):
-        while item := self.sendq.get():
-            log.debug({"event": "client/send", "item": item})
-            self.buffer.write(item)
-            self.buffer.write("\n")
-            self.buffer.flush()
+    def send(self, code):
+        """Given a string of code, send it to the REPL."""
+        # Evaluating code can define or remove vars, or switch namespaces.
+        self.completions.invalidate()
+        self.reactor.call_soon(self.write, code)
 
-        log.debug({"event": "thread/exit"})
+    def write(self, code):
+        log.debug({"event": "client/send", "item": code})
+        self.channel.write((code + "\n").encode("utf-8"))
 
     @abstractmethod
     def eval(self, code, file="NO_SOURCE_FILE", line=0, column=0, handler=None):
@@ -118,42 +561,61 @@ class Client(ABC):
     def switch_namespace(self, ns):
         pass
 
+    def expect(self, code, handler):
+        """Given a string of code and a function, call the function with the
+        response to the evaluation of the code.
+
+        An evaluation can take any length of time, so the client waits for
+        the response indefinitely."""
+        id = self.tracker.track(handler, "eval", timeout=NO_DEADLINE)
+        self.reactor.call_soon(self.remember, code, id)
+
+    def remember(self, code, id):
+        self.pending.setdefault(code, collections.deque()).append(id)
+
     def handle(self, item):
-        if ns := item.get(edn.Keyword("ns")):
+        if ns := item.get(keywords.NS):
             self.namespace = ns
 
-        if (form := item.get(edn.Keyword("form"))) and (handler := self.handlers.get(form)):
-            try:
-                handler.__call__(item)
-            finally:
-                self.handlers.pop(form, None)
+        if item.get(keywords.TAG) == keywords.RET:
+            # Forget the last truncated result once the REPL returns another
+            # result, so that Expand Result never expands a stale one.
+            self.truncated = item.get(keywords.TRUNCATED)
+
+        if (form := item.get(keywords.FORM)) and (ids := self.pending.get(form)):
+            id = ids.popleft()
+
+            if not ids:
+                del self.pending[form]
+
+            handler = self.tracker.complete(id) or self.recvq.put
         else:
-            self.recvq.put(item)
+            handler = self.recvq.put
 
-    def recv_loop(self):
-        try:
-            while item := edn.read_line(self.buffer):
-                log.debug({"event": "client/recv", "item": item})
-                self.handle(item)
-        except OSError as error:
-            log.error({"event": "error", "error": error})
-        finally:
-            self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("ret"),
-                "val": ":tutkain/disconnected"
-            }))
+        # Put every response on the handler thread, even those that go
+        # straight to the print queue, so that responses print in the order
+        # they arrive.
+        self.reactor.call_handler(handler, item)
+
+    def decode_error(self, line, error):
+        log.error({"event": "error", "line": line, "error": error})
 
-            # put a None into the queue to tell consumers to stop reading it.
-            self.recvq.put(None)
+    def handle_decoded(self):
+        for item in self.decoder:
+            log.debug({"event": "client/recv", "item": item})
+            self.handle(item)
 
-            # Feed poison pill to input queue.
-            self.sendq.put(None)
+    def recv(self):
+        """Receive bytes from the socket and handle every response they
+        complete.
 
-            log.debug({"event": "thread/exit"})
+        Return False if the socket has reached its end."""
+        if not (chunk := self.socket.recv(RECV_BUFFER_SIZE)):
+            return False
 
-            # We've exited the loop that reads from the socket, so we can
-            # close the connection to the socket.
-            self.disconnect()
+        self.decoder.feed(chunk)
+        self.handle_decoded()
+        return True
 
     def format_form(self, form):
         if lines := cleandoc(form).splitlines():
@@ -172,23 +634,14 @@ class Client(ABC):
     def format(self, response):
         pass
 
-    def format_loop(self):
-        try:
-            log.debug({"event": "thread/start"})
-
-            while response := self.recvq.get():
-                log.debug({"event": "formatq/recv", "data": response})
-
-                if printable := self.format(response):
-                    self.printq.put({"printable": printable, "response": response})
-        finally:
-            self.printq.put(None)
-            log.debug({"event": "thread/exit"})
-
     def halt(self):
-        log.debug({"event": "client/halt"})
+        log.debug({"event": "client/halt", "requests": self.tracker.metrics()})
         self.recvq.put(None)
-        self.sendq.put(":repl/quit")
+
+        if self.channel is not None:
+            self.send(":repl/quit")
+            self.channel.close()
+
         self.executor.shutdown(wait=False)
 
     def __exit__(self, type, value, traceback):
@@ -197,57 +650,48 @@ class Client(ABC):
 
 class JVMClient(Client):
     def handshake(self):
-        self.write_line("(ns tutkain.bootstrap)")
-        self.buffer.readline()
-        self.write_line("(def load-base64 (let [decoder (java.util.Base64/getDecoder)] (fn [blob file filename] (with-open [reader (-> decoder (.decode blob) (java.io.ByteArrayInputStream.) (java.io.InputStreamReader.) (clojure.lang.LineNumberingPushbackReader.))] (clojure.lang.Compiler/load reader file filename)))))")
-        self.buffer.readline()
-
-        for filename in ["format.clj", "backchannel.clj", "repl.clj"]:
-            path = self.source_path(filename)
-
-            with open(path, "rb") as file:
-                blob = base64.encode(file.read())
-                self.write_line(f"""(load-base64 "{blob}" "{path}" "{os.path.basename(path)}")""")
-
-            self.buffer.readline()
-
         backchannel_port = self.backchannel_opts.get("port", 0)
         backchannel_bind_address = self.backchannel_opts.get("bind_address", "localhost")
-        self.write_line(f"""(try (tutkain.repl/repl {{:port {backchannel_port} :bind-address "{backchannel_bind_address}"}}) (catch Exception ex {{:tag :err :val (.toString ex)}}))""")
-        line = self.buffer.readline()
+
+        self.module_hashes = self.bootstrap(
+            ["format.clj", "json.clj", "backchannel.clj", "repl.clj"],
+            f"""(try (tutkain.repl/repl {{:port {backchannel_port} :bind-address "{backchannel_bind_address}" {self.protocol_options()}{self.result_budget_option()}}}) (catch Exception ex {{:tag :err :val (.toString ex)}}))"""
+        )
+
+        line = self.readline()
 
         if not line.startswith('{'):
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": "Couldn't connect to Clojure REPL."
             }))
 
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": line
             }))
 
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": "NOTE: Tutkain requires Clojure 1.10.0 or newer."
             }))
         else:
             ret = edn.read(line)
 
-            if (host := ret.get(edn.Keyword("host"))):
-                port = ret.get(edn.Keyword("port"))
-                self.backchannel = Backchannel(self, host, port).connect()
-            elif (val := edn.read(ret.get(edn.Keyword("val")))) and isinstance(val, dict):
-                host = val.get(edn.Keyword("host"))
-                port = val.get(edn.Keyword("port"))
-                self.backchannel = Backchannel(self, host, port).connect()
+            if (host := ret.get(keywords.HOST)):
+                self.backchannel = self.open_backchannel(host, ret)
+            elif (val := edn.read(ret.get(keywords.VAL))) and isinstance(val, dict):
+                self.backchannel = self.open_backchannel(val.get(keywords.HOST), val)
             else:
                 self.recvq.put(ret)
 
         self.load_modules({
             "lookup.clj": [],
-            "completions.clj": [],
             "load_blob.clj": [],
+        })
+
+        self.defer_modules({
+            "completions.clj": [],
             "test.clj": [],
             "analyzer.clj": [
                 edn.Symbol("clojure.tools.reader"),
@@ -255,14 +699,71 @@ class JVMClient(Client):
             ]
         })
 
-        self.write_line("""(println "Clojure" (clojure-version))""")
-        self.recvq.put(edn.read_line(self.buffer))
+        with self.phase("first prompt"):
+            self.write_line("""(println "Clojure" (clojure-version))""")
+            self.recvq.put(edn.read(self.readline()))
+
+        log.debug({"event": "client/handshake", "data": self.readline()})
+        self.start()
+
+    def __init__(
+        self,
+        source_root,
+        host,
+        port,
+        backchannel_opts={},
+        output_backlog=OUTPUT_BACKLOG,
+        result_budget=RESULT_BUDGET
+    ):
+        super().__init__(
+            source_root,
+            host,
+            port,
+            "tutkain.clojure.client",
+            backchannel_opts=backchannel_opts,
+            output_backlog=output_backlog
+        )
+
+        # The number of characters at which the REPL truncates evaluation
+        # results. If None, never truncate results.
+        self.result_budget = result_budget
+
+    def result_budget_option(self):
+        """Return the result budget option to start the REPL with as an EDN
+        map entry, or an empty string if the REPL has no result budget."""
+        if self.result_budget is None:
+            return ""
+
+        return f" :result-budget {int(self.result_budget)}"
+
+    def expand(self):
+        """Print the next page of the last evaluation result the REPL
+        truncated, continuing from the offset the REPL printed the previous
+        page up to.
+
+        Return False if there's no truncated result to expand."""
+        if (truncated := self.truncated) is None:
+            return False
 
-        log.debug({"event": "client/handshake", "data": self.buffer.readline()})
-        self.start_workers()
+        self.truncated = None
 
-    def __init__(self, source_root, host, port, backchannel_opts={}):
-        super().__init__(source_root, host, port, "tutkain.clojure.client", backchannel_opts=backchannel_opts)
+        self.backchannel.send({
+            "op": keywords.EXPAND,
+            "handle": truncated.get(keywords.HANDLE),
+            "offset": truncated.get(keywords.OFFSET)
+        }, self.expanded)
+
+        return True
+
+    def expanded(self, response):
+        if truncated := response.get(keywords.TRUNCATED):
+            self.truncated = truncated
+
+        self.recvq.put(edn.kwmap({
+            "tag": keywords.RET,
+            "val": response.get(keywords.VAL) or "",
+            "truncated": truncated
+        }))
 
     def connect(self):
         super().connect()
@@ -273,23 +774,32 @@ class JVMClient(Client):
 
     def switch_namespace(self, ns):
         code = f"(do (or (some->> '{ns} find-ns ns-name in-ns) (ns {ns})) (set! *3 *2) (set! *2 *1))"
-        self.handlers[code] = lambda _: None
-        self.sendq.put(code)
+        self.expect(code, lambda _: None)
+        self.send(code)
 
     def eval(self, code, file="NO_SOURCE_FILE", line=0, column=0, handler=None):
-        self.handlers[code] = handler or self.recvq.put
+        self.expect(code, handler or self.recvq.put)
+
+        # Send the eval context on the line before the code in a single write
+        # instead of waiting for the backchannel to set it, so that
+        # evaluations take one round trip and pipeline.
+        context = edn.dumps({
+            keywords.EVAL_CONTEXT: edn.kwmap({
+                "file": file,
+                "line": line + 1,
+                "column": column + 1
+            })
+        })
 
-        self.backchannel.send({
-            "op": edn.Keyword("set-eval-context"),
-            "file": file,
-            "line": line + 1,
-            "column": column + 1
-        }, lambda _: self.sendq.put(code))
+        self.send(f"{context}\n{code}")
 
     def format(self, response):
-        if form := response.get(edn.Keyword("in")):
+        if form := response.get(keywords.IN):
             return self.format_form(form)
-        elif val := response.get(edn.Keyword("val")):
+        elif response.get(keywords.TRUNCATED):
+            val = response.get(keywords.VAL)
+            return f"{val}\n… (truncated; use Tutkain: Expand Result to print more)\n"
+        elif val := response.get(keywords.VAL):
             return val
 
     def halt(self):
@@ -298,8 +808,8 @@ class JVMClient(Client):
 
 
 class JSClient(Client):
-    def __init__(self, source_root, host, port, prompt_for_build_id):
-        super().__init__(source_root, host, port, "tutkain.cljs.client")
+    def __init__(self, source_root, host, port, prompt_for_build_id, output_backlog=OUTPUT_BACKLOG):
+        super().__init__(source_root, host, port, "tutkain.cljs.client", output_backlog=output_backlog)
         self.prompt_for_build_id = prompt_for_build_id
 
     def connect(self):
@@ -307,7 +817,7 @@ class JSClient(Client):
         # Start a promptless REPL so that we don't need to keep sinking the prompt.
         self.write_line('(clojure.main/repl :prompt (constantly "") :need-prompt (constantly false))')
         self.write_line("""(sort (shadow.cljs.devtools.api/get-build-ids))""")
-        build_id_options = edn.read_line(self.buffer)
+        build_id_options = edn.read(self.readline())
 
         self.executor.submit(
             self.prompt_for_build_id,
@@ -318,28 +828,16 @@ class JSClient(Client):
         return self
 
     def handshake(self, build_id):
-        self.write_line("(ns tutkain.bootstrap)")
-        self.buffer.readline()
-        self.write_line("(def load-base64 (let [decoder (java.util.Base64/getDecoder)] (fn [blob file filename] (with-open [reader (-> decoder (.decode blob) (java.io.ByteArrayInputStream.) (java.io.InputStreamReader.) (clojure.lang.LineNumberingPushbackReader.))] (clojure.lang.Compiler/load reader file filename)))))")
-        self.buffer.readline()
-
-        for filename in ["format.clj", "backchannel.clj", "shadow.clj"]:
-            path = self.source_path(filename)
-
-            with open(path, "rb") as file:
-                blob = base64.encode(file.read())
-                self.write_line(f"""(load-base64 "{blob}" "{path}" "{os.path.basename(path)}")""")
-
-            self.buffer.readline()
-
         backchannel_port = self.backchannel_opts.get("port", 0)
-        self.write_line(f"""(try (tutkain.shadow/repl {{:build-id {build_id} :port {backchannel_port}}}) (catch Exception ex {{:tag :err :val (.toString ex)}}))""")
 
-        line = self.buffer.readline()
+        self.module_hashes = self.bootstrap(
+            ["format.clj", "json.clj", "backchannel.clj", "shadow.clj"],
+            f"""(try (tutkain.shadow/repl {{:build-id {build_id} :port {backchannel_port} {self.protocol_options()}}}) (catch Exception ex {{:tag :err :val (.toString ex)}}))"""
+        )
+
+        line = self.readline()
         val = edn.read(line)
-        host = val.get(edn.Keyword("host"))
-        port = val.get(edn.Keyword("port"))
-        self.backchannel = Backchannel(self, host, port).connect()
+        self.backchannel = self.open_backchannel(val.get(keywords.HOST), val)
 
         self.load_modules({
             "lookup.clj": [],
@@ -348,62 +846,66 @@ class JSClient(Client):
             "shadow.clj": [],
         })
 
-        self.write_line("""(println "ClojureScript" *clojurescript-version*)""")
-        line = self.buffer.readline()
+        with self.phase("first prompt"):
+            self.write_line("""(println "ClojureScript" *clojurescript-version*)""")
+            line = self.readline()
 
         if not line.startswith('{'):
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": "Couldn't connect to ClojureScript REPL. Here's why:"
             }))
 
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": line
             }))
 
             self.recvq.put(edn.kwmap({
-                "tag": edn.Keyword("err"),
+                "tag": keywords.ERR,
                 "val": "Is the shadow-cljs watch running for the build ID you chose?"
             }))
         else:
             ret = edn.read(line)
             self.handle(ret)
 
-            if ret.get(edn.Keyword("tag")) != edn.Keyword("err"):
-                self.handle(edn.read_line(self.buffer))
-                log.debug({"event": "client/handshake", "data": self.buffer.readline()})
+            if ret.get(keywords.TAG) != keywords.ERR:
+                self.handle(edn.read(self.readline()))
+                log.debug({"event": "client/handshake", "data": self.readline()})
 
-        self.start_workers()
+        self.start()
 
     def switch_namespace(self, ns):
         code = f"(in-ns '{ns})"
-        self.handlers[code] = lambda _: None
-        self.sendq.put(code)
+        self.expect(code, lambda _: None)
+        self.send(code)
 
     def eval(self, code, file="NO_SOURCE_FILE", line=0, column=0, handler=None):
-        self.handlers[code] = handler or self.recvq.put
-        self.sendq.put(code)
+        self.expect(code, handler or self.recvq.put)
+        self.send(code)
 
     def format(self, response):
-        if form := response.get(edn.Keyword("in")):
+        if form := response.get(keywords.IN):
             return self.format_form(form)
-        elif response.get(edn.Keyword("tag")) == edn.Keyword("out"):
-            return response.get(edn.Keyword("val"))
-        elif val := response.get(edn.Keyword("val")):
+        elif response.get(keywords.TAG) == keywords.OUT:
+            return response.get(keywords.VAL)
+        elif val := response.get(keywords.VAL):
             return val
 
 
 class BabashkaClient(Client):
-    def __init__(self, source_root, host, port):
-        super().__init__(source_root, host, port, "tutkain.bb.client")
+    def __init__(self, source_root, host, port, output_backlog=OUTPUT_BACKLOG):
+        super().__init__(source_root, host, port, "tutkain.bb.client", output_backlog=output_backlog)
 
     def handshake(self):
         self.write_line("""((requiring-resolve 'clojure.core.server/io-prepl))""")
-        self.write_line("""(println "Babashka" (System/getProperty "babashka.version"))""")
-        self.recvq.put(edn.read_line(self.buffer))
-        self.buffer.readline()
-        self.start_workers()
+
+        with self.phase("first prompt"):
+            self.write_line("""(println "Babashka" (System/getProperty "babashka.version"))""")
+            self.recvq.put(edn.read(self.readline()))
+
+        self.readline()
+        self.start()
 
     def connect(self):
         super().connect()
@@ -412,17 +914,17 @@ class BabashkaClient(Client):
 
     def switch_namespace(self, ns):
         code = f"(in-ns '{ns})"
-        self.handlers[code] = lambda _: None
-        self.sendq.put(code)
+        self.expect(code, lambda _: None)
+        self.send(code)
 
     def eval(self, code, file="NO_SOURCE_FILE", line=0, column=0, handler=None):
-        self.handlers[code] = handler or self.recvq.put
-        self.sendq.put(code)
+        self.expect(code, handler or self.recvq.put)
+        self.send(code)
 
     def format(self, response):
-        if form := response.get(edn.Keyword("in")):
+        if form := response.get(keywords.IN):
             return self.format_form(form)
-        elif response.get(edn.Keyword("tag")) == edn.Keyword("out"):
-            return response.get(edn.Keyword("val"))
-        elif val := response.get(edn.Keyword("val")):
+        elif response.get(keywords.TAG) == keywords.OUT:
+            return response.get(keywords.VAL)
+        elif val := response.get(keywords.VAL):
             return val + "\n"
@@ -0,0 +1,153 @@
+"""A client-side cache of auto-completion candidates.
+
+The server returns the candidates that fuzzily match a prefix, best match
+first (see tutkain.completions/score). Every candidate that matches a longer
+prefix also matches the shorter prefix, so once the client has every
+candidate for "ma", it can answer "map" and "mapc" without asking the server,
+by matching the cached candidates against the longer prefix.
+
+If the server returned only the best candidates for a prefix (see LIMIT), the
+cache can only answer for that exact prefix. The server ranks shorter
+candidates first, so narrowing a truncated response would silently drop every
+longer candidate that matches the longer prefix. The trade-off is that short
+prefixes with many candidates (like ":a") rarely hit the cache: the client
+asks the server again as the user types until the candidates fit in the
+limit.
+
+Evaluating code can add or remove vars, so the client invalidates the cache
+whenever it sends code to the REPL."""
+
+import collections
+
+from threading import Lock
+
+from ...api import edn
+from ..log import log
+
+
+CANDIDATE = edn.Keyword("candidate")
+
+# The maximum number of (namespace, dialect) pairs to keep candidates for.
+MAX_ENTRIES = 16
+
+# The default maximum number of candidates to ask the server for.
+LIMIT = 100
+
+
+def anchor(prefix):
+    """Given a prefix, return the part of the prefix every fuzzy candidate
+    must start with: any leading colons or dots, and the character after
+    them."""
+    n = len(prefix) - len(prefix.lstrip(":."))
+    return prefix[:n + 1]
+
+
+def matches(prefix, candidate):
+    """Given a prefix and a candidate string, return True if the candidate
+    fuzzily matches the prefix."""
+    start = anchor(prefix)
+
+    if not candidate.startswith(start):
+        return False
+
+    index = len(start)
+
+    for char in prefix[len(start):]:
+        index = candidate.find(char, index) + 1
+
+        if index == 0:
+            return False
+
+    return True
+
+
+def category(prefix):
+    """Given a prefix, return the category of candidates the server searches
+    for the prefix (see tutkain.completions/candidates).
+
+    Narrowing the candidates of a prefix locally is only correct if the
+    longer prefix is in the same category."""
+    if prefix.startswith(":"):
+        return ":"
+    elif prefix.startswith("."):
+        return "."
+    elif "/" in prefix and not prefix.startswith("/"):
+        return "/" + prefix.split("/")[0]
+    elif "." in prefix:
+        # The server ignores nested classes unless the prefix has a dollar
+        # sign.
+        return "$" if "$" in prefix else "."
+    else:
+        return None
+
+
+class Entry(object):
+    __slots__ = ("prefix", "candidates", "truncated")
+
+    def __init__(self, prefix, candidates, truncated):
+        self.prefix = prefix
+        self.candidates = list(candidates)
+        self.truncated = truncated
+
+
+class CompletionCache(object):
+    """Caches the auto-completion candidates of the last prefix the server
+    returned candidates for, per namespace and dialect.
+
+    The cache is thread-safe."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, ns, dialect, prefix, candidates, truncated=False):
+        """Given a namespace, a dialect, a prefix, the candidates the server
+        returned for the prefix, and whether the server left out some
+        candidates for the prefix, cache the candidates."""
+        entry = Entry(prefix, candidates, truncated)
+
+        with self.lock:
+            self.entries[(ns, dialect)] = entry
+            self.entries.move_to_end((ns, dialect))
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, ns, dialect, prefix):
+        """Given a namespace, a dialect, and a prefix, return the candidates
+        for the prefix, or None if the cache can't answer for the prefix."""
+        with self.lock:
+            entry = self.entries.get((ns, dialect))
+
+            if entry is None or not (prefix == entry.prefix or (
+                not entry.truncated
+                and prefix.startswith(entry.prefix)
+                and category(prefix) == category(entry.prefix)
+            )):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end((ns, dialect))
+
+        if prefix == entry.prefix:
+            return entry.candidates
+
+        # Keep the order the server ranked the candidates in for the shorter
+        # prefix; Sublime Text re-sorts the completions as the user types
+        # anyway.
+        return [
+            candidate for candidate in entry.candidates
+            if matches(prefix, candidate.get(CANDIDATE))
+        ]
+
+    def invalidate(self):
+        """Forget every cached candidate."""
+        with self.lock:
+            if self.entries:
+                log.debug({"event": "completions/invalidate", "hits": self.hits, "misses": self.misses})
+
+            self.entries.clear()
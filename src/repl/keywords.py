@@ -0,0 +1,62 @@
+"""Prebuilt EDN keywords for the keys and values of the Tutkain protocol.
+
+Keywords are interned, so these constants are the same objects the EDN
+reader returns. Using them avoids constructing a keyword for every
+lookup on the message-handling paths."""
+
+from ...api import edn
+
+
+# Keys
+
+COMPRESSION = edn.Keyword("compression")
+COMPRESSION_THRESHOLD = edn.Keyword("compression-threshold")
+DEBUG = edn.Keyword("debug")
+ENCODING = edn.Keyword("encoding")
+EXCEPTION = edn.Keyword("exception")
+FILENAME = edn.Keyword("filename")
+FORM = edn.Keyword("form")
+FRAMING = edn.Keyword("framing")
+HANDLE = edn.Keyword("handle")
+HOST = edn.Keyword("host")
+ID = edn.Keyword("id")
+IDS = edn.Keyword("ids")
+IN = edn.Keyword("in")
+NS = edn.Keyword("ns")
+OFFSET = edn.Keyword("offset")
+OP = edn.Keyword("op")
+PORT = edn.Keyword("port")
+RESULT = edn.Keyword("result")
+TAG = edn.Keyword("tag")
+TRUNCATED = edn.Keyword("truncated")
+VAL = edn.Keyword("val")
+
+# Values
+
+ERR = edn.Keyword("err")
+EVAL_CONTEXT = edn.Keyword("eval-context", "tutkain")
+OK = edn.Keyword("ok")
+OUT = edn.Keyword("out")
+RET = edn.Keyword("ret")
+TAP = edn.Keyword("tap")
+
+# Framings
+
+NEWLINE = edn.Keyword("newline")
+LENGTH_PREFIXED = edn.Keyword("length-prefixed")
+
+# Encodings
+
+EDN = edn.Keyword("edn")
+JSON = edn.Keyword("json")
+
+# Compressions
+
+NONE = edn.Keyword("none")
+ZLIB = edn.Keyword("zlib")
+
+# Ops
+
+CANCEL = edn.Keyword("cancel")
+EXPAND = edn.Keyword("expand")
+LOAD_BASE64 = edn.Keyword("load-base64")
@@ -1,8 +1,31 @@
+import os
+import queue
+import sublime
+import time
+
 from ..log import log
-from ...api import edn
+from . import keywords
 from . import tap
 
 
+# By default, append to views at most this many times per second.
+MAX_FRAME_RATE = 60
+
+# When a REPL view exceeds its scrollback limit, trim it down to this share
+# of the limit, so that trimming happens rarely and in large chunks.
+TRIM_TO = 0.75
+
+# The start of the line the REPL view prints before every evaluation result
+# (see Client.format_form).
+FORM_BOUNDARY = r"^\S+=> "
+
+# By default, rotate the scrollback log once it reaches this many bytes.
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+# By default, keep this many rotated scrollback logs.
+LOG_BACKUPS = 3
+
+
 def print_characters(view, characters):
     if characters is not None:
         view.run_command("append", {"characters": characters, "scroll_to_end": True})
@@ -16,28 +39,163 @@ def append_to_view(view, characters):
         view.run_command("move_to", {"to": "eof"})
 
 
-def print_loop(view, client):
+class Scrollback(object):
+    """The scrollback limit of a REPL view.
+
+    Given a maximum number of characters or lines (or both), trims the
+    oldest output in the view once the view exceeds either maximum.
+
+    Given the path to a log file, appends the output it trims to the log
+    file. Once the log file reaches log_max_bytes, renames it to path.1
+    (path.1 to path.2, and so on), keeping at most log_backups old logs."""
+
+    def __init__(
+        self,
+        max_characters=None,
+        max_lines=None,
+        log_path=None,
+        log_max_bytes=LOG_MAX_BYTES,
+        log_backups=LOG_BACKUPS
+    ):
+        self.max_characters = max_characters
+        self.max_lines = max_lines
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+
+    def trim_point(self, view):
+        """Given a REPL view, return the point up to which to trim the view,
+        or 0 if the view doesn't exceed the scrollback limit.
+
+        Trims at the start of an evaluation if possible, else at the start of
+        a line."""
+        size = view.size()
+
+        if self.max_characters and size > self.max_characters:
+            point = size - int(self.max_characters * TRIM_TO)
+        elif self.max_lines and (lines := view.rowcol(size)[0] + 1) > self.max_lines:
+            point = view.text_point(lines - int(self.max_lines * TRIM_TO), 0)
+        else:
+            return 0
+
+        if (region := view.find(FORM_BOUNDARY, point)) and region.begin() != -1:
+            return region.begin()
+        else:
+            return view.full_line(point).end()
+
+    def rotate(self):
+        for n in range(self.log_backups - 1, 0, -1):
+            if os.path.exists(f"{self.log_path}.{n}"):
+                os.replace(f"{self.log_path}.{n}", f"{self.log_path}.{n + 1}")
+
+        if self.log_backups > 0:
+            os.replace(self.log_path, f"{self.log_path}.1")
+        else:
+            os.remove(self.log_path)
+
+    def spill(self, characters):
+        """Given the characters trimmed from a REPL view, append them to the
+        scrollback log."""
+        data = characters.replace('⁣', '').encode("utf-8")
+
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) + len(data) > self.log_max_bytes:
+                self.rotate()
+
+            with open(self.log_path, "ab") as file:
+                file.write(data)
+        except OSError as error:
+            log.error({"event": "error", "error": error})
+
+    def trim(self, view):
+        """Given a REPL view, trim the oldest output in the view if the view
+        exceeds the scrollback limit."""
+        if point := self.trim_point(view):
+            if self.log_path:
+                self.spill(view.substr(sublime.Region(0, point)))
+
+            log.debug({"event": "printer/trim", "view": view.id(), "characters": point})
+            view.run_command("tutkain_trim_view", {"end": point})
+
+
+def printable(item):
+    """Given a print queue item, return its destination (either the REPL view
+    or the tap panel) and the characters to append to the destination."""
+    printable = item.get("printable")
+    tag = item.get("response").get(keywords.TAG)
+
+    if tag == keywords.TAP:
+        return keywords.TAP, printable
+    elif tag == keywords.ERR:
+        return None, '⁣⁣' + printable + '⁣⁣'
+    elif tag == keywords.OUT:
+        # Print U+2063 around stdout to prevent them from getting syntax highlighting.
+        #
+        # This is probably somewhat evil, but the performance is *so* much better than
+        # with view.add_regions.
+        return None, '⁣' + printable + '⁣'
+    else:
+        return None, printable
+
+
+def drain(printq):
+    """Given a print queue, wait for an item, then remove every item in the
+    queue without waiting.
+
+    Return the items and whether the queue is closed."""
+    items = [printq.get()]
+
+    while items[-1] is not None:
+        try:
+            items.append(printq.get(block=False))
+        except queue.Empty:
+            return items, False
+
+    return items[:-1], True
+
+
+def batch(items):
+    """Given print queue items, return the characters to append to the REPL
+    view and the characters to append to the tap panel."""
+    batches = {None: [], keywords.TAP: []}
+
+    for item in items:
+        destination, characters = printable(item)
+        batches[destination].append(characters)
+
+    return "".join(batches[None]), "".join(batches[keywords.TAP])
+
+
+def print_loop(view, client, max_frame_rate=MAX_FRAME_RATE, scrollback=None):
+    """Print the items in the print queue of the client.
+
+    Append everything in the print queue to the REPL view and the tap panel
+    in a single command each, at most max_frame_rate times per second.
+
+    Given a Scrollback, trim the REPL view after every append."""
+    frame = 1 / max_frame_rate if max_frame_rate else 0
+
     try:
         log.debug({"event": "thread/start"})
+        closed = False
 
-        while item := client.printq.get():
-            printable = item.get("printable")
-            response = item.get("response")
-            tag = response.get(edn.Keyword("tag"))
+        while not closed:
+            started = time.monotonic()
+            items, closed = drain(client.printq)
+            characters, tapped = batch(items)
 
-            if tag == edn.Keyword("tap"):
+            if tapped:
                 view.window().run_command("show_panel", {"panel": f"output.{tap.panel_name}"})
                 panel = view.window().find_output_panel(tap.panel_name)
-                append_to_view(panel, printable)
-            elif tag == edn.Keyword("err"):
-                append_to_view(view, '⁣⁣' + printable + '⁣⁣')
-            elif tag == edn.Keyword("out"):
-                # Print U+2063 around stdout to prevent them from getting syntax highlighting.
-                #
-                # This is probably somewhat evil, but the performance is *so* much better than
-                # with view.add_regions.
-                append_to_view(view, '⁣' + printable + '⁣')
-            else:
-                append_to_view(view, printable)
+                append_to_view(panel, tapped)
+
+            append_to_view(view, characters)
+
+            if scrollback and characters:
+                scrollback.trim(view)
+
+            # Let more items pile up until the next frame.
+            if (remaining := frame - (time.monotonic() - started)) > 0 and not closed:
+                time.sleep(remaining)
     finally:
         log.debug({"event": "thread/exit"})
@@ -0,0 +1,304 @@
+"""A single I/O thread for every REPL and backchannel connection.
+
+Instead of a send thread and a receive thread per socket, every connection
+registers its socket with the reactor. The reactor thread waits for any
+socket to become readable or writable, and calls back into the connection
+that owns the socket.
+
+Sockets are non-blocking. Every channel has a queue of outgoing bytes: a
+write sends as much as the socket accepts, and the reactor sends the rest
+once the socket becomes writable again.
+
+Channels are not thread-safe: only touch them on the reactor thread. To do
+something on the reactor thread from another thread, use Reactor.call_soon.
+Channel.send and Channel.close do that for you.
+
+Response handlers can be slow (they touch views, for one), so the reactor
+thread doesn't call them: Reactor.call_handler hands them to a separate
+handler thread, which calls them in the order they arrive."""
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import time
+
+from threading import Lock, Thread
+
+from ..log import log
+
+
+class Channel(object):
+    """A non-blocking socket the reactor reads from and writes to.
+
+    When the socket becomes readable, the reactor calls on_readable, which
+    must read from the socket and return False if the socket has reached its
+    end. When the channel closes, the reactor calls on_close."""
+
+    def __init__(self, reactor, socket, on_readable, on_close):
+        self.reactor = reactor
+        self.socket = socket
+        self.on_readable = on_readable
+        self.on_close = on_close
+        self.outgoing = collections.deque()
+        self.events = 0
+        self.registered = False
+        self.closing = False
+        self.closed = False
+
+    def open(self):
+        """Start reading from and writing to the socket."""
+        self.reactor.call_soon(self.register)
+        return self
+
+    def send(self, data):
+        """Given bytes, send them to the socket."""
+        self.reactor.call_soon(self.write, data)
+
+    def close(self):
+        """Close the channel once every pending write is complete."""
+        self.reactor.call_soon(self.close_gracefully)
+
+    def register(self):
+        if not self.closed:
+            self.socket.setblocking(False)
+            self.registered = True
+            self.reactor.channels.add(self)
+            self.flush()
+
+    def write(self, data):
+        if not self.closed:
+            self.outgoing.append(memoryview(data))
+            self.flush()
+
+    def close_gracefully(self):
+        self.closing = True
+        self.flush()
+
+    def flush(self):
+        """Send as much of the outgoing bytes as the socket accepts."""
+        if not self.registered or self.closed:
+            return
+
+        while self.outgoing:
+            data = self.outgoing[0]
+
+            try:
+                n = self.socket.send(data)
+            except BlockingIOError:
+                break
+            except OSError as error:
+                log.error({"event": "error", "error": error})
+                self.shutdown()
+                return
+
+            if n < len(data):
+                self.outgoing[0] = data[n:]
+                break
+            else:
+                self.outgoing.popleft()
+
+        if self.closing and not self.outgoing:
+            self.shutdown()
+        else:
+            self.listen(selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outgoing else 0))
+
+    def listen(self, events):
+        if events != self.events:
+            if self.events:
+                self.reactor.selector.modify(self.socket, events, self)
+            else:
+                self.reactor.selector.register(self.socket, events, self)
+
+            self.events = events
+
+    def readable(self):
+        try:
+            if not self.on_readable():
+                self.shutdown()
+        except BlockingIOError:
+            pass
+        except OSError as error:
+            log.error({"event": "error", "error": error})
+            self.shutdown()
+
+    def ready(self, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush()
+
+        if events & selectors.EVENT_READ and not self.closed:
+            self.readable()
+
+    def shutdown(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.outgoing.clear()
+        self.reactor.channels.discard(self)
+
+        if self.events:
+            self.reactor.selector.unregister(self.socket)
+            self.events = 0
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.socket.close()
+        self.on_close()
+
+
+# The number of seconds Reactor.stop waits for channels to send their
+# pending writes before closing them anyway.
+STOP_TIMEOUT = 1
+
+
+class Reactor(object):
+    """Multiplexes every channel on a single thread.
+
+    The thread starts when the first channel opens."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # Every channel registered with the selector. Only touched on the
+        # reactor thread.
+        self.channels = set()
+        self.handlers = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tutkain.handlers")
+        self.calls = collections.deque()
+        # A heap of (time, sequence number, function, arguments) tuples.
+        self.timers = []
+        self.timer_sequence = itertools.count()
+        self.lock = Lock()
+        self.thread = None
+        self.running = False
+        self.stopping = False
+        # A pair of connected sockets for waking up the reactor thread when
+        # another thread wants the reactor to do something.
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ)
+
+    def channel(self, socket, on_readable, on_close):
+        """Given a connected socket and the callbacks of a channel, return a
+        new channel for the socket.
+
+        Call the open method of the channel to start reading from it."""
+        self.start()
+        return Channel(self, socket, on_readable, on_close)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.running = True
+                self.stopping = False
+                self.thread = Thread(daemon=True, target=self.run)
+                self.thread.name = "tutkain.reactor"
+                self.thread.start()
+
+    def stop(self):
+        """Stop the reactor thread once every pending call is complete.
+
+        Close every channel once it has sent its pending writes, or after
+        STOP_TIMEOUT seconds, whichever comes first."""
+        self.call_soon(self.halt)
+
+    def halt(self):
+        self.stopping = True
+
+        for channel in list(self.channels):
+            channel.close_gracefully()
+
+        self.call_later(STOP_TIMEOUT, self.force_stop)
+
+    def force_stop(self):
+        if self.stopping:
+            for channel in list(self.channels):
+                channel.shutdown()
+
+            self.running = False
+
+    def call_soon(self, f, *args):
+        """Given a function and its arguments, call the function on the
+        reactor thread."""
+        self.calls.append((f, args))
+
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            # The reactor thread has plenty of wakeup calls to handle already.
+            pass
+
+    def call_later(self, delay, f, *args):
+        """Given a delay in seconds, a function, and its arguments, call the
+        function on the reactor thread once the delay has passed."""
+        timer = (time.monotonic() + delay, next(self.timer_sequence), f, args)
+        self.call_soon(heapq.heappush, self.timers, timer)
+
+    def call_handler(self, f, *args):
+        """Given a response handler and its arguments, call the handler on
+        the handler thread."""
+        self.handlers.submit(self.run_handler, f, args)
+
+    def run_handler(self, f, args):
+        try:
+            f(*args)
+        except Exception as error:
+            log.error({"event": "error", "error": error})
+
+    def run_timers(self):
+        now = time.monotonic()
+
+        while self.timers and self.timers[0][0] <= now:
+            _, _, f, args = heapq.heappop(self.timers)
+
+            try:
+                f(*args)
+            except Exception as error:
+                log.error({"event": "error", "error": error})
+
+    def timeout(self):
+        """Return the number of seconds until the next timer is due, or None
+        if there are no timers."""
+        if self.timers:
+            return max(0, self.timers[0][0] - time.monotonic())
+
+    def run_calls(self):
+        for _ in range(len(self.calls)):
+            f, args = self.calls.popleft()
+
+            try:
+                f(*args)
+            except Exception as error:
+                log.error({"event": "error", "error": error})
+
+    def run(self):
+        log.debug({"event": "thread/start"})
+
+        try:
+            while self.running and not (self.stopping and not self.channels):
+                for key, events in self.selector.select(self.timeout()):
+                    if key.fileobj is self.wakee:
+                        try:
+                            while self.wakee.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        try:
+                            key.data.ready(events)
+                        except Exception as error:
+                            log.error({"event": "error", "error": error})
+
+                self.run_calls()
+                self.run_timers()
+        finally:
+            log.debug({"event": "thread/exit"})
+
+
+# The reactor every connection shares.
+REACTOR = Reactor()
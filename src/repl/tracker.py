@@ -0,0 +1,222 @@
+"""Track in-flight requests to a REPL or a backchannel.
+
+The tracker gives every request an id and remembers the handler that
+handles the response to the request. Every request has a deadline. If the
+response doesn't arrive before the deadline, the tracker evicts the request,
+so that handlers for responses that never arrive don't pile up. Requests
+that evaluate code can legitimately run for any length of time, so they have
+no deadline (see NO_DEADLINE).
+
+The tracker also counts the requests in flight and records the latency of
+every completed request in a histogram per kind of request (for example,
+the backchannel op)."""
+
+import bisect
+import itertools
+import math
+import time
+
+from threading import Lock
+
+from ..log import log
+
+
+# By default, evict requests that haven't completed in this many seconds.
+DEFAULT_TIMEOUT = 600
+
+# The timeout of a request the tracker never evicts.
+NO_DEADLINE = math.inf
+
+# The upper bounds of the latency histogram buckets, in milliseconds.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram(object):
+    """A latency histogram with fixed buckets."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket counts everything above the largest bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.sum += ms
+
+    def percentile(self, p):
+        """Given a percentile between 0 and 100, return the upper bound of the
+        bucket the percentile falls into, or None if the histogram is empty.
+
+        If the percentile falls above the largest bound, return infinity."""
+        if not self.count:
+            return None
+
+        rank = p / 100 * self.count
+        seen = 0
+
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+
+            if seen >= rank:
+                return bound
+
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": dict(zip(list(self.bounds) + ["+inf"], self.counts)),
+        }
+
+
+class Request(object):
+    __slots__ = ("id", "kind", "handler", "on_timeout", "started", "deadline")
+
+    def __init__(self, id, kind, handler, on_timeout, started, deadline):
+        self.id = id
+        self.kind = kind
+        self.handler = handler
+        self.on_timeout = on_timeout
+        self.started = started
+        self.deadline = deadline
+
+
+class Tracker(object):
+    """Tracks in-flight requests.
+
+    Given a schedule function like Reactor.call_later, the tracker uses it to
+    evict every request as soon as its deadline passes. Otherwise, call
+    expire to evict expired requests.
+
+    The tracker is thread-safe."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, schedule=None, clock=time.monotonic):
+        self.timeout = timeout
+        self.schedule = schedule
+        self.clock = clock
+        self.lock = Lock()
+        self.ids = itertools.count(1)
+        self.requests = {}
+        self.histograms = {}
+        self.completed = 0
+        self.expired = 0
+        self.cancelled = 0
+
+    def track(self, handler, kind=None, timeout=None, on_timeout=None):
+        """Given a function that handles the response to a request, start
+        tracking the request and return its id.
+
+        Optionally, give the kind of the request, the number of seconds to
+        wait for the response, and a function to call with the id of the
+        request if the response doesn't arrive in time."""
+        timeout = self.timeout if timeout is None else timeout
+        now = self.clock()
+
+        with self.lock:
+            id = next(self.ids)
+            self.requests[id] = Request(id, kind, handler, on_timeout, now, now + timeout)
+
+        if self.schedule and timeout != NO_DEADLINE:
+            self.schedule(timeout, self.expire)
+
+        return id
+
+    def next_id(self):
+        """Return a new request id without tracking a request."""
+        with self.lock:
+            return next(self.ids)
+
+    def complete(self, id):
+        """Given the id of a request, stop tracking the request.
+
+        Return the handler of the request, or None if the tracker isn't
+        tracking a request with the id (for example, because the request
+        expired)."""
+        with self.lock:
+            request = self.requests.pop(id, None)
+
+            if request is None:
+                return None
+
+            self.completed += 1
+            histogram = self.histograms.get(request.kind)
+
+            if histogram is None:
+                histogram = self.histograms[request.kind] = Histogram()
+
+            histogram.record((self.clock() - request.started) * 1000)
+
+        return request.handler
+
+    def tracking(self, id):
+        """Given the id of a request, return True if the tracker is tracking
+        a request with the id."""
+        with self.lock:
+            return id in self.requests
+
+    def cancel(self, id):
+        """Given the id of a request, stop tracking the request without
+        waiting for its response.
+
+        Return True if the tracker was tracking a request with the id."""
+        with self.lock:
+            if self.requests.pop(id, None) is None:
+                return False
+
+            self.cancelled += 1
+            return True
+
+    def expire(self):
+        """Evict every request whose deadline has passed.
+
+        Return the number of requests evicted."""
+        now = self.clock()
+
+        with self.lock:
+            expired = [request for request in self.requests.values() if request.deadline <= now]
+
+            for request in expired:
+                del self.requests[request.id]
+
+            self.expired += len(expired)
+
+        for request in expired:
+            log.debug({"event": "request/timeout", "id": request.id, "kind": request.kind})
+
+            if request.on_timeout:
+                request.on_timeout(request.id)
+
+        return len(expired)
+
+    def in_flight(self, kind=None):
+        """Return the number of requests in flight.
+
+        Given a kind of request, return the number of requests of that kind
+        in flight."""
+        with self.lock:
+            if kind is None:
+                return len(self.requests)
+            else:
+                return sum(1 for request in self.requests.values() if request.kind == kind)
+
+    def metrics(self):
+        """Return the request metrics as a dict."""
+        with self.lock:
+            in_flight = {}
+
+            for request in self.requests.values():
+                in_flight[request.kind] = in_flight.get(request.kind, 0) + 1
+
+            return {
+                "in_flight": in_flight,
+                "completed": self.completed,
+                "expired": self.expired,
+                "cancelled": self.cancelled,
+                "latency": {kind: histogram.to_dict() for kind, histogram in self.histograms.items()},
+            }
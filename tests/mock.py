@@ -3,6 +3,7 @@ import queue
 from concurrent import futures
 
 from Tutkain.api import edn
+from Tutkain.src.repl.client import BOOTSTRAP, read_module
 
 
 class Server(object):
@@ -51,3 +52,46 @@ class Server(object):
 
     def __exit__(self, type, value, traceback):
         self.stop()
+
+
+def bootstrap(server, client, filenames, cached=()):
+    """Given a mock REPL server, a client, the file names of the modules the
+    client bootstraps, and the file names of the modules the REPL has already
+    loaded, play the REPL's part in the bootstrap phase of the
+    handshake (see Client.bootstrap).
+
+    The client writes every bootstrap form at once, and then a load-base64
+    form for every module the REPL hasn't loaded the current version of."""
+    for form in BOOTSTRAP:
+        assert server.recv() == form + "\n"
+
+    server.send(None)
+    server.send(edn.Symbol("#'tutkain.bootstrap/hashes"))
+    server.send(edn.Symbol("#'tutkain.bootstrap/load-base64"))
+    server.send(edn.Symbol("#'tutkain.bootstrap/module-hashes"))
+    server.send({filename: read_module(client.source_path(filename))[1] for filename in cached})
+
+    loads = [filename for filename in filenames if filename not in cached]
+
+    for filename in loads:
+        line = server.recv()
+        assert line.startswith("(load-base64 ") and f'"{filename}"' in line, line
+
+    for filename in loads:
+        server.send(filename)
+
+
+def load_modules(backchannel, filenames):
+    """Given a mock backchannel server and the file names of the modules a
+    client loads over the backchannel, assert that the client loads them, and
+    respond that they loaded."""
+    for filename in filenames:
+        request = edn.read(backchannel.recv())
+        assert request.get(edn.Keyword("op")) == edn.Keyword("load-base64"), request
+        assert request.get(edn.Keyword("filename")) == filename, request
+
+        backchannel.send(edn.kwmap({
+            "id": request.get(edn.Keyword("id")),
+            "filename": filename,
+            "result": edn.Keyword("ok")
+        }))
@@ -0,0 +1,233 @@
+import queue
+import socket
+import zlib
+
+from unittest import TestCase
+
+from Tutkain.api import edn
+from Tutkain.src.repl import keywords
+from Tutkain.src.repl.backchannel import COMPRESSED, FRAME_HEADER, Backchannel, FrameReader, frame
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.recvq = queue.Queue()
+
+    def before_op(self, op):
+        pass
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.items = []
+
+    def write(self, data):
+        self.items.append(edn.read(data.decode("utf-8")))
+
+
+class DeferredReactor(object):
+    """A reactor that runs calls when told to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def call_soon(self, f, *args):
+        self.calls.append((f, args))
+
+    def call_later(self, delay, f, *args):
+        pass
+
+    def call_handler(self, f, *args):
+        f(*args)
+
+    def run_calls(self):
+        calls, self.calls = self.calls, []
+
+        for f, args in calls:
+            f(*args)
+
+
+class TestBackchannel(TestCase):
+    def test_frame_reader(self):
+        left, right = socket.socketpair()
+
+        try:
+            payloads = [b"", b"a", "äö".encode("utf-8"), b"x" * 100, b"y" * 1000, b"z" * 10]
+            data = b"".join(map(frame, payloads))
+            reader = FrameReader(right, size=16)
+            received = []
+
+            # Send the frames a few bytes at a time so that the reader has to
+            # put frames together from many chunks and grow its buffer.
+            for i in range(0, len(data), 7):
+                left.sendall(data[i:i + 7])
+                reader.recv()
+
+                for flags, payload in reader:
+                    self.assertEqual(0, flags)
+                    received.append(bytes(payload))
+
+            left.close()
+
+            while reader.recv():
+                for _, payload in reader:
+                    received.append(bytes(payload))
+
+            self.assertEqual(payloads, received)
+        finally:
+            left.close()
+            right.close()
+
+    def test_length_prefixed(self):
+        left, right = socket.socketpair()
+        client = FakeClient()
+        backchannel = Backchannel(client, "localhost", 0, keywords.LENGTH_PREFIXED)
+        backchannel.socket = right
+
+        try:
+            message = edn.kwmap({"op": edn.Keyword("echo"), "id": 1})
+            self.assertEqual(frame(edn.dumps(message).encode("utf-8")), backchannel.encode(message))
+
+            responses = [edn.read(":ret"), edn.kwmap({"val": "äö" * 10000, "exception": True})]
+
+            for response in responses:
+                left.sendall(frame(edn.dumps(response).encode("utf-8")))
+
+            left.close()
+            while backchannel.recv():
+                pass
+
+            self.assertEqual(responses[0], client.recvq.get(timeout=1))
+            self.assertEqual(responses[1], client.recvq.get(timeout=1))
+        finally:
+            left.close()
+            right.close()
+
+    def test_json(self):
+        left, right = socket.socketpair()
+        client = FakeClient()
+        backchannel = Backchannel(client, "localhost", 0, keywords.LENGTH_PREFIXED, keywords.JSON)
+        backchannel.socket = right
+
+        try:
+            message = edn.kwmap({"op": edn.Keyword("echo"), "id": 1})
+            self.assertEqual(frame(b'{"~:op":{"~:":"echo"},"~:id":1}'), backchannel.encode(message))
+
+            left.sendall(frame('{"~:val": "äö", "~:exception": true}'.encode("utf-8")))
+            left.close()
+            while backchannel.recv():
+                pass
+
+            self.assertEqual(edn.kwmap({"val": "äö", "exception": True}), client.recvq.get(timeout=1))
+        finally:
+            left.close()
+            right.close()
+
+    def test_compression(self):
+        left, right = socket.socketpair()
+        client = FakeClient()
+        backchannel = Backchannel(client, "localhost", 0, keywords.LENGTH_PREFIXED, keywords.EDN, 64)
+        backchannel.socket = right
+
+        try:
+            small = edn.kwmap({"op": edn.Keyword("echo"), "id": 1})
+            self.assertEqual(frame(edn.dumps(small).encode("utf-8")), backchannel.encode(small))
+
+            large = edn.kwmap({"op": edn.Keyword("echo"), "id": 2, "s": "x" * 1000})
+            payload = edn.dumps(large).encode("utf-8")
+            data = backchannel.encode(large)
+            flags, _ = FRAME_HEADER.unpack_from(data)
+            self.assertEqual(COMPRESSED, flags)
+            self.assertEqual(payload, zlib.decompress(data[FRAME_HEADER.size:]))
+
+            self.assertEqual(len(edn.dumps(small).encode("utf-8")) + len(payload), backchannel.byte_counts["sent"])
+            self.assertLess(backchannel.byte_counts["sent_wire"], backchannel.byte_counts["sent"])
+
+            response = edn.kwmap({"val": "äö" * 1000, "exception": True})
+            left.sendall(frame(zlib.compress(edn.dumps(response).encode("utf-8")), COMPRESSED))
+            left.close()
+            while backchannel.recv():
+                pass
+
+            self.assertEqual(response, client.recvq.get(timeout=1))
+            self.assertEqual(len(edn.dumps(response).encode("utf-8")), backchannel.byte_counts["received"])
+            self.assertLess(backchannel.byte_counts["received_wire"], backchannel.byte_counts["received"])
+        finally:
+            left.close()
+            right.close()
+
+    def test_drop_stale(self):
+        for encoding, stale, exception, fresh in [
+            (keywords.EDN, b'{:id 99, :val (', b'{:id 98, :exception true, :val "x"}', '{:id %d, :val "x"}'),
+            (keywords.JSON, b'{"~:id":99,"~:val":[', b'{"~:id":98,"~:exception":true,"~:val":"x"}', '{"~:id":%d,"~:val":"x"}'),
+        ]:
+            left, right = socket.socketpair()
+            client = FakeClient()
+            backchannel = Backchannel(client, "localhost", 0, keywords.LENGTH_PREFIXED, encoding, reactor=DeferredReactor())
+            backchannel.socket = right
+            responses = []
+
+            try:
+                id = backchannel.tracker.track(responses.append)
+
+                # The backchannel drops a response to a request it doesn't
+                # track without decoding it, but still prints an exception.
+                left.sendall(frame(stale))
+                left.sendall(frame(zlib.compress(stale + b" " * 1000), COMPRESSED))
+                left.sendall(frame(exception))
+                left.sendall(frame((fresh % id).encode("utf-8")))
+                left.close()
+                while backchannel.recv():
+                    pass
+
+                self.assertEqual([edn.kwmap({"id": id, "val": "x"})], responses)
+                self.assertEqual(edn.kwmap({"id": 98, "exception": True, "val": "x"}), client.recvq.get(timeout=1))
+            finally:
+                left.close()
+                right.close()
+
+    def test_no_deadline(self):
+        backchannel = Backchannel(FakeClient(), "localhost", 0, reactor=DeferredReactor())
+        backchannel.tracker.timeout = 0
+        backchannel.send({"op": edn.Keyword("test")}, lambda _: None)
+        backchannel.send({"op": edn.Keyword("lookup")}, lambda _: None)
+
+        # Ops that evaluate code never expire; other ops do.
+        self.assertEqual(1, backchannel.tracker.expire())
+        self.assertEqual(1, backchannel.tracker.in_flight("test"))
+
+    def test_supersede(self):
+        reactor = DeferredReactor()
+        backchannel = Backchannel(FakeClient(), "localhost", 0, reactor=reactor)
+        backchannel.channel = FakeChannel()
+        responses = []
+
+        def completions(prefix):
+            backchannel.send({"op": edn.Keyword("completions"), "prefix": prefix}, responses.append, group="completions")
+
+        # The backchannel drops requests a newer request supersedes before it
+        # sends them.
+        completions("a")
+        completions("ab")
+        reactor.run_calls()
+
+        [item] = backchannel.channel.items
+        self.assertEqual("ab", item.get(edn.Keyword("prefix")))
+        ab = item.get(keywords.ID)
+
+        # The backchannel tells the server to cancel requests a newer request
+        # supersedes after it sends them.
+        completions("abc")
+        reactor.run_calls()
+
+        cancel, item = backchannel.channel.items[1:]
+        self.assertEqual(keywords.CANCEL, cancel.get(keywords.OP))
+        self.assertEqual([ab], cancel.get(keywords.IDS))
+        abc = item.get(keywords.ID)
+
+        # The backchannel drops the responses to superseded requests.
+        backchannel.handle(edn.kwmap({"id": ab, "completions": []}))
+        backchannel.handle(edn.kwmap({"id": abc, "completions": []}))
+        self.assertEqual([edn.kwmap({"id": abc, "completions": []})], responses)
+        self.assertEqual(0, backchannel.tracker.in_flight())
+        self.assertEqual({}, backchannel.sent)
@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
+import queue
+import socket
 
 from Tutkain.api import edn
 from Tutkain.package import source_root, start_logging, stop_logging
-from Tutkain.src.repl.client import JVMClient
+from Tutkain.src.repl import keywords
+from Tutkain.src.repl.client import LOADABLE, LOADED, BabashkaClient, JVMClient, PrintQueue, read_module
 
-from .mock import Server
+from .mock import Server, bootstrap
 
 
 class TestJVMClient(TestCase):
@@ -28,23 +32,17 @@ class TestJVMClient(TestCase):
             # Client starts clojure.main/repl
             server.recv()
 
-            # Client switches into the bootstrap namespace
-            server.recv()
-            server.send("nil\n")
-
-            # Client defines load-base64 function
-            server.recv()
-            server.send("#'tutkain.bootstrap/load-base64\n")
-
-            # Client loads modules
-            server.recv()
-            server.send("#'tutkain.format/pp-str")
-            server.recv()
-            server.send("#'tutkain.backchannel/open")
-            server.recv()
-            server.send("#'tutkain.repl/repl")
-            server.recv()
+            # Client sends the bootstrap forms at once. The REPL has already
+            # loaded the current version of format.clj, so the client loads
+            # the other modules and starts the REPL in a single write.
+            bootstrap(
+                server,
+                client,
+                ["format.clj", "json.clj", "backchannel.clj", "repl.clj"],
+                cached=["format.clj"]
+            )
 
+            self.assertTrue(server.recv().startswith("(try (tutkain.repl/repl "))
 
             with Server() as backchannel:
                 server.send(
@@ -54,10 +52,20 @@ class TestJVMClient(TestCase):
                     })
                 )
 
-                for filename in ["lookup.clj", "completions.clj", "load_blob.clj", "test.clj", "analyzer.clj"]:
+                for filename in ["lookup.clj", "load_blob.clj"]:
                     response = edn.read(backchannel.recv())
                     self.assertEquals(edn.Keyword("load-base64"), response.get(edn.Keyword("op")))
                     self.assertEquals(filename, response.get(edn.Keyword("filename")))
+                    self.assertEquals(
+                        read_module(client.source_path(filename))[1],
+                        response.get(edn.Keyword("hash"))
+                    )
+
+                    backchannel.send(edn.kwmap({
+                        "id": response.get(edn.Keyword("id")),
+                        "filename": filename,
+                        "result": edn.Keyword("ok")
+                    }))
 
                 self.assertEquals(
                     """(println "Clojure" (clojure-version))""",
@@ -77,36 +85,58 @@ class TestJVMClient(TestCase):
                     edn.Keyword("form"): """(println "Clojure" (clojure-version))"""
                 })
 
-                self.assertEquals({
-                    "printable": "Clojure 1.11.0-alpha1",
-                    "response": {
-                        edn.Keyword("tag"): edn.Keyword("out"),
-                        edn.Keyword("val"): "Clojure 1.11.0-alpha1"
-                    }
-                }, client.printq.get(timeout=1))
+                # Once every module has loaded, the client prints how long
+                # each phase of connecting took. The print queue merges the
+                # output if the printer hasn't printed the version yet.
+                printed = ""
 
-                client.eval("(inc 1)")
+                while "Connected in " not in printed:
+                    item = client.printq.get(timeout=1)
+                    self.assertEquals(edn.Keyword("out"), item["response"].get(edn.Keyword("tag")))
+                    printed += item["printable"]
 
-                response = edn.read(backchannel.recv())
-                id = response.get(edn.Keyword("id"))
+                version, report = printed.split("Connected in ")
+                self.assertEquals("Clojure 1.11.0-alpha1", version)
+
+                for phase in ["tcp", "probe", "bootstrap", "backchannel", "lookup.clj", "load_blob.clj", "first prompt"]:
+                    self.assertIn(f"{phase} ", report)
 
                 self.assertEquals(
-                    edn.kwmap({
-                        "op": edn.Keyword("set-eval-context"),
-                        "id": id,
-                        "file": "NO_SOURCE_FILE",
-                        "line": 1,
-                        "column": 1
-                    }),
-                    response
+                    ["tcp", "probe", "bootstrap", "backchannel"],
+                    [name for name, _ in client.timings[:4]]
+                )
+
+                self.assertEquals("loadable", client.capabilities["analyzer.clj"])
+
+                # The first op of a deferred module loads the module first
+                client.backchannel.send({"op": edn.Keyword("locals")})
+
+                response = edn.read(backchannel.recv())
+                self.assertEquals(edn.Keyword("load-base64"), response.get(edn.Keyword("op")))
+                self.assertEquals("analyzer.clj", response.get(edn.Keyword("filename")))
+                self.assertEquals(
+                    [edn.Symbol("clojure.tools.reader"), edn.Symbol("clojure.tools.analyzer.jvm")],
+                    response.get(edn.Keyword("requires"))
                 )
 
-                backchannel.send(edn.kwmap({
-                    "id": id,
-                    "file": None,
-                    "ns": edn.Symbol("user"),
-                    "dialect": edn.Keyword("clj")
-                }))
+                self.assertEquals(edn.Keyword("locals"), edn.read(backchannel.recv()).get(edn.Keyword("op")))
+                self.assertEquals("loading", client.capabilities["analyzer.clj"])
+
+                client.backchannel.send({"op": edn.Keyword("locals")})
+                self.assertEquals(edn.Keyword("locals"), edn.read(backchannel.recv()).get(edn.Keyword("op")))
+
+                client.eval("(inc 1)")
+
+                self.assertEquals(
+                    {
+                        edn.Keyword("eval-context", "tutkain"): edn.kwmap({
+                            "file": "NO_SOURCE_FILE",
+                            "line": 1,
+                            "column": 1
+                        })
+                    },
+                    edn.read(server.recv())
+                )
 
                 self.assertEquals("(inc 1)\n", server.recv())
 
@@ -127,3 +157,232 @@ class TestJVMClient(TestCase):
 
             client.halt()
             self.assertEquals(":repl/quit\n", server.recv())
+
+
+class ImmediateReactor(object):
+    def call_soon(self, f, *args):
+        f(*args)
+
+    def call_later(self, delay, f, *args):
+        pass
+
+    def call_handler(self, f, *args):
+        f(*args)
+
+
+class TestClientHandlers(TestCase):
+    def test_same_form(self):
+        client = BabashkaClient(source_root(), "localhost", 0)
+        client.reactor = ImmediateReactor()
+        responses = []
+
+        # Evaluating the same form twice must not overwrite the first handler.
+        client.expect("(inc 1)", lambda response: responses.append(("a", response)))
+        client.expect("(inc 1)", lambda response: responses.append(("b", response)))
+        self.assertEqual(2, client.tracker.in_flight("eval"))
+
+        response = edn.kwmap({"tag": keywords.RET, "val": "2", "form": "(inc 1)"})
+        client.handle(response)
+        client.handle(response)
+
+        self.assertEqual([("a", response), ("b", response)], responses)
+        self.assertEqual(0, client.tracker.in_flight())
+        self.assertEqual({}, client.pending)
+
+    def test_no_deadline(self):
+        client = BabashkaClient(source_root(), "localhost", 0)
+        client.reactor = ImmediateReactor()
+        client.tracker.timeout = 0
+        responses = []
+        client.expect("(inc 1)", responses.append)
+
+        # An evaluation can take any length of time: the client never stops
+        # waiting for its response.
+        self.assertEqual(0, client.tracker.expire())
+
+        response = edn.kwmap({"tag": keywords.RET, "val": "2", "form": "(inc 1)"})
+        client.handle(response)
+        self.assertEqual([response], responses)
+        self.assertEqual({}, client.pending)
+
+    def test_order(self):
+        class QueueingReactor(ImmediateReactor):
+            def __init__(self):
+                self.handlers = []
+
+            def call_handler(self, f, *args):
+                self.handlers.append((f, args))
+
+        client = BabashkaClient(source_root(), "localhost", 0)
+        client.reactor = QueueingReactor()
+        responses = []
+        client.expect("(inc 1)", responses.append)
+
+        ret = edn.kwmap({"tag": keywords.RET, "val": "2", "form": "(inc 1)"})
+        out = edn.kwmap({"tag": keywords.OUT, "val": "a\n"})
+        client.handle(ret)
+        client.handle(out)
+
+        # Responses with a handler and responses that go straight to the
+        # print queue take the same path, so they can't overtake each other.
+        self.assertEqual([(responses.append, (ret,)), (client.recvq.put, (out,))], client.reactor.handlers)
+
+    def test_probe_closed(self):
+        client = BabashkaClient(source_root(), "localhost", 0)
+        client.socket, server = socket.socketpair()
+
+        try:
+            server.sendall(b"user")
+            server.close()
+            self.assertRaises(ConnectionError, client.probe)
+        finally:
+            client.socket.close()
+
+    def test_ready(self):
+        client = JVMClient(source_root(), "localhost", 0)
+        sent = []
+
+        class RecordingBackchannel(object):
+            def send(self, op, handler=None):
+                sent.append(op)
+
+        client.backchannel = RecordingBackchannel()
+        client.defer_modules({"analyzer.clj": []})
+        self.assertEqual(LOADABLE, client.capabilities["analyzer.clj"])
+
+        # The first check starts loading the module, but the op isn't ready
+        # until the module has loaded.
+        self.assertFalse(client.ready("locals"))
+        self.assertEqual(["analyzer.clj"], [op["filename"] for op in sent])
+        self.assertFalse(client.ready("locals"))
+        self.assertEqual(1, len(sent))
+
+        client.capabilities["analyzer.clj"] = LOADED
+        self.assertTrue(client.ready("locals"))
+
+        # Babashka has no analyzer.
+        self.assertFalse(BabashkaClient(source_root(), "localhost", 0).ready("locals"))
+
+    def test_load_deferred_concurrently(self):
+        client = JVMClient(source_root(), "localhost", 0)
+        sent = []
+
+        class RecordingBackchannel(object):
+            def send(self, op, handler=None):
+                sent.append(op)
+
+        client.backchannel = RecordingBackchannel()
+        client.defer_modules({"analyzer.clj": []})
+
+        # Threads that race to send the first op of a deferred module load
+        # the module once.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda op: client.before_op(op), ["locals"] * 64))
+
+        self.assertEqual(["analyzer.clj"], [op["filename"] for op in sent])
+        self.assertEqual({}, client.deferred_modules)
+
+    def test_expand(self):
+        client = JVMClient(source_root(), "localhost", 0)
+        client.reactor = ImmediateReactor()
+        sent = []
+
+        class RecordingBackchannel(object):
+            def send(self, op, handler=None):
+                sent.append((op, handler))
+
+        client.backchannel = RecordingBackchannel()
+        self.assertFalse(client.expand())
+
+        truncated = edn.kwmap({"handle": 1, "offset": 4})
+        client.handle(edn.kwmap({"tag": keywords.RET, "val": "(0 1", "truncated": truncated}))
+        self.assertEqual("(0 1\n… (truncated; use Tutkain: Expand Result to print more)\n", client.printq.get(timeout=1)["printable"])
+
+        self.assertTrue(client.expand())
+        [(op, handler)] = sent
+        self.assertEqual({"op": keywords.EXPAND, "handle": 1, "offset": 4}, op)
+
+        # Continue from the offset the previous page ended at.
+        handler(edn.kwmap({"id": 1, "val": " 2", "truncated": edn.kwmap({"handle": 1, "offset": 6})}))
+        client.printq.get(timeout=1)
+        self.assertTrue(client.expand())
+        (op, handler) = sent[-1]
+        self.assertEqual({"op": keywords.EXPAND, "handle": 1, "offset": 6}, op)
+
+        # The last page isn't truncated, so there's nothing left to expand.
+        handler(edn.kwmap({"id": 2, "val": " 3)\n"}))
+        self.assertEqual(" 3)\n", client.printq.get(timeout=1)["printable"])
+        self.assertFalse(client.expand())
+
+        # A later result that isn't truncated replaces a truncated one.
+        client.handle(edn.kwmap({"tag": keywords.RET, "val": "(0 1", "truncated": truncated}))
+        client.printq.get(timeout=1)
+        client.handle(edn.kwmap({"tag": keywords.RET, "val": "nil"}))
+        client.printq.get(timeout=1)
+        self.assertFalse(client.expand())
+
+
+def output(tag, val):
+    return {"printable": val, "response": edn.kwmap({"tag": edn.Keyword(tag), "val": val})}
+
+
+class TestPrintQueue(TestCase):
+    def test_coalesce(self):
+        printq = PrintQueue()
+        printq.put(output("out", "a\n"))
+        printq.put(output("out", "b\n"))
+        printq.put(output("err", "c\n"))
+        ret = {"printable": "nil", "response": edn.kwmap({"tag": keywords.RET, "val": "nil"})}
+        printq.put(ret)
+        printq.put(output("err", "d\n"))
+        printq.put(None)
+
+        self.assertEqual(output("out", "a\nb\n"), printq.get(timeout=1))
+        self.assertEqual(output("err", "c\n"), printq.get(timeout=1))
+        self.assertEqual(ret, printq.get(timeout=1))
+        self.assertEqual(output("err", "d\n"), printq.get(timeout=1))
+        self.assertIsNone(printq.get(timeout=1))
+        self.assertEqual(0, printq.lines)
+        self.assertRaises(queue.Empty, lambda: printq.get(timeout=0))
+
+    def test_backlog(self):
+        printq = PrintQueue(backlog=3)
+        ret = {"printable": "nil", "response": edn.kwmap({"tag": keywords.RET, "val": "nil"})}
+
+        for n in range(5):
+            printq.put(output("out", f"{n}\n"))
+
+        # Never drop evaluation results.
+        printq.put(ret)
+
+        self.assertEqual(output("out", "0\n1\n2\n"), printq.get(timeout=1))
+        self.assertEqual("… 2 lines dropped\n", printq.get(timeout=1)["printable"])
+        self.assertEqual(ret, printq.get(timeout=1))
+
+        # Once the backlog clears, stop dropping output.
+        printq.put(output("out", "5\n"))
+        self.assertEqual(output("out", "5\n"), printq.get(timeout=1))
+
+    def test_backlog_truncate(self):
+        printq = PrintQueue(backlog=3)
+
+        # Truncate a single item larger than the backlog instead of dropping
+        # it.
+        printq.put(output("out", "0\n1\n2\n3\n4\n"))
+        self.assertEqual(output("out", "0\n1\n2\n"), printq.get(timeout=1))
+        self.assertEqual("… 2 lines dropped\n", printq.get(timeout=1)["printable"])
+        self.assertEqual(0, printq.lines)
+
+        # Queue the lines that still fit into the backlog.
+        printq.put(output("out", "5\n"))
+        printq.put(output("err", "6\n7\n8\n"))
+        printq.put(output("err", "9\n"))
+        self.assertEqual(output("out", "5\n"), printq.get(timeout=1))
+        self.assertEqual(output("err", "6\n7\n"), printq.get(timeout=1))
+        self.assertEqual("… 2 lines dropped\n", printq.get(timeout=1)["printable"])
+
+        # Always queue at least one line.
+        printq = PrintQueue(backlog=0)
+        printq.put(output("out", "0\n1\n"))
+        self.assertEqual(output("out", "0\n"), printq.get(timeout=1))
+        self.assertEqual("… 1 line dropped\n", printq.get(timeout=1)["printable"])
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from Tutkain.api import edn
+from Tutkain.src.repl.completions import CompletionCache, anchor, matches
+
+
+CLJ = edn.Keyword("clj")
+
+
+def candidates(*names):
+    return [edn.kwmap({"candidate": name, "type": edn.Keyword("function")}) for name in names]
+
+
+def names(candidates):
+    return [candidate.get(edn.Keyword("candidate")) for candidate in candidates]
+
+
+class TestCompletionCache(TestCase):
+    def test_narrow(self):
+        cache = CompletionCache()
+        self.assertIsNone(cache.get("user", CLJ, "ma"))
+
+        cache.put("user", CLJ, "ma", candidates("macroexpand", "make-array", "map", "mapcat", "mapv", "max"))
+
+        self.assertEqual(["macroexpand", "map", "mapcat", "mapv"], names(cache.get("user", CLJ, "map")))
+        self.assertEqual(["mapcat"], names(cache.get("user", CLJ, "mapc")))
+        self.assertEqual([], names(cache.get("user", CLJ, "mapx")))
+
+        # Shorter prefixes, other namespaces, and other dialects miss.
+        self.assertIsNone(cache.get("user", CLJ, "m"))
+        self.assertIsNone(cache.get("other", CLJ, "map"))
+        self.assertIsNone(cache.get("user", edn.Keyword("cljs"), "map"))
+
+        # So do prefixes the server searches different candidates for.
+        self.assertIsNone(cache.get("user", CLJ, "ma.x"))
+        self.assertIsNone(cache.get("user", CLJ, "ma/x"))
+
+        self.assertEqual(3, cache.hits)
+
+    def test_truncated(self):
+        cache = CompletionCache()
+        cache.put("user", CLJ, "ma", candidates("map", "mapv"), truncated=True)
+
+        # The server might have left out better matches for a longer prefix.
+        self.assertEqual(["map", "mapv"], names(cache.get("user", CLJ, "ma")))
+        self.assertIsNone(cache.get("user", CLJ, "map"))
+
+    def test_invalidate(self):
+        cache = CompletionCache()
+        cache.put("user", CLJ, "ma", candidates("map"))
+        cache.invalidate()
+        self.assertIsNone(cache.get("user", CLJ, "map"))
+
+    def test_max_entries(self):
+        cache = CompletionCache(max_entries=2)
+
+        for ns in ["a", "b", "c"]:
+            cache.put(ns, CLJ, "m", candidates("map"))
+
+        self.assertIsNone(cache.get("a", CLJ, "m"))
+        self.assertEqual(["map"], names(cache.get("c", CLJ, "m")))
+
+
+class TestMatches(TestCase):
+    def test_anchor(self):
+        self.assertEqual("m", anchor("mct"))
+        self.assertEqual(":a", anchor(":abc"))
+        self.assertEqual("::s", anchor("::spec/"))
+        self.assertEqual(".g", anchor(".get"))
+        self.assertEqual("::", anchor("::"))
+
+    def test_matches(self):
+        self.assertTrue(matches("mct", "mapcat"))
+        self.assertTrue(matches("map", "map"))
+        self.assertFalse(matches("mct", "format"))
+        self.assertFalse(matches("mapx", "mapcat"))
+        self.assertTrue(matches("::sk", "::spec/keys"))
+        self.assertFalse(matches(":sk", "::spec/keys"))
@@ -1,5 +1,14 @@
 """Unit tests for the EDN module."""
 
+from decimal import Decimal
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import datetime
+import math
+import pickle
+import uuid
+
 from unittest import TestCase
 from Tutkain.api import edn
 from .util import start_client, stop_client, start_server
@@ -47,6 +56,195 @@ class TestEdn(TestCase):
             {"a": []},
             {"a": [{"b": "c"}]},
             {edn.Keyword("a"): [{edn.Keyword("b"): edn.Keyword("c")}]},
+            {},
+            set(),
+            'a\\"b\\\\c\n\td\re\x00f',
         ]:
             edn.write(self.buffer, val)
             self.assertEqual(val, edn.read_line(self.buffer))
+
+    def test_line_decoder(self):
+        messages = [
+            '{:tag :ret, :val "{:a \\"}\\" :b [1 2]}\\n", :ns "user", :ms 1}\n',
+            "nil\n",
+            "\n",
+            '"Hello,\nworld!"\n',
+            "[1 [2 (3)] #{4}]\n",
+            '[\\( \\" "a\nb\nc" \\a]\n',
+        ]
+
+        expected = [
+            edn.kwmap({"tag": edn.Keyword("ret"), "val": '{:a "}" :b [1 2]}\n', "ns": "user", "ms": 1}),
+            None,
+            "Hello,\nworld!",
+            [1, [2, [3]], {4}],
+            ["(", '"', "a\nb\nc", "a"],
+        ]
+
+        data = "".join(messages).encode("utf-8")
+
+        for size in [1, 2, 3, 7, 64, len(data)]:
+            decoder = edn.LineDecoder()
+            elements = []
+
+            for i in range(0, len(data), size):
+                decoder.feed(data[i:i + size])
+                elements.extend(decoder)
+
+            self.assertEqual(expected, elements)
+            self.assertEqual(b"", decoder.buffer)
+
+    def test_line_decoder_error(self):
+        errors = []
+        decoder = edn.LineDecoder(on_error=lambda line, error: errors.append(line))
+
+        # Drop a line that isn't valid EDN, or that ends in the middle of an
+        # element, and carry on with the next line.
+        decoder.feed(b'{:tag :ret :val "x" :x \\o777}\n{:tag :ret :val "1"}\n')
+        decoder.feed(b'{:tag :ret :val [1\n{:tag :ret :val "2"}\n')
+
+        self.assertEqual(
+            [edn.kwmap({"tag": edn.Keyword("ret"), "val": "1"}), edn.kwmap({"tag": edn.Keyword("ret"), "val": "2"})],
+            list(decoder)
+        )
+
+        self.assertEqual(['{:tag :ret :val "x" :x \\o777}\n', '{:tag :ret :val [1\n'], errors)
+        self.assertEqual(b"", decoder.buffer)
+
+    def test_line_decoder_lines(self):
+        # An element with many lines takes time proportional to its length.
+        decoder = edn.LineDecoder()
+        decoder.feed(b'"' + b"x\n" * 20000 + b'"\n')
+        self.assertEqual(["x\n" * 20000], list(decoder))
+
+    def test_decoder_readline(self):
+        decoder = edn.LineDecoder()
+        decoder.feed(b"#'user/x\n{:a")
+        self.assertEqual("#'user/x\n", decoder.readline())
+        self.assertEqual(None, decoder.readline())
+        self.assertEqual([], list(decoder))
+        decoder.feed(b" 1}\n")
+        self.assertEqual([{edn.Keyword("a"): 1}], list(decoder))
+
+    def test_read(self):
+        self.assertEqual(None, edn.read(""))
+        self.assertEqual(None, edn.read(" ,\n"))
+        self.assertEqual("a\tb\nc\rd\"e\\f", edn.read('"a\\tb\\nc\\rd\\"e\\\\f"'))
+        self.assertEqual("äö €", edn.read('"äö \\u20ac"'))
+        self.assertEqual(["(", "\n", " ", "\t", "\r", "a", "ä"], edn.read("[\\( \\newline \\space \\tab \\return \\a \\u00e4]"))
+        self.assertEqual({1, 2}, edn.read("#{1 2}"))
+        self.assertEqual([[], {}, []], edn.read("[[] {} ()]"))
+        self.assertEqual(edn.Keyword("bar", "foo"), edn.read(":foo/bar"))
+        self.assertEqual({edn.Keyword("a"): [1, {edn.Keyword("b"): "}"}]}, edn.read('{:a [1 {:b "}"}]} {:c 2}'))
+
+        self.assertRaises(edn.UnmatchedDelimiterError, edn.read, "(1 2]")
+        self.assertRaises(edn.UnmatchedDelimiterError, edn.read, "]")
+        self.assertRaises(EOFError, edn.read, "[1 2")
+        self.assertRaises(EOFError, edn.read, '"abc')
+        self.assertRaises(ValueError, edn.read, "{:a}")
+
+    def test_read_flat_map(self):
+        # Flat maps take a shortcut; they must read the same as any other map.
+        for s in [
+            '{:tag :ret, :val "0\\n", :ns "user", :ms 12, :form "(inc 0)"}\n',
+            '{:a "", :b nil, :c true, :d :e/f, :g -1.5, :h 1/2, :a 2}',
+            '{}',
+            '{:a "x"} {:b 1}',
+            '{:a "x" :b #inst "2020-01-01T00:00:00Z"}',
+            '{:a "x" :b [1]}',
+        ]:
+            # Padding the string past FLAT_MAP_MAX_LENGTH skips the shortcut.
+            self.assertEqual(edn.read(s + " " * edn.FLAT_MAP_MAX_LENGTH), edn.read(s))
+
+        self.assertRaises(ValueError, edn.read, "{:a 1 :b}")
+
+    def test_interned(self):
+        self.assertIs(edn.Keyword("foo"), edn.Keyword("foo"))
+        self.assertIs(edn.Keyword("bar", "foo"), edn.read(":foo/bar"))
+        self.assertIs(edn.Symbol("foo"), edn.read("foo"))
+        self.assertIs(edn.Symbol("bar", "foo"), edn.read("foo/bar"))
+        self.assertIs(edn.Symbol("/"), edn.read("/"))
+        self.assertIsNot(edn.Keyword("foo"), edn.Symbol("foo"))
+        self.assertNotEqual(edn.Keyword("foo"), edn.Keyword("foo", "bar"))
+        self.assertEqual({edn.Keyword("foo"): 1}, edn.kwmap({"foo": 1}))
+        self.assertIs(edn.Keyword("foo"), copy.deepcopy(edn.Keyword("foo")))
+        self.assertIs(edn.Keyword("foo"), pickle.loads(pickle.dumps(edn.Keyword("foo"))))
+
+        with self.assertRaises(AttributeError):
+            edn.Keyword("foo").name = "bar"
+
+    def test_interned_concurrently(self):
+        names = [f"concurrent-{n}" for n in range(1000)]
+
+        def construct(_):
+            return [edn.Keyword(name) for name in names]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(construct, range(8)))
+
+        for keywords in results[1:]:
+            for a, b in zip(results[0], keywords):
+                self.assertIs(a, b)
+
+    def test_dumps(self):
+        self.assertEqual("nil", edn.dumps(None))
+        self.assertEqual("[true false 1 -2]", edn.dumps([True, False, 1, -2]))
+        self.assertEqual("[[] [] #{} {}]", edn.dumps([[], (), set(), {}]))
+        self.assertEqual('"a\\"b\\\\c\\n\\u0001"', edn.dumps('a"b\\c\n\x01'))
+        self.assertEqual("{:a [1 2] :b/c d}", edn.dumps({edn.Keyword("a"): (1, 2), edn.Keyword("c", "b"): edn.Symbol("d")}))
+        self.assertEqual("#{:x}", edn.dumps(frozenset([edn.Keyword("x")])))
+        self.assertRaises(ValueError, edn.dumps, object())
+
+    def test_read_numbers(self):
+        self.assertEqual(
+            [0, -1, 42, 42, 31, 15, 5, 1.5, -0.0025, 1000.0, Decimal("1.0"), Fraction(-3, 4)],
+            edn.read("[0 -1 +42 42N 0x1F 017 2r101 1.5 -2.5e-3 1e3 1.0M -3/4]")
+        )
+
+        self.assertEqual([math.inf, -math.inf], edn.read("[##Inf ##-Inf]"))
+        self.assertTrue(math.isnan(edn.read("##NaN")))
+        self.assertEqual([edn.Symbol("-"), edn.Symbol("+"), edn.Symbol("-foo")], edn.read("[- + -foo]"))
+        self.assertRaises(ValueError, edn.read, "08")
+        self.assertRaises(ValueError, edn.read, "1.5N")
+
+    def test_read_dispatch(self):
+        self.assertEqual(2, edn.read("#_ 1 2"))
+        self.assertEqual([1, 3], edn.read("[1 #_ 2 3]"))
+        self.assertEqual([3], edn.read("[#_ #_ 1 2 3]"))
+        self.assertEqual({edn.Keyword("a"): 1}, edn.read("{:a #_ :b 1}"))
+        self.assertEqual([1, 2], edn.read("[1 ; comment\n 2] ; comment"))
+        self.assertEqual([1], edn.read("^:foo [1]"))
+        self.assertEqual(edn.Symbol("x"), edn.read("^{:a 1} x"))
+
+        self.assertEqual(
+            datetime.datetime(2021, 3, 4, 5, 6, 7, 123000, datetime.timezone(datetime.timedelta(hours=-2))),
+            edn.read('#inst "2021-03-04T05:06:07.123-02:00"')
+        )
+
+        self.assertEqual(datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc), edn.read('#inst "2021"'))
+        self.assertEqual(uuid.UUID("f81d4fae-7dec-11d0-a765-00a0c91e6bf6"), edn.read('#uuid "f81d4fae-7dec-11d0-a765-00a0c91e6bf6"'))
+        self.assertEqual(edn.TaggedLiteral("my/tag", [1]), edn.read("#my/tag [1]"))
+
+        edn.register_tag("test/point", lambda xs: tuple(xs))
+
+        try:
+            self.assertEqual([(1, 2)], edn.read("[#test/point [1 2]]"))
+        finally:
+            edn.TAGS.pop("test/point")
+
+        self.assertRaises(edn.UnmatchedDelimiterError, edn.read, "[#_]")
+        self.assertRaises(EOFError, edn.read, "#inst")
+        self.assertRaises(NotImplementedError, edn.read, "##Foo")
+
+    def test_dumps_extended(self):
+        for val in [
+            [1.5, -0.0025, math.inf, -math.inf],
+            Decimal("1.25"),
+            Fraction(1, 3),
+            datetime.datetime(2021, 3, 4, 5, 6, 7, 123000, datetime.timezone.utc),
+            uuid.UUID("f81d4fae-7dec-11d0-a765-00a0c91e6bf6"),
+            edn.TaggedLiteral("my/tag", {edn.Keyword("a"): 1}),
+        ]:
+            self.assertEqual(val, edn.read(edn.dumps(val)))
+
+        self.assertEqual("##NaN", edn.dumps(math.nan))
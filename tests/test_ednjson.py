@@ -0,0 +1,52 @@
+"""Unit tests for the EDN over JSON module."""
+
+from decimal import Decimal
+from fractions import Fraction
+import math
+
+from unittest import TestCase
+from Tutkain.api import edn, ednjson
+
+
+class TestEdnJson(TestCase):
+    def test_roundtrip(self):
+        for val in [
+            None,
+            True,
+            42,
+            -1.5,
+            "foo",
+            "~foo",
+            "äö\n\"\\",
+            [],
+            {},
+            edn.Keyword("foo"),
+            edn.Keyword("bar", "foo"),
+            edn.Symbol("foo"),
+            edn.Symbol("bar", "foo"),
+            set([1, 2, edn.Keyword("a")]),
+            [1, [2, {edn.Keyword("a"): edn.Keyword("b")}]],
+            {"~k": 1, 2: 3, edn.Symbol("s"): [], edn.Keyword("c", "b"): None},
+            {"~:": "not a keyword"},
+            Decimal("1.5"),
+            Fraction(1, 3),
+            math.inf,
+        ]:
+            self.assertEqual(val, ednjson.loads(ednjson.dumps(val)))
+
+    def test_loads(self):
+        self.assertEqual(
+            {edn.Keyword("tag"): edn.Keyword("ret"), edn.Keyword("val"): "1", "s": "~:x"},
+            ednjson.loads('{"~:tag": {"~:": "ret"}, "~:val": "1", "s": "~:x"}')
+        )
+
+        self.assertEqual(
+            [edn.Keyword("done"), edn.Keyword("b", "a"), edn.Symbol("x"), {1}, Fraction(1, 2)],
+            ednjson.loads('[{"~:": "done"}, {"~:": "a/b"}, {"~$": "x"}, {"~#set": [1]}, {"~#edn": "1/2"}]')
+        )
+
+    def test_dumps(self):
+        self.assertEqual(
+            '{"~:op":{"~:":"echo"},"~~id":1,"~$sym":["äö",null]}',
+            ednjson.dumps({edn.Keyword("op"): edn.Keyword("echo"), "~id": 1, edn.Symbol("sym"): ("äö", None)})
+        )
@@ -2,12 +2,13 @@ import queue
 
 from Tutkain.api import edn
 from Tutkain.package import source_root, start_logging, stop_logging
+from Tutkain.src.repl import keywords
 from Tutkain.src.repl import views
 from Tutkain.src.repl.client import BabashkaClient, JVMClient, JSClient
 from Tutkain.src import base64
 from Tutkain.src import state
 
-from .mock import Server
+from .mock import Server, bootstrap, load_modules
 from .util import ViewTestCase
 
 
@@ -19,22 +20,18 @@ class TestJVMClient(ViewTestCase):
         # Client starts clojure.main/repl
         server.recv()
 
-        # Client switches into the bootstrap namespace
-        server.recv()
-        server.send("nil\n")
-
-        # Client defines load-base64 function
-        server.recv()
-        server.send("#'tutkain.bootstrap/load-base64\n")
+        # Client sends every bootstrap form at once. The REPL has already
+        # loaded the current version of format.clj, so the client doesn't
+        # load it again.
+        bootstrap(
+            server,
+            self.client,
+            ["format.clj", "json.clj", "backchannel.clj", "repl.clj"],
+            cached=["format.clj"]
+        )
 
-        # Client loads modules
-        server.recv()
-        server.send("#'tutkain.format/pp-str")
-        server.recv()
-        server.send("#'tutkain.backchannel/open")
-        server.recv()
-        server.send("#'tutkain.repl/repl")
-        server.recv()
+        # Client starts the REPL in the same write as the module loads
+        assert server.recv().startswith("(try (tutkain.repl/repl ")
 
         with Server() as backchannel:
             server.send({
@@ -42,8 +39,10 @@ class TestJVMClient(ViewTestCase):
                 edn.Keyword("val"): f"""{{:host "localhost", :port {backchannel.port}}}""",
             })
 
-            for _ in range(5):
-                backchannel.recv()
+            load_modules(backchannel, ["lookup.clj", "load_blob.clj"])
+
+            # Client prints the Clojure version
+            server.recv()
 
             server.send({
                 edn.Keyword("tag"): edn.Keyword("out"),
@@ -58,8 +57,6 @@ class TestJVMClient(ViewTestCase):
                 edn.Keyword("form"): """(println "Clojure" (clojure-version))"""
             })
 
-            server.recv()
-
             # Clojure version info is printed on the client
             self.client.printq.get(timeout=5)
 
@@ -107,25 +104,12 @@ class TestJVMClient(ViewTestCase):
             }
         }
 
-    def eval_context(self, ns="user", file="NO_SOURCE_FILE", line=1, column=1):
-        actual = edn.read(self.backchannel.recv())
-        id = actual.get(edn.Keyword("id"))
-
-        response = edn.kwmap({
-             "id": id,
-             "op": edn.Keyword("set-eval-context"),
-             "file": file,
-             "line": line,
-             "column": column,
-        })
-
-        self.assertEquals(response, actual)
-
-        self.backchannel.send(edn.kwmap({
-            "id": id,
-            "file": file,
-            "ns": edn.Symbol(ns)
-        }))
+    def eval_context(self, file="NO_SOURCE_FILE", line=1, column=1):
+        # The client sends the eval context on the line before the code.
+        self.assertEquals(
+            {keywords.EVAL_CONTEXT: edn.kwmap({"file": file, "line": line, "column": column})},
+            edn.read(self.server.recv())
+        )
 
     def test_outermost(self):
         self.set_view_content("(comment (inc 1) (inc 2))")
@@ -133,9 +117,8 @@ class TestJVMClient(ViewTestCase):
         self.view.run_command("tutkain_evaluate", {"scope": "outermost"})
 
         self.eval_context(column=10)
-        self.eval_context(column=18)
-
         self.assertEquals("(inc 1)\n", self.server.recv())
+        self.eval_context(column=18)
         self.assertEquals("(inc 2)\n", self.server.recv())
 
     def test_outermost_empty(self):
@@ -157,11 +140,11 @@ class TestJVMClient(ViewTestCase):
         self.set_selections((0, 0), (3, 3))
         self.view.run_command("tutkain_evaluate", {"scope": "form"})
         self.eval_context()
-        self.assertEquals(self.print_item("user", "42"), self.get_print())
-        self.eval_context(column=4)
-        self.assertEquals(self.print_item("user", "84"), self.get_print())
         self.assertEquals("42\n", self.server.recv())
+        self.eval_context(column=4)
         self.assertEquals("84\n", self.server.recv())
+        self.assertEquals(self.print_item("user", "42"), self.get_print())
+        self.assertEquals(self.print_item("user", "84"), self.get_print())
 
     def test_parameterized(self):
         self.set_view_content("{:a 1} {:b 2}")
@@ -172,21 +155,21 @@ class TestJVMClient(ViewTestCase):
 
     def test_eval_in_ns(self):
         self.view.run_command("tutkain_evaluate", {"code": "(reset)", "ns": "user"})
-        self.eval_context()
         self.assertEquals(self.print_item("user", "(reset)"), self.get_print())
         # Clients sends ns first
         ret = self.server.recv()
         self.assertTrue(ret.startswith("(do (or (some->> "))
+        self.eval_context()
         self.assertEquals("(reset)\n", self.server.recv())
 
     def test_ns(self):
         self.set_view_content("(ns foo.bar) (ns baz.quux) (defn x [y] y)")
         self.set_selections((0, 0))
         self.view.run_command("tutkain_evaluate", {"scope": "ns"})
-        self.eval_context(ns="baz.quux")
+        self.eval_context()
         self.assertEquals(self.print_item("user", "(ns foo.bar)"), self.get_print())
         self.assertEquals("(ns foo.bar)\n", self.server.recv())
-        self.eval_context(ns="baz.quux", column=14)
+        self.eval_context(column=14)
         self.assertEquals(self.print_item("user", "(ns baz.quux)"), self.get_print())
         self.assertEquals("(ns baz.quux)\n", self.server.recv())
 
@@ -329,25 +312,17 @@ class TestJSClient(ViewTestCase):
             edn.Keyword("npm")
         ])
 
-        # Client switches into the bootstrap namespace
-        server.recv()
-        server.send("nil\n")
-
-        # Client defines load-base64 function
-        server.recv()
-        server.send("#'tutkain.bootstrap/load-base64\n")
-
-        # Client loads modules
-        server.recv()
-        server.send("#'tutkain.format/pp-str")
-        server.recv()
-        server.send("#'tutkain.backchannel/open")
-        server.recv()
-        server.send("#'tutkain.repl/repl")
+        # Client sends every bootstrap form at once. The REPL has already
+        # loaded the current version of every module but shadow.clj.
+        bootstrap(
+            server,
+            self.client,
+            ["format.clj", "json.clj", "backchannel.clj", "shadow.clj"],
+            cached=["format.clj", "json.clj", "backchannel.clj"]
+        )
 
         # Client starts REPL
-        server.recv()
-
+        assert server.recv().startswith("(try (tutkain.shadow/repl ")
 
         with Server() as backchannel:
             server.send({
@@ -355,8 +330,7 @@ class TestJSClient(ViewTestCase):
                 edn.Keyword("port"): backchannel.port
             })
 
-            for _ in range(4):
-                backchannel.recv()
+            load_modules(backchannel, ["lookup.clj", "completions.clj", "cljs.clj", "shadow.clj"])
 
             # Client sends version print
             server.recv()
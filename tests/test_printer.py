@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+from unittest import TestCase
+
+from Tutkain.src.repl.printer import Scrollback
+
+
+class TestScrollback(TestCase):
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "repl.log")
+            scrollback = Scrollback(max_lines=10, log_path=path, log_max_bytes=8, log_backups=2)
+
+            for characters in ["⁣a\n⁣", "b\n", "c\n", "d\n", "e\n", "f\n"]:
+                scrollback.spill(characters * 2)
+
+            self.assertEqual(["repl.log", "repl.log.1", "repl.log.2"], sorted(os.listdir(directory)))
+
+            def read(name):
+                with open(os.path.join(directory, name), encoding="utf-8") as file:
+                    return file.read()
+
+            self.assertEqual("e\ne\nf\nf\n", read("repl.log"))
+            self.assertEqual("c\nc\nd\nd\n", read("repl.log.1"))
+            self.assertEqual("a\na\nb\nb\n", read("repl.log.2"))
@@ -0,0 +1,108 @@
+import queue
+import socket
+
+from unittest import TestCase
+
+from Tutkain.src.repl.reactor import Reactor
+
+
+class TestReactor(TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+
+    def tearDown(self):
+        self.reactor.stop()
+
+    def test_channel(self):
+        left, right = socket.socketpair()
+        received = queue.Queue()
+        closed = queue.Queue()
+
+        def on_readable():
+            if data := right.recv(65536):
+                received.put(data)
+                return True
+            else:
+                return False
+
+        channel = self.reactor.channel(right, on_readable, lambda: closed.put(True)).open()
+
+        try:
+            # Send more than the socket accepts at once so that the channel
+            # has to wait for the socket to become writable.
+            data = b"x" * (4 * 1024 * 1024)
+            channel.send(data)
+            left.setblocking(True)
+            n = 0
+
+            while n < len(data):
+                n += len(left.recv(65536))
+
+            self.assertEqual(len(data), n)
+
+            left.sendall(b"hello")
+            self.assertEqual(b"hello", received.get(timeout=1))
+
+            left.close()
+            self.assertTrue(closed.get(timeout=1))
+        finally:
+            left.close()
+            right.close()
+
+    def test_close(self):
+        left, right = socket.socketpair()
+        closed = queue.Queue()
+        channel = self.reactor.channel(right, lambda: bool(right.recv(65536)), lambda: closed.put(True)).open()
+
+        try:
+            channel.send(b"bye\n")
+            channel.close()
+
+            self.assertTrue(closed.get(timeout=1))
+            self.assertEqual(b"bye\n", left.makefile("rb").readline())
+            self.assertEqual(b"", left.recv(1))
+        finally:
+            left.close()
+            right.close()
+
+    def test_call_handler(self):
+        started = queue.Queue()
+        release = queue.Queue()
+        called = queue.Queue()
+
+        def slow_handler():
+            started.put(True)
+            release.get(timeout=1)
+
+        # A slow handler doesn't hold up the reactor thread.
+        self.reactor.start()
+        self.reactor.call_handler(slow_handler)
+        self.assertTrue(started.get(timeout=1))
+        self.reactor.call_soon(called.put, "call")
+        self.assertEqual("call", called.get(timeout=1))
+
+        # Handlers run in the order they arrive.
+        self.reactor.call_handler(called.put, 1)
+        self.reactor.call_handler(called.put, 2)
+        release.put(True)
+        self.assertEqual([1, 2], [called.get(timeout=1), called.get(timeout=1)])
+
+    def test_stop(self):
+        left, right = socket.socketpair()
+        closed = queue.Queue()
+        channel = self.reactor.channel(right, lambda: bool(right.recv(65536)), lambda: closed.put(True)).open()
+
+        try:
+            channel.send(b"bye\n")
+            self.reactor.stop()
+
+            # Stopping the reactor sends pending writes and closes every
+            # channel.
+            self.assertTrue(closed.get(timeout=1))
+            self.assertEqual(b"bye\n", left.makefile("rb").readline())
+            self.assertEqual(b"", left.recv(1))
+            self.reactor.thread.join(timeout=1)
+            self.assertFalse(self.reactor.thread.is_alive())
+        finally:
+            left.close()
+            right.close()
@@ -0,0 +1,87 @@
+from unittest import TestCase
+
+from Tutkain.src.repl.tracker import NO_DEADLINE, Histogram, Tracker
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTracker(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = Tracker(timeout=10, clock=self.clock)
+
+    def test_complete(self):
+        a = self.tracker.track("a", "eval")
+        b = self.tracker.track("b", "eval")
+        self.assertNotEqual(a, b)
+        self.assertEqual(2, self.tracker.in_flight())
+        self.assertEqual(2, self.tracker.in_flight("eval"))
+
+        self.clock.now = 0.003
+        self.assertEqual("b", self.tracker.complete(b))
+        self.assertIsNone(self.tracker.complete(b))
+        self.assertEqual(1, self.tracker.in_flight())
+
+        metrics = self.tracker.metrics()
+        self.assertEqual({"eval": 1}, metrics["in_flight"])
+        self.assertEqual(1, metrics["completed"])
+        self.assertEqual(1, metrics["latency"]["eval"]["count"])
+        self.assertEqual(5, metrics["latency"]["eval"]["p50"])
+
+    def test_cancel(self):
+        a = self.tracker.track("a", "completions")
+        self.assertTrue(self.tracker.cancel(a))
+        self.assertFalse(self.tracker.cancel(a))
+        self.assertIsNone(self.tracker.complete(a))
+
+        metrics = self.tracker.metrics()
+        self.assertEqual(1, metrics["cancelled"])
+        self.assertEqual(0, metrics["completed"])
+
+    def test_expire(self):
+        timed_out = []
+        a = self.tracker.track("a", "lookup", on_timeout=timed_out.append)
+        b = self.tracker.track("b", "lookup", timeout=60)
+
+        self.clock.now = 9
+        self.assertEqual(0, self.tracker.expire())
+
+        self.clock.now = 10
+        self.assertEqual(1, self.tracker.expire())
+        self.assertEqual([a], timed_out)
+        self.assertIsNone(self.tracker.complete(a))
+        self.assertEqual("b", self.tracker.complete(b))
+        self.assertEqual(1, self.tracker.metrics()["expired"])
+
+    def test_schedule(self):
+        scheduled = []
+        tracker = Tracker(timeout=10, schedule=lambda delay, f: scheduled.append((delay, f)))
+        tracker.track("a", timeout=5)
+        self.assertEqual([(5, tracker.expire)], scheduled)
+
+    def test_no_deadline(self):
+        scheduled = []
+        tracker = Tracker(timeout=10, schedule=lambda delay, f: scheduled.append((delay, f)), clock=self.clock)
+        a = tracker.track("a", "eval", timeout=NO_DEADLINE)
+        self.assertEqual([], scheduled)
+
+        self.clock.now = 1e9
+        self.assertEqual(0, tracker.expire())
+        self.assertEqual("a", tracker.complete(a))
+
+    def test_histogram(self):
+        histogram = Histogram(bounds=(1, 10, 100))
+        self.assertIsNone(histogram.percentile(50))
+
+        for ms in [0.5, 5, 5, 50, 500]:
+            histogram.record(ms)
+
+        self.assertEqual([1, 2, 1, 1], histogram.counts)
+        self.assertEqual(10, histogram.percentile(50))
+        self.assertEqual(float("inf"), histogram.percentile(100))